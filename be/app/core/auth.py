@@ -1,54 +1,218 @@
-from fastapi import HTTPException, status, Security
+from fastapi import Depends, HTTPException, status, Security
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import asyncio
+import hashlib
 import httpx
 import os
+import time
 import jwt
 from jwt.algorithms import RSAAlgorithm
-import json
 
 security = HTTPBearer()
 
 CLERK_ISSUER = os.getenv("CLERK_ISSUER")
 CLERK_JWKS_URL = f"{CLERK_ISSUER}/.well-known/jwks.json"
 
+JWKS_CACHE_TTL = float(os.getenv("JWKS_CACHE_TTL", "3600"))
+JWKS_REFRESH_MARGIN = float(os.getenv("JWKS_REFRESH_MARGIN", "300"))
+JWKS_MIN_REFETCH_INTERVAL = float(os.getenv("JWKS_MIN_REFETCH_INTERVAL", "30"))
+
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+TOKEN_CACHE_MAX_TTL = float(os.getenv("TOKEN_CACHE_MAX_TTL", "300"))
+
+# Clerk user ids allowed to read /api/system/*; nobody can while it is empty.
+SYSTEM_ADMIN_USER_IDS = {u.strip() for u in os.getenv("SYSTEM_ADMIN_USER_IDS", "").split(",") if u.strip()}
+
+
+# Parsed Clerk signing keys indexed by kid. Refreshed in the background
+# shortly before the TTL runs out; an unknown kid forces a refetch. Refetches
+# happen at most once per min_refetch_interval, so neither forged kids nor a
+# Clerk outage can hammer Clerk, and during an outage the last good keys keep
+# being used.
+class JWKSCache:
+    def __init__(
+        self,
+        url: str,
+        ttl: float = JWKS_CACHE_TTL,
+        refresh_margin: float = JWKS_REFRESH_MARGIN,
+        min_refetch_interval: float = JWKS_MIN_REFETCH_INTERVAL
+    ):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl / 2)
+        self.min_refetch_interval = min_refetch_interval
+        self._keys: Dict[str, Any] = {}
+        self._expires_at = 0.0
+        self._last_fetch = 0.0
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    async def get_key(self, kid: str):
+        now = time.monotonic()
+
+        if not self._keys:
+            # Nothing to fall back on; a failed fetch fails the request.
+            await self._refresh()
+        elif now >= self._expires_at:
+            if now - self._last_fetch >= self.min_refetch_interval:
+                try:
+                    await self._refresh()
+                except Exception as e:
+                    # Keep verifying with the last good keys while Clerk is
+                    # unreachable and try again after min_refetch_interval.
+                    print(f"JWKS refresh failed, serving cached keys: {e}")
+                    self._expires_at = time.monotonic() + self.min_refetch_interval
+        elif now >= self._expires_at - self.refresh_margin and now - self._last_fetch >= self.min_refetch_interval:
+            self._schedule_background_refresh()
+
+        key = self._keys.get(kid)
+        if key is None and time.monotonic() - self._last_fetch >= self.min_refetch_interval:
+            try:
+                await self._refresh(force=True)
+            except Exception as e:
+                print(f"JWKS refresh for unknown kid {kid} failed: {e}")
+            key = self._keys.get(kid)
+        return key
+
+    def _schedule_background_refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._background_refresh())
+
+    async def _background_refresh(self):
+        try:
+            await self._refresh(force=True)
+        except Exception as e:
+            print(f"JWKS background refresh failed: {e}")
+
+    async def _refresh(self, force: bool = False):
+        started = time.monotonic()
+        async with self._lock:
+            # Another coroutine may have refreshed while we waited for the lock.
+            if self._last_fetch > started or (not force and self._keys and time.monotonic() < self._expires_at):
+                return
+
+            try:
+                async with httpx.AsyncClient() as client:
+                    response = await client.get(self.url, timeout=10.0)
+                    response.raise_for_status()
+                    jwks = response.json()
+            finally:
+                self._last_fetch = time.monotonic()
+
+            keys = {}
+            for jwk in jwks.get("keys", []):
+                kid = jwk.get("kid")
+                if not kid or jwk.get("kty") != "RSA":
+                    continue
+                try:
+                    keys[kid] = RSAAlgorithm.from_jwk(jwk)
+                except Exception as e:
+                    print(f"Skipping unusable JWK {kid}: {e}")
+
+            self._keys = keys
+            self._expires_at = time.monotonic() + self.ttl
+            print(f"JWKS refreshed: {len(keys)} signing keys cached")
+
+
+# Claims of already verified bearer tokens, keyed by the token's SHA-256 so raw
+# JWTs never sit in memory as keys. Entries die at the token's exp (capped at
+# max_ttl) and the least recently used entry is evicted once max_entries is hit.
+class VerifiedTokenCache:
+    def __init__(self, max_entries: int = TOKEN_CACHE_MAX_ENTRIES, max_ttl: float = TOKEN_CACHE_MAX_TTL):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        key = self._key(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, claims = entry
+        if time.time() >= expires_at:
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return claims
+
+    def put(self, token: str, claims: Dict[str, Any]):
+        if self.max_entries <= 0:
+            return
+        exp = claims.get("exp")
+        if exp is None:
+            return
+
+        expires_at = min(float(exp), time.time() + self.max_ttl)
+        key = self._key(token)
+        self._entries[key] = (expires_at, claims)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None
+        }
+
+
+jwks_cache = JWKSCache(CLERK_JWKS_URL)
+token_cache = VerifiedTokenCache()
+
+
+def get_token_cache_stats() -> Dict[str, Any]:
+    return token_cache.stats()
+
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Security(security)):
     token = credentials.credentials
-    
+
+    cached_claims = token_cache.get(token)
+    if cached_claims is not None:
+        return cached_claims
+
     try:
         if not CLERK_ISSUER:
             print("CRITICAL: CLERK_ISSUER env var is not set!")
             raise ValueError("CLERK_ISSUER not set")
 
-        async with httpx.AsyncClient() as client:
-            print(f"Fetching JWKS from: {CLERK_JWKS_URL}")
-            response = await client.get(CLERK_JWKS_URL)
-            response.raise_for_status()
-            jwks = response.json()
-
         unverified_header = jwt.get_unverified_header(token)
         kid = unverified_header.get("kid")
 
-        rsa_key = {}
-        for key in jwks["keys"]:
-            if key["kid"] == kid:
-                rsa_key = {
-                    "kty": key["kty"],
-                    "kid": key["kid"],
-                    "use": key["use"],
-                    "n": key["n"],
-                    "e": key["e"]
-                }
-                break
-        
-        if not rsa_key:
+        public_key = await jwks_cache.get_key(kid) if kid else None
+        if public_key is None:
              raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Could not find verifying key",
                 headers={"WWW-Authenticate": "Bearer"},
             )
 
-        public_key = RSAAlgorithm.from_jwk(json.dumps(rsa_key))
-
         payload = jwt.decode(
             token,
             public_key,
@@ -57,9 +221,10 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Security(
             issuer=CLERK_ISSUER,
             options={"verify_aud": False}
         )
-        
+
+        token_cache.put(token, payload)
         return payload
-        
+
     except Exception as e:
         print(f"Auth Error: {e}")
         raise HTTPException(
@@ -67,3 +232,11 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Security(
             detail="Invalid authentication credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
+
+
+# Guards the operational stats under /api/system: they expose cache, pool and
+# upstream internals, so only the configured admins may read them.
+async def require_system_access(current_user: dict = Depends(get_current_user)):
+    if current_user.get("sub") not in SYSTEM_ADMIN_USER_IDS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed")
+    return current_user
@@ -1,21 +1,144 @@
-from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy import event
+from contextvars import ContextVar
+from opentelemetry import metrics
+from typing import Any, Dict, Optional
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+meter = metrics.get_meter("madlen.db")
+_checkout_wait_histogram = meter.create_histogram(
+    "db.pool.checkout.wait",
+    unit="ms",
+    description="Time spent waiting for a pooled database connection"
+)
+_checkout_failure_counter = meter.create_counter(
+    "db.pool.checkout.failures",
+    description="Connection checkouts that failed or timed out"
+)
+
+def _async_url(url: str) -> str:
+    # Keep accepting the plain URLs from .env / docker-compose and pick the asyncio driver here.
+    for prefix, async_prefix in (
+        ("postgresql+psycopg2://", "postgresql+asyncpg://"),
+        ("postgresql://", "postgresql+asyncpg://"),
+        ("postgres://", "postgresql+asyncpg://"),
+        ("sqlite://", "sqlite+aiosqlite://"),
+    ):
+        if url.startswith(prefix):
+            return async_prefix + url[len(prefix):]
+    return url
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_checkout(self, wait: float):
+        self.checkouts += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        _checkout_wait_histogram.record(wait * 1000)
+
+    def record_failure(self):
+        self.checkout_failures += 1
+        _checkout_failure_counter.add(1)
+
+pool_stats = PoolStats()
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    # _do_get is where QueuePool blocks when every connection is checked out,
+    # so timing it gives the queueing delay a request pays for a connection.
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except Exception:
+            pool_stats.record_failure()
+            raise
+        pool_stats.record_checkout(time.perf_counter() - started)
+        return conn
+
+def _engine_options(url: str) -> Dict[str, Any]:
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "poolclass": InstrumentedPool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+engine = create_async_engine(_async_url(DATABASE_URL), **_engine_options(DATABASE_URL))
+
+class QueryTimer:
+    # Database time spent on behalf of one HTTP request (see RequestMetricsMiddleware).
+    __slots__ = ("seconds", "queries")
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.queries = 0
+
+request_query_timer: ContextVar[Optional[QueryTimer]] = ContextVar("request_query_timer", default=None)
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    timer = request_query_timer.get()
+    if timer is not None:
+        timer.seconds += time.perf_counter() - started
+        timer.queries += 1
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute.
+    conn = context.connection
+    if conn is not None and conn.info.get("query_started"):
+        conn.info["query_started"].pop()
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+def get_pool_stats() -> Dict[str, Any]:
+    pool = engine.pool
+    stats = {
+        "pool_class": type(pool).__name__,
+        "checkouts": pool_stats.checkouts,
+        "checkout_failures": pool_stats.checkout_failures,
+        "avg_wait_ms": round(pool_stats.total_wait / pool_stats.checkouts * 1000, 3) if pool_stats.checkouts else 0.0,
+        "max_wait_ms": round(pool_stats.max_wait * 1000, 3),
+    }
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        stats.update({
+            "pool_size": pool.size(),
+            "max_overflow": DB_MAX_OVERFLOW,
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": max(0, pool.overflow()),
+        })
+    return stats
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -0,0 +1,33 @@
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+import anyio
+
+
+class DisconnectAwareStreamingResponse(StreamingResponse):
+    # StreamingResponse only notices a closed connection when the next chunk fails
+    # to send (ASGI 2.4 servers) and never closes its body iterator, so an abandoned
+    # generator - and the upstream request it is reading from - keeps running until
+    # the model finishes or the generator is garbage collected. Here the client is
+    # watched for the whole response and the iterator is closed as soon as it goes
+    # away, so the generator's cleanup runs right then.
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            async with anyio.create_task_group() as task_group:
+                async def stream():
+                    try:
+                        await self.stream_response(send)
+                    except OSError:
+                        pass
+                    task_group.cancel_scope.cancel()
+
+                task_group.start_soon(stream)
+                await self.listen_for_disconnect(receive)
+                task_group.cancel_scope.cancel()
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                with anyio.CancelScope(shield=True):
+                    await aclose()
+
+        if self.background is not None:
+            await self.background()
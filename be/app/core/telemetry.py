@@ -1,14 +1,119 @@
-from opentelemetry import trace
+from opentelemetry import trace, metrics
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
 from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from opentelemetry.instrumentation.sqlalchemy import SQLAlchemyInstrumentor
+from opentelemetry.metrics import Observation
 from fastapi import FastAPI
+from .database import get_pool_stats, QueryTimer, request_query_timer
+import os
 import socket
 
+OTEL_METRICS_ENDPOINT = os.getenv("OTEL_METRICS_ENDPOINT")
+OTEL_METRICS_EXPORT_INTERVAL_MS = int(os.getenv("OTEL_METRICS_EXPORT_INTERVAL_MS", "15000"))
+PROMETHEUS_METRICS_ENABLED = os.getenv("PROMETHEUS_METRICS_ENABLED", "false").lower() in ("1", "true", "yes")
+
+resource = Resource.create(attributes={
+    "service.name": "madlen-ai-backend",
+    "service.version": "1.0.0"
+})
+
+def setup_metrics(app: FastAPI = None):
+    readers = []
+    if OTEL_METRICS_ENDPOINT:
+        readers.append(PeriodicExportingMetricReader(
+            OTLPMetricExporter(endpoint=OTEL_METRICS_ENDPOINT),
+            export_interval_millis=OTEL_METRICS_EXPORT_INTERVAL_MS
+        ))
+        print(f"TELEMETRY: Exporting metrics to {OTEL_METRICS_ENDPOINT}")
+    if PROMETHEUS_METRICS_ENABLED:
+        reader = _prometheus_reader(app)
+        if reader is not None:
+            readers.append(reader)
+
+    metrics.set_meter_provider(MeterProvider(resource=resource, metric_readers=readers))
+    _register_db_pool_metrics(metrics.get_meter("madlen.db"))
+
+def _prometheus_reader(app: FastAPI):
+    # Optional: needs opentelemetry-exporter-prometheus (which brings prometheus_client).
+    try:
+        from opentelemetry.exporter.prometheus import PrometheusMetricReader
+        from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+    except ImportError:
+        print("TELEMETRY WARNING: PROMETHEUS_METRICS_ENABLED is set but opentelemetry-exporter-prometheus is not installed")
+        return None
+
+    if app is not None:
+        from starlette.responses import Response
+
+        async def prometheus_metrics(request):
+            return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+        app.add_route("/metrics", prometheus_metrics, include_in_schema=False)
+    print("TELEMETRY: Serving Prometheus metrics at /metrics")
+    return PrometheusMetricReader()
+
+def _register_db_pool_metrics(meter):
+    def observe(key):
+        def callback(options):
+            value = get_pool_stats().get(key)
+            return [Observation(value)] if value is not None else []
+        return callback
+
+    meter.create_observable_gauge("db.pool.size", callbacks=[observe("pool_size")],
+                                  description="Configured number of pooled connections")
+    meter.create_observable_gauge("db.pool.checked_out", callbacks=[observe("checked_out")],
+                                  description="Connections currently checked out")
+    meter.create_observable_gauge("db.pool.overflow", callbacks=[observe("overflow")],
+                                  description="Connections open beyond pool_size")
+    meter.create_observable_gauge("db.pool.checked_in", callbacks=[observe("checked_in")],
+                                  description="Idle connections in the pool")
+
+_db_time_histogram = metrics.get_meter("madlen.db").create_histogram(
+    "db.request.time",
+    unit="ms",
+    description="Database time spent while serving one HTTP request",
+    explicit_bucket_boundaries_advisory=[1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+)
+_db_queries_histogram = metrics.get_meter("madlen.db").create_histogram(
+    "db.request.queries",
+    unit="{query}",
+    description="Statements executed while serving one HTTP request",
+    explicit_bucket_boundaries_advisory=[0, 1, 2, 3, 5, 8, 13, 21, 50]
+)
+
+class RequestMetricsMiddleware:
+    # Pure ASGI so the measurement covers streamed bodies too. Statements run by
+    # background tasks (the message writer) are not attributed to any request.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timer = QueryTimer()
+        token = request_query_timer.set(timer)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_query_timer.reset(token)
+            route = scope.get("route")
+            if route is not None and timer.queries:
+                attributes = {"endpoint": getattr(route, "path", "unknown"), "method": scope["method"]}
+                _db_time_histogram.record(timer.seconds * 1000, attributes)
+                _db_queries_histogram.record(timer.queries, attributes)
+
 def setup_telemetry(app: FastAPI, engine):
+    setup_metrics(app)
+    app.add_middleware(RequestMetricsMiddleware)
+
     endpoint = "http://localhost:4318/v1/traces"
     
     try:
@@ -25,11 +130,6 @@ def setup_telemetry(app: FastAPI, engine):
 
     print("TELEMETRY: Connecting to Jaeger at localhost:4318...")
 
-    resource = Resource.create(attributes={
-        "service.name": "madlen-ai-backend",
-        "service.version": "1.0.0"
-    })
-
     provider = TracerProvider(resource=resource)
     trace.set_tracer_provider(provider)
 
@@ -42,7 +142,7 @@ def setup_telemetry(app: FastAPI, engine):
     print("TELEMETRY: FastAPI instrumented")
 
     if engine:
-        SQLAlchemyInstrumentor().instrument(engine=engine)
+        SQLAlchemyInstrumentor().instrument(engine=getattr(engine, "sync_engine", engine))
         print("TELEMETRY: SQLAlchemy instrumented")
 
     print("TELEMETRY SUCCESS: Connected to Jaeger! Traces will be sent to http://localhost:16686")
@@ -1,26 +1,67 @@
+from contextlib import asynccontextmanager
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from .routers import chat
+from .routers import chat, system
 import os
-from .core.database import engine, Base
-from . import models
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import text
+from .core.database import engine
 from .core.telemetry import setup_telemetry
+from .services import openrouter
+from .services.model_catalog import model_catalog
+from .services.message_writer import message_writer
 
-try:
-    Base.metadata.create_all(bind=engine)
-    print("--- SUCCESS: Database tables created successfully! ---")
-except Exception as e:
-    print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-    print("CRITICAL ERROR: Could not connect to the database or create tables.")
-    print("Please check your password in be/.env file.")
-    print("Error details:", str(e))
-    print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "true").lower() in ("1", "true", "yes")
+# Postgres advisory lock key ("madlen") held while migrating on startup.
+MIGRATION_LOCK_ID = 0x6D61646C656E
 
-app = FastAPI(title="Madlen AI Backend")
+def _upgrade_schema(connection):
+    # Every worker runs this on startup; the lock makes them migrate one after
+    # another (the later ones find the schema at head). It is released when the
+    # surrounding transaction ends.
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+    config = Config(os.path.join(BACKEND_DIR, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(BACKEND_DIR, "migrations"))
+    config.attributes["connection"] = connection
+    config.attributes["configure_logging"] = False
+    command.upgrade(config, "head")
+
+async def init_db():
+    if not DB_AUTO_MIGRATE:
+        return
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(_upgrade_schema)
+        print("--- SUCCESS: Database schema is up to date! ---")
+    except Exception as e:
+        print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        print("CRITICAL ERROR: Could not connect to the database or run migrations.")
+        print("Please check your password in be/.env file.")
+        print("Error details:", str(e))
+        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await init_db()
+    await openrouter.startup()
+    await message_writer.start()
+    # Warm the model catalog without holding up startup on OpenRouter.
+    warmup = asyncio.create_task(model_catalog.refresh())
+    yield
+    warmup.cancel()
+    await message_writer.stop()
+    await openrouter.shutdown()
+    await engine.dispose()
+
+app = FastAPI(title="Madlen AI Backend", lifespan=lifespan)
 
 setup_telemetry(app, engine)
 
@@ -32,6 +73,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[chat.NEXT_CURSOR_HEADER],
 )
 
 @app.get("/")
@@ -39,3 +81,4 @@ def read_root():
     return {"message": "Welcome to Madlen AI API"}
 
 app.include_router(chat.router)
+app.include_router(system.router)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Index, false
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import uuid
@@ -35,5 +35,12 @@ class Message(Base):
     model = Column(String, nullable=True)
     image_url = Column(String, nullable=True)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    truncated = Column(Boolean, nullable=False, default=False, server_default=false())
 
     session = relationship("ChatSession", back_populates="messages")
+
+Index(
+    "ix_chat_sessions_user_id_updated_at",
+    ChatSession.user_id, ChatSession.updated_at.desc(), ChatSession.id.desc()
+)
+Index("ix_messages_session_id_timestamp", Message.session_id, Message.timestamp, Message.id)
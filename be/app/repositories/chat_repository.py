@@ -1,52 +1,169 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import select, func, tuple_, update, insert, or_, bindparam
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, List, Optional, Tuple
 from .. import models
 from datetime import datetime
+import base64
+import json
 import uuid
 
+PREVIEW_LENGTH = 50
+
+Cursor = Tuple[datetime, str]
+
+def encode_cursor(timestamp: datetime, item_id: str) -> str:
+    raw = json.dumps([timestamp.isoformat(), item_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Cursor:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    timestamp, item_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    return datetime.fromisoformat(timestamp), str(item_id)
+
 class ChatRepository:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
 
-    def get_user(self, user_id: str):
-        return self.db.query(models.User).filter(models.User.id == user_id).first()
+    async def get_user(self, user_id: str):
+        result = await self.db.execute(
+            select(models.User).filter(models.User.id == user_id)
+        )
+        return result.scalars().first()
 
-    def create_user(self, user_id: str, email: str = None):
+    async def create_user(self, user_id: str, email: str = None):
         user = models.User(id=user_id, email=email)
         self.db.add(user)
-        self.db.commit()
-        self.db.refresh(user)
+        await self.db.commit()
+        await self.db.refresh(user)
         return user
 
-    def get_user_sessions(self, user_id: str):
-        return self.db.query(models.ChatSession)\
-            .filter(models.ChatSession.user_id == user_id)\
-            .order_by(models.ChatSession.updated_at.desc())\
-            .all()
+    async def get_user_sessions(
+        self,
+        user_id: str,
+        limit: Optional[int] = None,
+        before: Optional[Cursor] = None,
+        after: Optional[Cursor] = None
+    ):
+        # One round trip: the last message of each session is picked by a correlated
+        # subquery and only PREVIEW_LENGTH + 1 characters of it leave the database
+        # (the extra one tells the caller whether the text was cut).
+        last_message_preview = (
+            select(func.substr(models.Message.content, 1, PREVIEW_LENGTH + 1))
+            .where(models.Message.session_id == models.ChatSession.id)
+            .order_by(models.Message.timestamp.desc(), models.Message.id.desc())
+            .limit(1)
+            .correlate(models.ChatSession)
+            .scalar_subquery()
+        )
+        # Keyset pagination on (updated_at, id), newest first; served by
+        # ix_chat_sessions_user_id_updated_at.
+        key = tuple_(models.ChatSession.updated_at, models.ChatSession.id)
+        query = select(models.ChatSession, last_message_preview.label("preview"))\
+            .filter(models.ChatSession.user_id == user_id)
+        if before:
+            query = query.filter(key < tuple_(*before))
+        if after:
+            query = query.filter(key > tuple_(*after))
+            query = query.order_by(models.ChatSession.updated_at.asc(), models.ChatSession.id.asc())
+        else:
+            query = query.order_by(models.ChatSession.updated_at.desc(), models.ChatSession.id.desc())
+        if limit:
+            query = query.limit(limit)
+
+        result = await self.db.execute(query)
+        rows = result.all()
+        return rows[::-1] if after else rows
 
-    def create_session(self, user_id: str):
+    async def create_session(self, user_id: str):
         new_session = models.ChatSession(user_id=user_id)
         self.db.add(new_session)
-        self.db.commit()
-        self.db.refresh(new_session)
+        await self.db.commit()
+        await self.db.refresh(new_session)
         return new_session
 
-    def get_session(self, session_id: str, user_id: str):
-        return self.db.query(models.ChatSession).filter(
-            models.ChatSession.id == session_id,
-            models.ChatSession.user_id == user_id
-        ).first()
+    async def get_session(self, session_id: str, user_id: str):
+        result = await self.db.execute(
+            select(models.ChatSession).filter(
+                models.ChatSession.id == session_id,
+                models.ChatSession.user_id == user_id
+            )
+        )
+        return result.scalars().first()
+
+    async def delete_session(self, session: models.ChatSession):
+        await self.db.delete(session)
+        await self.db.commit()
 
-    def delete_session(self, session: models.ChatSession):
-        self.db.delete(session)
-        self.db.commit()
+    async def get_messages(
+        self,
+        session_id: str,
+        limit: Optional[int] = None,
+        before: Optional[Cursor] = None,
+        after: Optional[Cursor] = None
+    ):
+        # Always returned oldest first. With a limit and no `after` cursor the page
+        # is taken from the newest end, so clients load the latest messages first
+        # and scroll back with `before`; served by ix_messages_session_id_timestamp.
+        key = tuple_(models.Message.timestamp, models.Message.id)
+        query = select(models.Message).filter(models.Message.session_id == session_id)
+        if before:
+            query = query.filter(key < tuple_(*before))
+        if after:
+            query = query.filter(key > tuple_(*after))
 
-    def get_messages(self, session_id: str):
-        return self.db.query(models.Message)\
-            .filter(models.Message.session_id == session_id)\
-            .order_by(models.Message.timestamp.asc())\
-            .all()
+        newest_first = limit is not None and not after
+        if newest_first:
+            query = query.order_by(models.Message.timestamp.desc(), models.Message.id.desc())
+        else:
+            query = query.order_by(models.Message.timestamp.asc(), models.Message.id.asc())
+        if limit:
+            query = query.limit(limit)
 
-    def add_message(self, session_id: str, role: str, content: str, model: str = None, image_url: str = None):
+        result = await self.db.execute(query)
+        messages = result.scalars().all()
+        return messages[::-1] if newest_first else messages
+
+    async def stream_messages(self, session_id: str, batch_size: int = 500):
+        # Oldest first, read through a server-side cursor batch_size rows at a time,
+        # so a long session is never materialised in full. Only the exported
+        # columns are selected, as plain rows rather than ORM objects.
+        query = (
+            select(
+                models.Message.role,
+                models.Message.content,
+                models.Message.timestamp,
+                models.Message.model,
+                models.Message.image_url
+            )
+            .filter(models.Message.session_id == session_id)
+            .order_by(models.Message.timestamp.asc(), models.Message.id.asc())
+            .execution_options(yield_per=batch_size)
+        )
+        result = await self.db.stream(query)
+        try:
+            async for rows in result.partitions():
+                for row in rows:
+                    yield row
+        finally:
+            await result.close()
+
+    async def list_sessions(self, user_id: str):
+        result = await self.db.execute(
+            select(models.ChatSession)
+            .filter(models.ChatSession.user_id == user_id)
+            .order_by(models.ChatSession.created_at.asc(), models.ChatSession.id.asc())
+        )
+        return result.scalars().all()
+
+    async def add_message(
+        self,
+        session_id: str,
+        role: str,
+        content: str,
+        model: str = None,
+        image_url: str = None,
+        session: models.ChatSession = None
+    ):
         msg_id = str(uuid.uuid4())
         msg = models.Message(
             id=msg_id,
@@ -57,18 +174,57 @@ class ChatRepository:
             image_url=image_url
         )
         self.db.add(msg)
-        self.db.commit()
-        self.db.refresh(msg)
+        if session is not None:
+            # Touch the session in the same commit so its updated_at moves with every write.
+            session.updated_at = datetime.utcnow()
+        await self.db.commit()
+        await self.db.refresh(msg)
         return msg
 
-    def update_session_timestamp(self, session: models.ChatSession):
+    async def save_messages(self, messages: List[models.Message], titles: Optional[Dict[str, str]] = None):
+        # Writes a batch of already-built messages in one transaction: one multi-row
+        # INSERT, then every touched session's updated_at moved forward to its newest
+        # message (never back, since batches can land out of order) and any
+        # first-turn titles. Messages must carry their id and timestamp.
+        if not messages:
+            return
+
+        message_table = models.Message.__table__
+        session_table = models.ChatSession.__table__
+        latest: Dict[str, datetime] = {}
+        rows = []
+        for m in messages:
+            rows.append({c.name: getattr(m, c.key) for c in message_table.columns})
+            if m.session_id not in latest or m.timestamp > latest[m.session_id]:
+                latest[m.session_id] = m.timestamp
+
+        await self.db.execute(insert(message_table), rows)
+        await self.db.execute(
+            update(session_table)
+            .where(
+                session_table.c.id == bindparam("b_id"),
+                or_(session_table.c.updated_at.is_(None), session_table.c.updated_at < bindparam("b_ts"))
+            )
+            .values(updated_at=bindparam("b_ts")),
+            [{"b_id": session_id, "b_ts": ts} for session_id, ts in latest.items()]
+        )
+        if titles:
+            await self.db.execute(
+                update(session_table)
+                .where(session_table.c.id == bindparam("b_id"))
+                .values(title=bindparam("b_title"), updated_at=session_table.c.updated_at),
+                [{"b_id": session_id, "b_title": title} for session_id, title in titles.items()]
+            )
+        await self.db.commit()
+
+    async def update_session_timestamp(self, session: models.ChatSession):
         session.updated_at = datetime.utcnow()
-        self.db.commit()
+        await self.db.commit()
 
     def update_session_title(self, session_id: str, title: str):
         pass
     
-    def update_session(self, session: models.ChatSession):
+    async def update_session(self, session: models.ChatSession):
         self.db.add(session)
-        self.db.commit()
-        self.db.refresh(session)
+        await self.db.commit()
+        await self.db.refresh(session)
@@ -1,12 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
-from typing import List
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Literal, Optional
 from ..core.auth import get_current_user
 from ..core.database import get_db
+from ..core.streaming import DisconnectAwareStreamingResponse
 from .. import schemas
 from ..services.chat_service import ChatService
-import json
+from ..services.stream_coalescer import StreamCoalescer
+from ..services.image_store import image_store, sniff_type
+from ..services import exporter
+from ..repositories.chat_repository import PREVIEW_LENGTH
+
+# Paginated list endpoints put the cursor for the next page (continuing in the
+# direction that was requested: `before` by default, `after` when given) here.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
 
 router = APIRouter(
     prefix="/api", 
@@ -15,38 +23,43 @@ router = APIRouter(
 )
 
 @router.get("/rate-limit")
-async def get_rate_limit(db: Session = Depends(get_db)):
+async def get_rate_limit(db: AsyncSession = Depends(get_db)):
     service = ChatService(db)
-    return service.get_rate_limit()
+    return await service.get_rate_limit()
 
 @router.get("/models", response_model=List[schemas.AIModelDTO])
-async def list_models(db: Session = Depends(get_db)):
+async def list_models(request: Request, db: AsyncSession = Depends(get_db)):
     service = ChatService(db)
-    raw_models = await service.list_models()
-    return [
-        schemas.AIModelDTO(
-            id=m["id"],
-            name=m["name"],
-            provider=m["provider"],
-            isFree=m["is_free"],
-            contextWindow=m["context_length"]
-        ) for m in raw_models
-    ]
+    catalog = await service.list_models()
+    headers = {"ETag": catalog.etag, "Cache-Control": "no-cache"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if catalog.etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=catalog.body, media_type="application/json", headers=headers)
 
 @router.get("/sessions", response_model=List[schemas.SessionResponse])
-def get_sessions(
+async def get_sessions(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=200),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     service = ChatService(db)
-    sessions = service.get_user_sessions(current_user.get("sub"), current_user.get("email"))
+    sessions, next_cursor = await service.get_user_sessions(
+        current_user.get("sub"), current_user.get("email"), limit, before, after
+    )
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
     
     results = []
-    for s in sessions:
+    for s, last_message in sessions:
         preview = "New Chat"
-        if s.messages:
-             last_msg = s.messages[-1]
-             preview = (last_msg.content[:50] + '...') if len(last_msg.content) > 50 else last_msg.content
+        if last_message is not None:
+             preview = (last_message[:PREVIEW_LENGTH] + '...') if len(last_message) > PREVIEW_LENGTH else last_message
         
         results.append(schemas.SessionResponse(
             id=s.id,
@@ -58,37 +71,76 @@ def get_sessions(
     return results
 
 @router.post("/sessions", response_model=schemas.SessionResponse)
-def create_session(
+async def create_session(
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     service = ChatService(db)
-    new_session = service.create_session(current_user.get("sub"))
+    new_session = await service.create_session(current_user.get("sub"))
     return new_session
 
 @router.get("/sessions/{session_id}/messages", response_model=List[schemas.MessageResponse])
-def get_messages(
+async def get_messages(
     session_id: str,
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=200),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     service = ChatService(db)
     user_id = current_user.get("sub")
-    return service.get_session_messages(session_id, user_id)
+    messages, next_cursor = await service.get_session_messages_page(session_id, user_id, limit, before, after)
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+
+    base_url = str(request.base_url)
+    return [
+        schemas.MessageResponse(
+            id=m.id,
+            role=m.role,
+            content=m.content,
+            image_url=image_store.public_url(m.image_url, base_url),
+            timestamp=m.timestamp,
+            model=m.model,
+            truncated=getattr(m, "truncated", False) or False
+        )
+        for m in messages
+    ]
+
+@router.get("/images/{digest}")
+async def get_image(digest: str, request: Request):
+    # Content-addressed, so a given URL always returns the same bytes: cacheable
+    # forever, and revalidation only ever needs the hash. Not behind auth because
+    # <img> tags cannot send the bearer token; the 256-bit hash is the capability.
+    headers = {"ETag": f'"{digest}"', "Cache-Control": "public, max-age=31536000, immutable"}
+    if f'"{digest}"' in (tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")):
+        return Response(status_code=304, headers=headers)
+
+    data = await image_store.get(digest)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return Response(content=data, media_type=sniff_type(data) or "application/octet-stream", headers=headers)
 
 @router.post("/sessions/{session_id}/chat/stream")
 async def stream_chat_message(
     session_id: str,
     request: schemas.ChatRequest,
+    coalesce_ms: Optional[float] = Query(None, ge=0, le=1000, description="Merge tokens arriving within this window into one frame; 0 sends every token as it arrives"),
+    coalesce_bytes: Optional[int] = Query(None, ge=0, le=65536, description="Flush a merged frame early once it holds this many bytes; 0 means no limit"),
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     service = ChatService(db)
     user_id = current_user.get("sub")
     
-    generate_func = await service.stream_chat_message(session_id, user_id, request)
+    generate_func = await service.stream_chat_message(
+        session_id, user_id, request, StreamCoalescer(coalesce_ms, coalesce_bytes)
+    )
     
-    return StreamingResponse(
+    return DisconnectAwareStreamingResponse(
         generate_func(),
         media_type="text/event-stream",
         headers={
@@ -99,70 +151,47 @@ async def stream_chat_message(
     )
 
 @router.delete("/sessions/{session_id}")
-def delete_session(
+async def delete_session(
     session_id: str,
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     service = ChatService(db)
     user_id = current_user.get("sub")
-    service.delete_session(session_id, user_id)
+    await service.delete_session(session_id, user_id)
     return {"message": "Session deleted successfully"}
 
 @router.get("/sessions/{session_id}/export")
-def export_session(
+async def export_session(
     session_id: str,
-    format: str = "json",
+    request: Request,
+    format: Literal["txt", "json", "ndjson"] = "json",
+    gzip: bool = Query(False, description="Compress the export on the fly (adds .gz to the file name)"),
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     service = ChatService(db)
-    user_id = current_user.get("sub")
-    messages = service.get_session_messages(session_id, user_id)
-    session = service.repository.get_session(session_id, user_id)
-    
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-
-    if format == "txt":
-        lines = [f"Chat Export: {session.title}", f"Date: {session.created_at}", "=" * 50, ""]
-        for msg in messages:
-            role = "You" if msg.role == "user" else "AI"
-            timestamp = msg.timestamp.strftime("%Y-%m-%d %H:%M:%S") if msg.timestamp else ""
-            lines.append(f"[{timestamp}] {role}:")
-            lines.append(msg.content)
-            lines.append("")
-        
-        content = "\n".join(lines)
-        return StreamingResponse(
-            iter([content]),
-            media_type="text/plain",
-            headers={
-                "Content-Disposition": f"attachment; filename=chat-{session_id[:8]}.txt"
-            }
-        )
-    else:
-        export_data = {
-            "session_id": session_id,
-            "title": session.title,
-            "created_at": session.created_at.isoformat() if session.created_at else None,
-            "updated_at": session.updated_at.isoformat() if session.updated_at else None,
-            "messages": [
-                {
-                    "role": msg.role,
-                    "content": msg.content,
-                    "timestamp": msg.timestamp.isoformat() if msg.timestamp else None,
-                    "model": msg.model,
-                    "image_url": msg.image_url
-                }
-                for msg in messages
-            ]
+    session = await service.get_session_for_export(session_id, current_user.get("sub"))
+    return StreamingResponse(
+        exporter.export_session(session, format, str(request.base_url), compress=gzip),
+        media_type="application/gzip" if gzip else exporter.EXPORT_FORMATS[format],
+        headers={
+            "Content-Disposition": f"attachment; filename={exporter.export_filename(session, format, gzip)}"
         }
-        
-        return StreamingResponse(
-            iter([json.dumps(export_data, indent=2, ensure_ascii=False)]),
-            media_type="application/json",
-            headers={
-                "Content-Disposition": f"attachment; filename=chat-{session_id[:8]}.json"
-            }
-        )
+    )
+
+@router.get("/sessions/export")
+async def export_all_sessions(
+    request: Request,
+    format: Literal["txt", "json", "ndjson"] = "json",
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    # Every session of the user as a zip with one file per session, streamed.
+    service = ChatService(db)
+    sessions = await service.get_sessions_for_export(current_user.get("sub"))
+    return StreamingResponse(
+        exporter.export_archive(sessions, format, str(request.base_url)),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=chats.zip"}
+    )
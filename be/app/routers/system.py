@@ -0,0 +1,72 @@
+from fastapi import APIRouter, Depends
+from ..core.auth import get_token_cache_stats, require_system_access
+from ..core.database import get_pool_stats
+from ..services.conversation_cache import get_conversation_cache_stats
+from ..services.model_catalog import get_model_catalog_stats
+from ..services.message_writer import message_writer
+from ..services.stream_stats import get_stream_stats
+from ..services.rate_limiter import get_scheduler_stats
+from ..services.model_router import get_model_stats
+from ..services.circuit_breaker import get_circuit_breaker_stats
+from ..services.response_cache import get_response_cache_stats
+from ..services.image_store import get_image_store_stats
+from ..services.llm_metrics import get_llm_metrics
+from ..services.shared_state import get_shared_state_stats
+
+router = APIRouter(
+    prefix="/api/system",
+    tags=["system"],
+    dependencies=[Depends(require_system_access)],
+)
+
+@router.get("/token-cache")
+async def token_cache_stats():
+    return get_token_cache_stats()
+
+@router.get("/db-pool")
+async def db_pool_stats():
+    return get_pool_stats()
+
+@router.get("/conversation-cache")
+async def conversation_cache_stats():
+    return get_conversation_cache_stats()
+
+@router.get("/model-catalog")
+async def model_catalog_stats():
+    return get_model_catalog_stats()
+
+@router.get("/message-writer")
+async def message_writer_stats():
+    return message_writer.stats()
+
+@router.get("/streams")
+async def stream_stats():
+    return get_stream_stats()
+
+@router.get("/rate-limiter")
+async def rate_limiter_stats():
+    return get_scheduler_stats()
+
+@router.get("/models")
+async def model_stats():
+    return get_model_stats()
+
+@router.get("/circuit-breakers")
+async def circuit_breaker_stats():
+    return get_circuit_breaker_stats()
+
+@router.get("/response-cache")
+async def response_cache_stats():
+    return get_response_cache_stats()
+
+@router.get("/image-store")
+async def image_store_stats():
+    return get_image_store_stats()
+
+@router.get("/llm-metrics")
+async def llm_metrics():
+    return get_llm_metrics()
+
+@router.get("/shared-state")
+async def shared_state_stats():
+    return get_shared_state_stats()
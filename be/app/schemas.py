@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional
 from datetime import datetime
 
 class MessageBase(BaseModel):
@@ -14,6 +14,7 @@ class MessageResponse(MessageBase):
     id: str
     timestamp: datetime
     model: Optional[str] = None
+    truncated: bool = False
 
     class Config:
         orm_mode = True
@@ -37,6 +38,8 @@ class ChatRequest(BaseModel):
     message: str
     model: str
     image: Optional[str] = None
+    # Overrides MODEL_ROUTING for this request (see services/model_router.py).
+    routing: Optional[Literal["off", "failover", "hedge"]] = None
 
 class AIModelDTO(BaseModel):
     id: str
@@ -1,144 +1,304 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import HTTPException
-from ..repositories.chat_repository import ChatRepository
-from ..services import openrouter
+from ..repositories.chat_repository import ChatRepository, encode_cursor, decode_cursor
+from ..services import openrouter, prompt_builder, model_router
+from ..services.conversation_cache import conversation_cache
+from ..services.model_catalog import model_catalog
+from ..services.stream_stats import stream_stats
+from ..services.stream_coalescer import StreamCoalescer
+from ..services.message_writer import message_writer, WriterBusy, WRITE_BEHIND_ENABLED
+from ..services.image_store import image_store, InvalidImage
+from ..services.llm_metrics import llm_metrics, StreamTimer
 from .. import schemas, models
-import json
+from datetime import datetime
+from typing import Optional
+import time
+import uuid
+
+def _parse_cursor(cursor: Optional[str]):
+    if not cursor:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+
+def _paginate(items, limit: Optional[int], extra_at_start: bool, cursor_of):
+    # The repository is asked for limit + 1 rows; the extra one only tells us
+    # whether another page exists and is dropped from the response.
+    if not limit or len(items) <= limit:
+        return list(items), None
+    if extra_at_start:
+        page = list(items[1:])
+        return page, cursor_of(page[0])
+    page = list(items[:limit])
+    return page, cursor_of(page[-1])
+
+def _new_message(
+    session_id: str,
+    role: str,
+    content: str,
+    model: str = None,
+    image_url: str = None,
+    truncated: bool = False
+) -> models.Message:
+    # id and timestamp are assigned here rather than by the database so the message
+    # can go into the conversation cache (and the write-behind queue) before it is written.
+    return models.Message(
+        id=str(uuid.uuid4()),
+        session_id=session_id,
+        role=role,
+        content=content,
+        model=model,
+        image_url=image_url,
+        timestamp=datetime.utcnow(),
+        truncated=truncated
+    )
+
+# The cached history already contains queued messages; when one cannot be written,
+# drop the entry so the next turn reloads what was actually stored.
+message_writer.on_failure(lambda message: conversation_cache.invalidate(message.session_id))
 
 class ChatService:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.repository = ChatRepository(db)
 
-    def get_rate_limit(self):
-        return openrouter.get_rate_limit_info()
+    async def get_rate_limit(self):
+        return await openrouter.get_rate_limit_info()
 
     async def list_models(self):
-        return await openrouter.get_models()
+        return await model_catalog.get()
 
-    def get_user_sessions(self, user_id: str, email: str = None):
-        user = self.repository.get_user(user_id)
+    async def get_user_sessions(
+        self,
+        user_id: str,
+        email: str = None,
+        limit: Optional[int] = None,
+        before: Optional[str] = None,
+        after: Optional[str] = None
+    ):
+        before_key, after_key = _parse_cursor(before), _parse_cursor(after)
+        user = await self.repository.get_user(user_id)
         if not user:
-            self.repository.create_user(user_id, email)
+            await self.repository.create_user(user_id, email)
         
-        return self.repository.get_user_sessions(user_id)
+        rows = await self.repository.get_user_sessions(
+            user_id, limit + 1 if limit else None, before_key, after_key
+        )
+        return _paginate(
+            rows, limit,
+            extra_at_start=bool(after_key),
+            cursor_of=lambda row: encode_cursor(row[0].updated_at, row[0].id)
+        )
+
+    async def create_session(self, user_id: str):
+        if not await self.repository.get_user(user_id):
+            await self.repository.create_user(user_id)
+        return await self.repository.create_session(user_id)
+
+    async def get_session_messages(self, session_id: str, user_id: str):
+        session = await self.repository.get_session(session_id, user_id)
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
+        await self._flush_pending(session_id)
+        return await self.repository.get_messages(session_id)
+
+    async def get_session_messages_page(
+        self,
+        session_id: str,
+        user_id: str,
+        limit: Optional[int] = None,
+        before: Optional[str] = None,
+        after: Optional[str] = None
+    ):
+        before_key, after_key = _parse_cursor(before), _parse_cursor(after)
+        session = await self.repository.get_session(session_id, user_id)
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
 
-    def create_session(self, user_id: str):
-        if not self.repository.get_user(user_id):
-            self.repository.create_user(user_id)
-        return self.repository.create_session(user_id)
+        await self._flush_pending(session_id)
+        messages = await self.repository.get_messages(
+            session_id, limit + 1 if limit else None, before_key, after_key
+        )
+        return _paginate(
+            messages, limit,
+            extra_at_start=not after_key,
+            cursor_of=lambda m: encode_cursor(m.timestamp, m.id)
+        )
 
-    def get_session_messages(self, session_id: str, user_id: str):
-        session = self.repository.get_session(session_id, user_id)
+    async def get_session_for_export(self, session_id: str, user_id: str):
+        session = await self.repository.get_session(session_id, user_id)
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
-        return self.repository.get_messages(session_id)
+        await self._flush_pending(session_id)
+        return session
 
-    def delete_session(self, session_id: str, user_id: str):
-        session = self.repository.get_session(session_id, user_id)
+    async def get_sessions_for_export(self, user_id: str):
+        # Sessions are committed before any of their messages are queued, so every
+        # pending record of this user belongs to one of these. Queued writes can set
+        # titles, so the list is read again after waiting for them.
+        sessions = await self.repository.list_sessions(user_id)
+        if await message_writer.wait_pending([s.id for s in sessions]):
+            sessions = await self.repository.list_sessions(user_id)
+        return sessions
+
+    async def delete_session(self, session_id: str, user_id: str):
+        session = await self.repository.get_session(session_id, user_id)
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
-        self.repository.delete_session(session)
+        await self._flush_pending(session_id)
+        await self.repository.delete_session(session)
+        conversation_cache.invalidate(session_id)
 
     async def send_message(self, session_id: str, user_id: str, request: schemas.ChatRequest):
-        session = self.repository.get_session(session_id, user_id)
+        started = time.monotonic()
+        session = await self.repository.get_session(session_id, user_id)
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
 
-        self.repository.add_message(
-            session_id=session_id,
-            role="user",
-            content=request.message,
-            image_url=request.image
-        )
+        past_messages, version = await self._add_user_message(session, request)
+        is_first_turn = len(past_messages) == 1
+        or_messages = await self._prepare_openrouter_messages(past_messages, request)
 
-        past_messages = self.repository.get_messages(session_id)
-        
-        or_messages = []
-        for m in past_messages:
-            if m.image_url and m.role == "user":
-                or_messages.append({
-                    "role": m.role,
-                    "content": [
-                        {"type": "text", "text": m.content},
-                        {"type": "image_url", "image_url": {"url": m.image_url}}
-                    ]
-                })
-            else:
-                or_messages.append({"role": m.role, "content": m.content})
-
-        ai_response = await openrouter.chat_completion(
-            model=request.model,
-            messages=or_messages
+        ai_response, served_model = await model_router.chat_completion(
+            request.model, or_messages, user_id=user_id, mode=request.routing
         )
         
         ai_content = "Error: No response from AI."
         if "choices" in ai_response and len(ai_response["choices"]) > 0:
             ai_content = ai_response["choices"][0]["message"]["content"]
-
-        ai_msg = self.repository.add_message(
-            session_id=session_id,
-            role="assistant",
-            content=ai_content,
-            model=request.model
+        llm_metrics.record_duration(
+            served_model, "chat", time.monotonic() - started, prompt_builder.estimate_tokens(ai_content)
         )
 
-        self.repository.update_session_timestamp(session)
-        if len(past_messages) == 1:
-            session.title = request.message[:30]
-            self.repository.update_session(session)
+        ai_msg = _new_message(session_id, "assistant", ai_content, model=served_model)
+        title = request.message[:30] if is_first_turn else None
+        if WRITE_BEHIND_ENABLED:
+            await self._enqueue(ai_msg, title)
+        else:
+            await self.repository.save_messages([ai_msg], {session_id: title} if title else None)
+        conversation_cache.extend(session_id, version, [ai_msg], ai_msg.timestamp, track=False)
 
         return ai_msg
 
-    def _prepare_openrouter_messages(self, messages, current_request):
-        pass
+    async def _add_user_message(self, session: models.ChatSession, request: schemas.ChatRequest):
+        # Saves (or, in write-behind mode, queues) the user's message and returns the
+        # conversation including it together with the session version it corresponds
+        # to. History is served from the conversation cache when the session has not
+        # changed since it was filled.
+        previous_version = session.updated_at
+        image_url = await self._store_image(request.image)
+        if WRITE_BEHIND_ENABLED:
+            user_msg = _new_message(session.id, "user", request.message, image_url=image_url)
+            await self._enqueue(user_msg)
+            version = user_msg.timestamp
+        else:
+            user_msg = await self.repository.add_message(
+                session_id=session.id,
+                role="user",
+                content=request.message,
+                image_url=image_url,
+                session=session
+            )
+            version = session.updated_at
+
+        history = conversation_cache.extend(session.id, previous_version, [user_msg], version)
+        if history is None:
+            await self._flush_pending(session.id)
+            messages = await self.repository.get_messages(session.id)
+            history = conversation_cache.put(session.id, messages, version)
+        return history, version
 
-    async def stream_chat_message(self, session_id: str, user_id: str, request: schemas.ChatRequest):
-        session = self.repository.get_session(session_id, user_id)
+    async def _store_image(self, image: Optional[str]) -> Optional[str]:
+        # Only a reference to the stored image goes into the message row.
+        try:
+            return await image_store.save_upload(image)
+        except InvalidImage as e:
+            raise HTTPException(status_code=413 if e.too_large else 400, detail=str(e))
+
+    async def _enqueue(self, message: models.Message, title: Optional[str] = None):
+        try:
+            await message_writer.enqueue(message, title)
+        except WriterBusy:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many messages are waiting to be saved, please retry shortly",
+                headers={"Retry-After": "1"}
+            )
+
+    async def _flush_pending(self, session_id: str):
+        # Read-your-writes: anything still queued for this session is written before
+        # it is read back from the database.
+        await message_writer.wait_pending([session_id])
+
+    async def _prepare_openrouter_messages(self, messages, current_request):
+        # Newest messages that fit the model's context window; older turns are dropped.
+        context_length = await model_catalog.get_context_length(current_request.model)
+        return await image_store.resolve_prompt(prompt_builder.build_prompt(messages, context_length))
+
+    async def stream_chat_message(
+        self,
+        session_id: str,
+        user_id: str,
+        request: schemas.ChatRequest,
+        coalescer: Optional[StreamCoalescer] = None
+    ):
+        # Latencies are measured from here, i.e. as the user experiences them.
+        timer = StreamTimer()
+        session = await self.repository.get_session(session_id, user_id)
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
 
-        self.repository.add_message(
-            session_id=session_id,
-            role="user",
-            content=request.message,
-            image_url=request.image
-        )
+        # Check the scheduler before the user message is stored, so a request that
+        # would wait too long is turned away with 429 + Retry-After and leaves
+        # nothing behind. The slot itself is taken by the stream once it runs, so a
+        # response that is never iterated holds none.
+        await openrouter.check_slot(user_id)
+        past_messages, version = await self._add_user_message(session, request)
+        is_first_turn = len(past_messages) == 1
+        or_messages = await self._prepare_openrouter_messages(past_messages, request)
 
-        past_messages = self.repository.get_messages(session_id)
-        or_messages = []
-        for m in past_messages:
-            if m.image_url and m.role == "user":
-                or_messages.append({
-                    "role": m.role,
-                    "content": [
-                        {"type": "text", "text": m.content},
-                        {"type": "image_url", "image_url": {"url": m.image_url}}
-                    ]
-                })
-            else:
-                or_messages.append({"role": m.role, "content": m.content})
-        
         async def generate():
-            full_content = ""
-            async for chunk in openrouter.chat_completion_stream(
-                model=request.model,
-                messages=or_messages
-            ):
-                data = json.loads(chunk)
-                if "content" in data:
-                    full_content += data["content"]
-                yield f"data: {chunk}\n\n"
-            
-            if full_content:
-                self.repository.add_message(
-                    session_id=session_id,
-                    role="assistant",
-                    content=full_content,
-                    model=request.model
-                )
-                self.repository.update_session_timestamp(session)
-                if len(past_messages) == 1:
-                    session.title = request.message[:30]
-                    self.repository.update_session(session)
+            chunks = []
+            finished = False
+            stage = coalescer or StreamCoalescer()
+            route = model_router.RoutedStream(
+                request.model, or_messages, user_id=user_id, mode=request.routing
+            )
+            upstream = stage.stream(route.stream())
+            try:
+                async for delta in upstream:
+                    if delta.content:
+                        timer.token()
+                        chunks.append(delta.content)
+                    yield delta.frame
+                finished = True
+            finally:
+                # Runs on completion and when the response closes the generator
+                # because the client went away: closing the upstream generator exits
+                # its httpx stream, which cancels the request and frees the connection.
+                await upstream.aclose()
+                full_content = "".join(chunks)
+                tokens = prompt_builder.estimate_tokens(full_content)
+                stream_stats.record_frames(stage.deltas, stage.frames)
+                if timer.ttft is not None:
+                    llm_metrics.record_ttft(route.model, "chat_stream", timer.ttft)
+                if finished:
+                    stream_stats.record_completed(tokens)
+                    llm_metrics.record_duration(
+                        route.model, "chat_stream", time.monotonic() - timer.started, tokens, timer.generating
+                    )
+                else:
+                    stream_stats.record_aborted(tokens, route.model)
+                if full_content:
+                    # Hand the write to the background writer so the response closes
+                    # right after the last token instead of after the commit.
+                    ai_msg = _new_message(
+                        session_id, "assistant", full_content,
+                        model=route.model, truncated=not finished
+                    )
+                    title = request.message[:30] if is_first_turn else None
+                    conversation_cache.extend(session_id, version, [ai_msg], ai_msg.timestamp, track=False)
+                    message_writer.submit(ai_msg, title)
         
         return generate
@@ -0,0 +1,332 @@
+from collections import deque
+from opentelemetry import metrics
+from opentelemetry.metrics import Observation
+from typing import Any, Deque, Dict, List, Optional, Tuple
+import math
+import os
+import time
+from .shared_state import shared_state, submit
+
+CIRCUIT_WINDOW_SECONDS = float(os.getenv("CIRCUIT_WINDOW_SECONDS", "60"))
+CIRCUIT_MIN_REQUESTS = int(os.getenv("CIRCUIT_MIN_REQUESTS", "5"))
+CIRCUIT_ERROR_THRESHOLD = float(os.getenv("CIRCUIT_ERROR_THRESHOLD", "0.5"))
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "20"))
+CIRCUIT_SLOW_THRESHOLD = float(os.getenv("CIRCUIT_SLOW_THRESHOLD", "0.8"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+CIRCUIT_MAX_OPEN_SECONDS = float(os.getenv("CIRCUIT_MAX_OPEN_SECONDS", "300"))
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "1"))
+CIRCUIT_RETRY_RATIO = float(os.getenv("CIRCUIT_RETRY_RATIO", "0.2"))
+CIRCUIT_RETRY_BUDGET = float(os.getenv("CIRCUIT_RETRY_BUDGET", "10"))
+# How often a worker picks up circuits other workers opened (see CircuitBreakers).
+CIRCUIT_SYNC_INTERVAL = float(os.getenv("CIRCUIT_SYNC_INTERVAL", "1"))
+
+# Open circuits of all workers in shared_state: breaker key -> [open until, open for],
+# "open until" on the shared_state clock.
+CIRCUITS_KEY = "openrouter:circuits"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+meter = metrics.get_meter("madlen.openrouter")
+_rejected_counter = meter.create_counter(
+    "openrouter.circuit.rejected",
+    description="OpenRouter requests failed fast because a circuit was open"
+)
+_transition_counter = meter.create_counter(
+    "openrouter.circuit.transitions",
+    description="Circuit breaker state changes"
+)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, key: str, retry_after: float):
+        super().__init__(f"circuit '{key}' is open, retry in {retry_after:.0f}s")
+        self.key = key
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+# One breaker per model id and per OpenRouter endpoint. Closed, it keeps the
+# outcomes of the last CIRCUIT_WINDOW_SECONDS and trips once at least
+# CIRCUIT_MIN_REQUESTS were seen and either the error rate reaches
+# CIRCUIT_ERROR_THRESHOLD or the share of calls slower than
+# CIRCUIT_SLOW_CALL_SECONDS reaches CIRCUIT_SLOW_THRESHOLD. Open, every call
+# fails fast. After the open period it lets CIRCUIT_HALF_OPEN_PROBES calls
+# through: a success closes it, a failure reopens it for twice as long (up to
+# CIRCUIT_MAX_OPEN_SECONDS).
+class CircuitBreaker:
+    def __init__(self, key: str):
+        self.key = key
+        self.state = CLOSED
+        self._outcomes: Deque[Tuple[float, bool, bool]] = deque()
+        self._opened_at = 0.0
+        self._open_for = CIRCUIT_OPEN_SECONDS
+        self._probes = 0
+        self.rejected = 0
+        self.trips = 0
+
+    def _trim(self, now: float):
+        while self._outcomes and self._outcomes[0][0] < now - CIRCUIT_WINDOW_SECONDS:
+            self._outcomes.popleft()
+
+    def _transition(self, state: str):
+        if state != self.state:
+            self.state = state
+            _transition_counter.add(1, {"circuit": self.key, "state": state})
+
+    def retry_after(self, now: Optional[float] = None) -> float:
+        now = time.monotonic() if now is None else now
+        return max(0.0, self._opened_at + self._open_for - now)
+
+    def check(self, now: float) -> Optional[float]:
+        # None if a call may go out now, otherwise seconds until it may.
+        if self.state == OPEN:
+            if now < self._opened_at + self._open_for:
+                return self.retry_after(now)
+            self._transition(HALF_OPEN)
+            self._probes = 0
+        if self.state == HALF_OPEN and self._probes >= CIRCUIT_HALF_OPEN_PROBES:
+            # Probes are in flight; everyone else keeps failing fast until they report.
+            return 1.0
+        return None
+
+    def effective_state(self, now: float) -> str:
+        if self.state == OPEN and now >= self._opened_at + self._open_for:
+            return HALF_OPEN
+        return self.state
+
+    def start(self):
+        if self.state == HALF_OPEN:
+            self._probes += 1
+
+    def release(self):
+        # A call that ended without an outcome (e.g. the client went away).
+        if self.state == HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def record(self, ok: bool, latency: float = 0.0):
+        now = time.monotonic()
+        if self.state == HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+            if ok and latency < CIRCUIT_SLOW_CALL_SECONDS:
+                self._outcomes.clear()
+                self._open_for = CIRCUIT_OPEN_SECONDS
+                self._transition(CLOSED)
+                _publish(self.key, None)
+            else:
+                self._open(now, min(self._open_for * 2, CIRCUIT_MAX_OPEN_SECONDS))
+            return
+        if self.state == OPEN:
+            return
+
+        self._outcomes.append((now, ok, latency >= CIRCUIT_SLOW_CALL_SECONDS))
+        self._trim(now)
+        total = len(self._outcomes)
+        if total < CIRCUIT_MIN_REQUESTS:
+            return
+        errors = sum(1 for _, success, _ in self._outcomes if not success)
+        slow = sum(1 for _, _, is_slow in self._outcomes if is_slow)
+        if errors / total >= CIRCUIT_ERROR_THRESHOLD or slow / total >= CIRCUIT_SLOW_THRESHOLD:
+            self._open(now, CIRCUIT_OPEN_SECONDS)
+
+    def _open(self, now: float, open_for: float):
+        self._opened_at = now
+        self._open_for = open_for
+        self._outcomes.clear()
+        self.trips += 1
+        self._transition(OPEN)
+        _publish(self.key, open_for)
+        print(f"Circuit '{self.key}' opened for {open_for:.0f}s")
+
+    def adopt(self, remaining: float, open_for: float):
+        # Another worker opened this circuit; stay open until it reopens. Not a trip
+        # of this worker's, so nothing is published back.
+        now = time.monotonic()
+        if self.state == OPEN and self._opened_at + self._open_for >= now + remaining - 0.5:
+            return
+        self._opened_at = now + remaining - open_for
+        self._open_for = open_for
+        self._outcomes.clear()
+        self._transition(OPEN)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        self._trim(now)
+        total = len(self._outcomes)
+        errors = sum(1 for _, success, _ in self._outcomes if not success)
+        slow = sum(1 for _, _, is_slow in self._outcomes if is_slow)
+        return {
+            "state": self.state,
+            "window_requests": total,
+            "error_rate": round(errors / total, 3) if total else None,
+            "slow_rate": round(slow / total, 3) if total else None,
+            "retry_after": round(self.retry_after(now), 1) if self.state == OPEN else None,
+            "trips": self.trips,
+            "rejected": self.rejected
+        }
+
+
+def _publish(key: str, open_for: Optional[float]):
+    # Records that a circuit opened (or, with None, closed again) for the other workers.
+    def update(current):
+        now = shared_state.now()
+        circuits = {k: v for k, v in (current or {}).items() if v[0] > now and k != key}
+        if open_for is not None:
+            circuits[key] = [now + open_for, open_for]
+        return circuits or None, None
+    submit(shared_state, shared_state.update, CIRCUITS_KEY, update)
+
+
+class Guard:
+    # The breakers one OpenRouter call goes through; report the outcome exactly once.
+    __slots__ = ("breakers", "started", "done")
+
+    def __init__(self, breakers: List[CircuitBreaker]):
+        self.breakers = breakers
+        self.started = time.monotonic()
+        self.done = False
+
+    def success(self):
+        self._record(True)
+
+    def failure(self, endpoint: bool = True):
+        # endpoint=False: the model failed but OpenRouter itself answered fine
+        # (e.g. a model-level 429), so only the model's breaker counts it.
+        self._record(False, endpoint)
+
+    def _record(self, ok: bool, endpoint: bool = True):
+        if self.done:
+            return
+        self.done = True
+        latency = time.monotonic() - self.started
+        for breaker in self.breakers:
+            if breaker.key.startswith("model:"):
+                breaker.record(ok, latency)
+            else:
+                breaker.record(ok or not endpoint, latency)
+
+    def release(self):
+        if not self.done:
+            self.done = True
+            for breaker in self.breakers:
+                breaker.release()
+
+
+class RetryBudget:
+    # Retries may add at most CIRCUIT_RETRY_RATIO extra requests on top of first
+    # attempts (with a small reserve), so a degraded upstream does not get every
+    # request multiplied by the retry count.
+    def __init__(self, ratio: float = CIRCUIT_RETRY_RATIO, reserve: float = CIRCUIT_RETRY_BUDGET):
+        self.ratio = ratio
+        self.reserve = reserve
+        self._balance = reserve
+        self.denied = 0
+
+    def deposit(self):
+        self._balance = min(self.reserve, self._balance + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self._balance >= 1:
+            self._balance -= 1
+            return True
+        self.denied += 1
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"balance": round(self._balance, 2), "denied": self.denied}
+
+
+# Breakers are per worker, but trips are shared: a circuit one worker opens is
+# adopted by the others within CIRCUIT_SYNC_INTERVAL, so they stop sending
+# requests to a failing model or endpoint too instead of each finding out on
+# their own. Half-open probing stays per worker.
+class CircuitBreakers:
+    def __init__(self, sync_interval: float = CIRCUIT_SYNC_INTERVAL):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self.retry_budget = RetryBudget()
+        self.sync_interval = sync_interval
+        self._synced_at = float("-inf")
+
+    def _sync(self):
+        now = time.monotonic()
+        if now - self._synced_at < self.sync_interval:
+            return
+        self._synced_at = now
+        submit(shared_state, shared_state.get, CIRCUITS_KEY, then=self._adopt_all)
+
+    def _adopt_all(self, circuits: Optional[Dict[str, List[float]]]):
+        if not circuits:
+            return
+        shared_now = shared_state.now()
+        for key, (until, open_for) in circuits.items():
+            if until > shared_now:
+                self.get(key).adopt(until - shared_now, open_for)
+
+    def get(self, key: str) -> CircuitBreaker:
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = self._breakers[key] = CircuitBreaker(key)
+        return breaker
+
+    def is_open(self, model: str) -> bool:
+        self._sync()
+        breaker = self._breakers.get(f"model:{model}")
+        return breaker is not None and breaker.check(time.monotonic()) is not None
+
+    def guard(self, endpoint: str, model: Optional[str] = None) -> Guard:
+        # Raises CircuitOpenError instead of letting the call out when the endpoint
+        # or the model circuit is open.
+        self._sync()
+        breakers = [self.get(f"endpoint:{endpoint}")]
+        if model:
+            breakers.append(self.get(f"model:{model}"))
+        now = time.monotonic()
+        for breaker in breakers:
+            wait = breaker.check(now)
+            if wait is not None:
+                breaker.rejected += 1
+                _rejected_counter.add(1, {"circuit": breaker.key})
+                raise CircuitOpenError(breaker.key, wait)
+        for breaker in breakers:
+            breaker.start()
+        return Guard(breakers)
+
+    def states(self) -> Dict[str, int]:
+        # Read-only: called from the metrics reader thread, so it neither syncs
+        # nor moves breakers on. An open circuit whose period is over is reported
+        # as half-open, which is what the next call will find.
+        now = time.monotonic()
+        return {key: STATE_VALUES[b.effective_state(now)] for key, b in list(self._breakers.items())}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "retry_budget": self.retry_budget.stats(),
+            "circuits": {key: b.stats() for key, b in self._breakers.items()}
+        }
+
+
+circuit_breakers = CircuitBreakers()
+
+
+def get_circuit_breaker_stats() -> Dict[str, Any]:
+    return circuit_breakers.stats()
+
+
+def get_circuit_states() -> Dict[str, int]:
+    return circuit_breakers.states()
+
+
+def _observe_states(options):
+    return [Observation(state, {"circuit": key}) for key, state in get_circuit_states().items()]
+
+
+meter.create_observable_gauge(
+    "openrouter.circuit.state",
+    callbacks=[_observe_states],
+    description="Circuit breaker state per model/endpoint: 0 closed, 1 half-open, 2 open"
+)
@@ -0,0 +1,137 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+import os
+import time
+
+CONVERSATION_CACHE_MAX_SESSIONS = int(os.getenv("CONVERSATION_CACHE_MAX_SESSIONS", "1000"))
+CONVERSATION_CACHE_TTL = float(os.getenv("CONVERSATION_CACHE_TTL", "900"))
+
+
+class CachedMessage:
+    # Detached snapshot of a models.Message with just what prompt building needs.
+    __slots__ = ("id", "role", "content", "image_url", "model", "timestamp")
+
+    def __init__(self, id, role, content, image_url=None, model=None, timestamp=None):
+        self.id = id
+        self.role = role
+        self.content = content
+        self.image_url = image_url
+        self.model = model
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_model(cls, message) -> "CachedMessage":
+        return cls(
+            id=message.id,
+            role=message.role,
+            content=message.content,
+            image_url=message.image_url,
+            model=message.model,
+            timestamp=message.timestamp
+        )
+
+
+def _not_newer(version: Optional[datetime], than: Optional[datetime]) -> bool:
+    if version is None or than is None:
+        return version == than
+    return version <= than
+
+
+class _Entry:
+    __slots__ = ("messages", "version", "expires_at")
+
+    def __init__(self, messages: List[CachedMessage], version: Optional[datetime], expires_at: float):
+        self.messages = messages
+        self.version = version
+        self.expires_at = expires_at
+
+
+# Per-session history, appended to as a turn writes messages instead of being
+# reloaded from Postgres every turn. Every entry carries the session's updated_at
+# as a version; a turn only reuses the entry when the session row is not newer
+# than that, so writes made by another worker (or anything else) force a reload.
+# An older row is fine: it means this process's own queued writes have not
+# landed yet (the writer only ever moves updated_at forward).
+class ConversationCache:
+    def __init__(self, max_sessions: int = CONVERSATION_CACHE_MAX_SESSIONS, ttl: float = CONVERSATION_CACHE_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _live_entry(self, session_id: str, version: Optional[datetime]) -> Optional[_Entry]:
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        if time.monotonic() >= entry.expires_at or not _not_newer(version, entry.version):
+            del self._entries[session_id]
+            self.invalidations += 1
+            return None
+        return entry
+
+    def put(self, session_id: str, messages: Iterable, version: Optional[datetime]) -> List[CachedMessage]:
+        snapshot = [m if isinstance(m, CachedMessage) else CachedMessage.from_model(m) for m in messages]
+        if self.max_sessions <= 0:
+            return snapshot
+
+        self._entries[session_id] = _Entry(snapshot, version, time.monotonic() + self.ttl)
+        self._entries.move_to_end(session_id)
+        while len(self._entries) > self.max_sessions:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return list(snapshot)
+
+    def extend(
+        self,
+        session_id: str,
+        expected_version: Optional[datetime],
+        new_messages: Iterable,
+        new_version: Optional[datetime],
+        track: bool = True
+    ) -> Optional[List[CachedMessage]]:
+        # Appends messages just written (or queued) by this turn. Returns the full
+        # history, or None when there is no usable entry and the caller has to reload.
+        # track=False is for bookkeeping appends that should not count as lookups.
+        entry = self._live_entry(session_id, expected_version)
+        if entry is None:
+            if track:
+                self.misses += 1
+            return None
+
+        if track:
+            self.hits += 1
+        entry.messages.extend(CachedMessage.from_model(m) for m in new_messages)
+        entry.version = new_version if _not_newer(entry.version, new_version) else entry.version
+        entry.expires_at = time.monotonic() + self.ttl
+        self._entries.move_to_end(session_id)
+        return list(entry.messages)
+
+    def invalidate(self, session_id: str):
+        if self._entries.pop(session_id, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "sessions": len(self._entries),
+            "max_sessions": self.max_sessions,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None
+        }
+
+
+conversation_cache = ConversationCache()
+
+
+def get_conversation_cache_stats() -> Dict[str, Any]:
+    return conversation_cache.stats()
@@ -0,0 +1,162 @@
+from typing import Any, AsyncIterator, Dict, Iterable, Optional
+import json
+import os
+import zipfile
+import zlib
+from ..core.database import SessionLocal
+from ..repositories.chat_repository import ChatRepository
+from .image_store import image_store
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", "65536"))
+EXPORT_GZIP_LEVEL = int(os.getenv("EXPORT_GZIP_LEVEL", "6"))
+
+EXPORT_FORMATS = {
+    "txt": "text/plain; charset=utf-8",
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def _isoformat(value) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def _session_fields(session) -> Dict[str, Any]:
+    return {
+        "session_id": session.id,
+        "title": session.title,
+        "created_at": _isoformat(session.created_at),
+        "updated_at": _isoformat(session.updated_at)
+    }
+
+
+def _message_fields(row, base_url: str) -> Dict[str, Any]:
+    return {
+        "role": row.role,
+        "content": row.content,
+        "timestamp": _isoformat(row.timestamp),
+        "model": row.model,
+        "image_url": image_store.public_url(row.image_url, base_url)
+    }
+
+
+async def _txt(session, rows: AsyncIterator, base_url: str) -> AsyncIterator[str]:
+    yield f"Chat Export: {session.title}\nDate: {session.created_at}\n{'=' * 50}\n"
+    separator = "\n"
+    async for row in rows:
+        role = "You" if row.role == "user" else "AI"
+        timestamp = row.timestamp.strftime("%Y-%m-%d %H:%M:%S") if row.timestamp else ""
+        yield f"{separator}[{timestamp}] {role}:\n{row.content}\n"
+
+
+async def _json(session, rows: AsyncIterator, base_url: str) -> AsyncIterator[str]:
+    # Same document json.dumps(..., indent=2) would produce, written one message
+    # at a time: the session fields, then the messages array element by element.
+    head = json.dumps(_session_fields(session), indent=2, ensure_ascii=False)
+    yield head[:-2] + ',\n  "messages": ['
+    separator = "\n    "
+    async for row in rows:
+        body = json.dumps(_message_fields(row, base_url), indent=2, ensure_ascii=False)
+        yield separator + body.replace("\n", "\n    ")
+        separator = ",\n    "
+    yield "]\n}" if separator == "\n    " else "\n  ]\n}"
+
+
+async def _ndjson(session, rows: AsyncIterator, base_url: str) -> AsyncIterator[str]:
+    # One JSON object per line: the session first, then its messages in order.
+    yield json.dumps({"type": "session", **_session_fields(session)}, ensure_ascii=False) + "\n"
+    async for row in rows:
+        yield json.dumps({"type": "message", **_message_fields(row, base_url)}, ensure_ascii=False) + "\n"
+
+
+_ENCODERS = {"txt": _txt, "json": _json, "ndjson": _ndjson}
+
+
+async def _buffered(pieces: AsyncIterator[str], size: int = EXPORT_CHUNK_BYTES) -> AsyncIterator[bytes]:
+    # Per-message pieces are small; sending each as its own chunk would mean one
+    # write (and one gzip/zip call) per message.
+    buffer = []
+    buffered = 0
+    async for piece in pieces:
+        data = piece.encode("utf-8")
+        buffer.append(data)
+        buffered += len(data)
+        if buffered >= size:
+            yield b"".join(buffer)
+            buffer.clear()
+            buffered = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+async def _gzipped(chunks: AsyncIterator[bytes], level: int = EXPORT_GZIP_LEVEL) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _document(db, session, fmt: str, base_url: str) -> AsyncIterator[bytes]:
+    rows = ChatRepository(db).stream_messages(session.id, EXPORT_BATCH_SIZE)
+    return _buffered(_ENCODERS[fmt](session, rows, base_url))
+
+
+def export_filename(session, fmt: str, compress: bool = False) -> str:
+    return f"chat-{session.id[:8]}.{fmt}" + (".gz" if compress else "")
+
+
+async def export_session(session, fmt: str, base_url: str, compress: bool = False) -> AsyncIterator[bytes]:
+    # Runs after the response has started, so it reads through its own database
+    # session instead of the request's.
+    async with SessionLocal() as db:
+        chunks = _document(db, session, fmt, base_url)
+        if compress:
+            chunks = _gzipped(chunks)
+        async for chunk in chunks:
+            yield chunk
+
+
+class _ZipSink:
+    # Write-only target for ZipFile. Having no seek/tell makes zipfile write a
+    # streamable archive (sizes in data descriptors after each entry), and the
+    # bytes written so far are handed out with drain().
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def export_archive(sessions: Iterable, fmt: str, base_url: str) -> AsyncIterator[bytes]:
+    # All given sessions as one zip, one file per session, built while it is sent.
+    sink = _ZipSink()
+    async with SessionLocal() as db:
+        with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for session in sessions:
+                info = zipfile.ZipInfo(
+                    f"chat-{session.id}.{fmt}",
+                    date_time=(session.updated_at or session.created_at).timetuple()[:6]
+                )
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with archive.open(info, "w") as entry:
+                    async for chunk in _document(db, session, fmt, base_url):
+                        entry.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+                data = sink.drain()
+                if data:
+                    yield data
+    yield sink.drain()
@@ -0,0 +1,335 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import asyncio
+import base64
+import binascii
+import hashlib
+import os
+import re
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# local: files under IMAGE_STORE_DIR. memory: in-process only (tests, throwaway
+# instances). s3: any S3-compatible bucket, needs boto3.
+IMAGE_STORE_BACKEND = os.getenv("IMAGE_STORE_BACKEND", "local").lower()
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", os.path.join(BACKEND_DIR, "data", "images"))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_S3_BUCKET = os.getenv("IMAGE_S3_BUCKET")
+IMAGE_S3_PREFIX = os.getenv("IMAGE_S3_PREFIX", "images/")
+IMAGE_S3_ENDPOINT_URL = os.getenv("IMAGE_S3_ENDPOINT_URL")
+# Base URL under which this API is reachable from outside, e.g. https://api.example.com.
+# When set, image links in API responses use it and models are sent that link
+# instead of the inlined image; otherwise links are built from the request URL.
+IMAGE_PUBLIC_BASE_URL = os.getenv("IMAGE_PUBLIC_BASE_URL", "").rstrip("/")
+# Recently sent images kept as data URLs, so follow-up turns of a conversation
+# do not read and re-encode the same image every time.
+IMAGE_INLINE_CACHE_BYTES = int(os.getenv("IMAGE_INLINE_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# Stored in messages.image_url instead of the image itself.
+REF_PREFIX = "sha256:"
+IMAGE_PATH = "/api/images/"
+
+_DATA_URL = re.compile(r"^data:(?P<type>[\w.+-]+/[\w.+-]+)?(?:;[\w=-]+)*;base64,", re.IGNORECASE)
+_HASH = re.compile(r"^[0-9a-f]{64}$")
+
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+class InvalidImage(Exception):
+    def __init__(self, message: str, too_large: bool = False):
+        super().__init__(message)
+        self.too_large = too_large
+
+
+def sniff_type(data: bytes) -> Optional[str]:
+    # The type is taken from the bytes, never from what the client claimed, so a
+    # stored object is always served as the image it is.
+    for signature, content_type in _SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def is_ref(value: Optional[str]) -> bool:
+    return bool(value) and value.startswith(REF_PREFIX)
+
+
+def ref_hash(value: str) -> str:
+    return value[len(REF_PREFIX):]
+
+
+def valid_hash(digest: str) -> bool:
+    return bool(_HASH.match(digest))
+
+
+class LocalImageBackend:
+    # Files named by their hash under a two-level fan-out (ab/cd/abcd...). Writes
+    # go to a temporary file that is renamed into place, so a reader never sees a
+    # partial image and concurrent uploads of the same bytes are harmless.
+    def __init__(self, root: str = IMAGE_STORE_DIR):
+        self.root = root
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def _exists(self, digest: str) -> bool:
+        return os.path.exists(self._path(digest))
+
+    def _put(self, digest: str, data: bytes, content_type: str):
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def _get(self, digest: str) -> Optional[bytes]:
+        try:
+            with open(self._path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    async def exists(self, digest: str) -> bool:
+        return await asyncio.to_thread(self._exists, digest)
+
+    async def put(self, digest: str, data: bytes, content_type: str):
+        await asyncio.to_thread(self._put, digest, data, content_type)
+
+    async def get(self, digest: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._get, digest)
+
+
+class MemoryImageBackend:
+    def __init__(self):
+        self._objects: Dict[str, bytes] = {}
+
+    async def exists(self, digest: str) -> bool:
+        return digest in self._objects
+
+    async def put(self, digest: str, data: bytes, content_type: str):
+        self._objects[digest] = data
+
+    async def get(self, digest: str) -> Optional[bytes]:
+        return self._objects.get(digest)
+
+
+class S3ImageBackend:
+    # boto3 is synchronous; calls run in the default thread pool. Objects are
+    # immutable, so they are written with a long Cache-Control for CDNs in front
+    # of the bucket.
+    def __init__(self, bucket: Optional[str] = IMAGE_S3_BUCKET, prefix: str = IMAGE_S3_PREFIX, endpoint_url: Optional[str] = IMAGE_S3_ENDPOINT_URL):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("IMAGE_STORE_BACKEND=s3 requires boto3 (pip install boto3)")
+        if not bucket:
+            raise RuntimeError("IMAGE_STORE_BACKEND=s3 requires IMAGE_S3_BUCKET")
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = boto3.client("s3", endpoint_url=endpoint_url)
+        self._not_found = self._client.exceptions.ClientError
+
+    def _key(self, digest: str) -> str:
+        return f"{self.prefix}{digest}"
+
+    def _exists(self, digest: str) -> bool:
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=self._key(digest))
+            return True
+        except self._not_found as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def _put(self, digest: str, data: bytes, content_type: str):
+        self._client.put_object(
+            Bucket=self.bucket,
+            Key=self._key(digest),
+            Body=data,
+            ContentType=content_type,
+            CacheControl="public, max-age=31536000, immutable"
+        )
+
+    def _get(self, digest: str) -> Optional[bytes]:
+        try:
+            response = self._client.get_object(Bucket=self.bucket, Key=self._key(digest))
+        except self._not_found as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return response["Body"].read()
+
+    async def exists(self, digest: str) -> bool:
+        return await asyncio.to_thread(self._exists, digest)
+
+    async def put(self, digest: str, data: bytes, content_type: str):
+        await asyncio.to_thread(self._put, digest, data, content_type)
+
+    async def get(self, digest: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._get, digest)
+
+
+def _build_backend(name: str):
+    if name == "memory":
+        return MemoryImageBackend()
+    if name == "s3":
+        return S3ImageBackend()
+    return LocalImageBackend()
+
+
+# Images attached to chat messages, stored once per distinct content under their
+# SHA-256. Message rows only hold the "sha256:<hex>" reference, so history and
+# export queries stay small; the image itself is served by GET /api/images/{hash}
+# and inlined (or linked, see IMAGE_PUBLIC_BASE_URL) when a prompt is sent.
+# Values that are not references (plain URLs, data URLs stored before this
+# existed) are passed through untouched.
+class ImageStore:
+    def __init__(self, backend=None, inline_cache_bytes: int = IMAGE_INLINE_CACHE_BYTES):
+        self._backend = backend
+        self.inline_cache_bytes = inline_cache_bytes
+        self._inline: "OrderedDict[str, str]" = OrderedDict()
+        self._inline_size = 0
+        self.saved = 0
+        self.deduplicated = 0
+        self.bytes_written = 0
+        self.served = 0
+        self.inlined = 0
+        self.inline_hits = 0
+
+    @property
+    def backend(self):
+        # Built on first use so a misconfigured S3 backend fails the request that
+        # needs it instead of the import of every module.
+        if self._backend is None:
+            self._backend = _build_backend(IMAGE_STORE_BACKEND)
+        return self._backend
+
+    async def save(self, data: bytes) -> str:
+        if len(data) > IMAGE_MAX_BYTES:
+            raise InvalidImage(f"Image is larger than {IMAGE_MAX_BYTES // (1024 * 1024)} MB", too_large=True)
+        content_type = sniff_type(data)
+        if content_type is None:
+            raise InvalidImage("Unsupported image format, use PNG, JPEG, GIF or WebP")
+
+        digest = hashlib.sha256(data).hexdigest()
+        if await self.backend.exists(digest):
+            self.deduplicated += 1
+        else:
+            await self.backend.put(digest, data, content_type)
+            self.saved += 1
+            self.bytes_written += len(data)
+        return REF_PREFIX + digest
+
+    async def save_upload(self, value: Optional[str]) -> Optional[str]:
+        # ChatRequest.image: data URLs are decoded and stored, anything else (an
+        # http(s) link) is kept as given.
+        if not value:
+            return value
+        match = _DATA_URL.match(value)
+        if match is None:
+            if value.startswith("data:"):
+                raise InvalidImage("Images must be sent as base64 data URLs")
+            return value
+        # Rough decoded size check before decoding megabytes of base64 for nothing.
+        if (len(value) - match.end()) * 3 // 4 > IMAGE_MAX_BYTES:
+            raise InvalidImage(f"Image is larger than {IMAGE_MAX_BYTES // (1024 * 1024)} MB", too_large=True)
+        try:
+            data = base64.b64decode(value[match.end():], validate=False)
+        except (binascii.Error, ValueError):
+            raise InvalidImage("Image data is not valid base64")
+        return await self.save(data)
+
+    async def get(self, digest: str) -> Optional[bytes]:
+        if not valid_hash(digest):
+            return None
+        data = await self.backend.get(digest)
+        if data is not None:
+            self.served += 1
+        return data
+
+    def public_url(self, value: Optional[str], base_url: str = "") -> Optional[str]:
+        if not is_ref(value):
+            return value
+        base = IMAGE_PUBLIC_BASE_URL or base_url.rstrip("/")
+        return f"{base}{IMAGE_PATH}{ref_hash(value)}"
+
+    async def for_model(self, value: str) -> str:
+        # What goes into the image_url part of a prompt.
+        if not is_ref(value):
+            return value
+        if IMAGE_PUBLIC_BASE_URL:
+            return self.public_url(value)
+
+        digest = ref_hash(value)
+        cached = self._inline.get(digest)
+        if cached is not None:
+            self._inline.move_to_end(digest)
+            self.inline_hits += 1
+            return cached
+
+        data = await self.backend.get(digest)
+        if data is None:
+            raise InvalidImage(f"Image {digest[:12]} is missing from the image store")
+        data_url = f"data:{sniff_type(data) or 'application/octet-stream'};base64,{base64.b64encode(data).decode()}"
+        self.inlined += 1
+        if len(data_url) <= self.inline_cache_bytes:
+            self._inline[digest] = data_url
+            self._inline_size += len(data_url)
+            while self._inline_size > self.inline_cache_bytes:
+                _, evicted = self._inline.popitem(last=False)
+                self._inline_size -= len(evicted)
+        return data_url
+
+    async def resolve_prompt(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Swaps stored references in OpenRouter-format messages for something the
+        # model can load. Messages without images are returned as they are.
+        # An image that has gone missing from the store is left out with a warning
+        # rather than failing the whole conversation.
+        for message in messages:
+            content = message.get("content")
+            if not isinstance(content, list):
+                continue
+            resolved = []
+            for part in content:
+                if part.get("type") == "image_url" and is_ref(part["image_url"].get("url")):
+                    try:
+                        part = {**part, "image_url": {**part["image_url"], "url": await self.for_model(part["image_url"]["url"])}}
+                    except InvalidImage as e:
+                        print(f"Image store: {e}, sending the message without it")
+                        continue
+                resolved.append(part)
+            message["content"] = resolved
+        return messages
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": type(self._backend).__name__ if self._backend is not None else IMAGE_STORE_BACKEND,
+            "saved": self.saved,
+            "deduplicated": self.deduplicated,
+            "bytes_written": self.bytes_written,
+            "served": self.served,
+            "inlined": self.inlined,
+            "inline_hits": self.inline_hits,
+            "inline_cache_bytes": self._inline_size
+        }
+
+
+image_store = ImageStore()
+
+
+def get_image_store_stats() -> Dict[str, Any]:
+    return image_store.stats()
@@ -0,0 +1,186 @@
+from collections import deque
+from opentelemetry import metrics
+from typing import Any, Deque, Dict, Optional, Tuple
+import os
+import time
+
+LLM_METRICS_SAMPLES = int(os.getenv("LLM_METRICS_SAMPLES", "500"))
+
+# Latency boundaries in ms; the SDK defaults top out at 10 s, below what a slow
+# free model takes to start answering.
+_LATENCY_BUCKETS_MS = [50, 100, 250, 500, 1000, 2000, 4000, 8000, 15000, 30000, 60000, 120000]
+_GAP_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+_RATE_BUCKETS = [1, 5, 10, 20, 40, 60, 80, 120, 160, 240, 320]
+
+meter = metrics.get_meter("madlen.llm")
+_ttft_histogram = meter.create_histogram(
+    "llm.time_to_first_token",
+    unit="ms",
+    description="Time from receiving a chat request to the first token of the answer",
+    explicit_bucket_boundaries_advisory=_LATENCY_BUCKETS_MS
+)
+_upstream_ttft_histogram = meter.create_histogram(
+    "llm.upstream.time_to_first_token",
+    unit="ms",
+    description="Time from sending the request to OpenRouter to its first token",
+    explicit_bucket_boundaries_advisory=_LATENCY_BUCKETS_MS
+)
+_gap_histogram = meter.create_histogram(
+    "llm.inter_token_gap",
+    unit="ms",
+    description="Time between consecutive streamed deltas from OpenRouter",
+    explicit_bucket_boundaries_advisory=_GAP_BUCKETS_MS
+)
+_duration_histogram = meter.create_histogram(
+    "llm.request.duration",
+    unit="ms",
+    description="Time from receiving a chat request to the end of the answer",
+    explicit_bucket_boundaries_advisory=_LATENCY_BUCKETS_MS
+)
+_tokens_per_second_histogram = meter.create_histogram(
+    "llm.tokens_per_second",
+    unit="{token}/s",
+    description="Completion tokens per second after the first token",
+    explicit_bucket_boundaries_advisory=_RATE_BUCKETS
+)
+_queue_wait_histogram = meter.create_histogram(
+    "llm.queue.wait",
+    unit="ms",
+    description="Time spent waiting for the OpenRouter request scheduler",
+    explicit_bucket_boundaries_advisory=_LATENCY_BUCKETS_MS
+)
+_retry_counter = meter.create_counter(
+    "llm.upstream.retries",
+    description="OpenRouter requests repeated after a retryable failure"
+)
+
+
+def _percentile(samples, fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class _Series:
+    # The last LLM_METRICS_SAMPLES values of one measurement, for percentiles in
+    # the JSON stats; the OTel histograms carry the full distribution.
+    __slots__ = ("count", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.samples: Deque[float] = deque(maxlen=LLM_METRICS_SAMPLES)
+
+    def add(self, value: float):
+        self.count += 1
+        self.samples.append(value)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "p50": _round(_percentile(self.samples, 0.5)),
+            "p95": _round(_percentile(self.samples, 0.95)),
+            "max": _round(max(self.samples)) if self.samples else None
+        }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 2) if value is not None else None
+
+
+# Per-request LLM latencies, tagged by model and endpoint ("chat" for the
+# buffered answer, "chat_stream" for SSE). Recorded both as OTel instruments
+# (exported through the OTLP reader and, when enabled, Prometheus /metrics) and
+# as recent-sample percentiles for /api/system/llm-metrics.
+class LLMMetrics:
+    def __init__(self):
+        self._series: Dict[Tuple[str, str, str], _Series] = {}
+        self.retries: Dict[Tuple[str, str, str], int] = {}
+
+    def _add(self, name: str, model: str, endpoint: str, value: float):
+        key = (name, model, endpoint)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series()
+        series.add(value)
+
+    def record_ttft(self, model: str, endpoint: str, seconds: float):
+        ms = seconds * 1000
+        _ttft_histogram.record(ms, {"model": model, "endpoint": endpoint})
+        self._add("ttft_ms", model, endpoint, ms)
+
+    def record_upstream_ttft(self, model: str, endpoint: str, seconds: float):
+        ms = seconds * 1000
+        _upstream_ttft_histogram.record(ms, {"model": model, "endpoint": endpoint})
+        self._add("upstream_ttft_ms", model, endpoint, ms)
+
+    def record_gap(self, model: str, endpoint: str, seconds: float):
+        ms = seconds * 1000
+        _gap_histogram.record(ms, {"model": model, "endpoint": endpoint})
+        self._add("inter_token_gap_ms", model, endpoint, ms)
+
+    def record_duration(self, model: str, endpoint: str, seconds: float, tokens: int = 0, generating: Optional[float] = None):
+        # generating: seconds from the first to the last token, when streamed.
+        ms = seconds * 1000
+        attributes = {"model": model, "endpoint": endpoint}
+        _duration_histogram.record(ms, attributes)
+        self._add("duration_ms", model, endpoint, ms)
+        window = generating if generating is not None else seconds
+        if tokens > 1 and window > 0:
+            rate = tokens / window
+            _tokens_per_second_histogram.record(rate, attributes)
+            self._add("tokens_per_second", model, endpoint, rate)
+
+    def record_queue_wait(self, model: str, endpoint: str, seconds: float):
+        ms = seconds * 1000
+        _queue_wait_histogram.record(ms, {"model": model, "endpoint": endpoint})
+        self._add("queue_wait_ms", model, endpoint, ms)
+
+    def record_retry(self, model: str, endpoint: str, reason: str):
+        _retry_counter.add(1, {"model": model, "endpoint": endpoint, "reason": reason})
+        key = (model, endpoint, reason)
+        self.retries[key] = self.retries.get(key, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {}
+        for (name, model, endpoint), series in self._series.items():
+            result.setdefault(model, {}).setdefault(endpoint, {})[name] = series.summary()
+        for (model, endpoint, reason), count in self.retries.items():
+            result.setdefault(model, {}).setdefault(endpoint, {}).setdefault("retries", {})[reason] = count
+        return result
+
+
+llm_metrics = LLMMetrics()
+
+
+def get_llm_metrics() -> Dict[str, Any]:
+    return llm_metrics.stats()
+
+
+class StreamTimer:
+    # Timing of one streamed answer: call token() for every delta with content.
+    __slots__ = ("started", "first", "last")
+
+    def __init__(self, started: Optional[float] = None):
+        self.started = time.monotonic() if started is None else started
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+
+    def token(self) -> Optional[float]:
+        # Returns the gap since the previous token (None for the first one).
+        now = time.monotonic()
+        gap = None
+        if self.first is None:
+            self.first = now
+        else:
+            gap = now - self.last
+        self.last = now
+        return gap
+
+    @property
+    def ttft(self) -> Optional[float]:
+        return self.first - self.started if self.first is not None else None
+
+    @property
+    def generating(self) -> Optional[float]:
+        return self.last - self.first if self.first is not None else None
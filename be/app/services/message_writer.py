@@ -0,0 +1,209 @@
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+import asyncio
+import os
+from .. import models
+from ..core.database import SessionLocal
+from ..repositories.chat_repository import ChatRepository
+
+MESSAGE_WRITER_QUEUE_SIZE = int(os.getenv("MESSAGE_WRITER_QUEUE_SIZE", "10000"))
+MESSAGE_WRITER_BATCH_SIZE = int(os.getenv("MESSAGE_WRITER_BATCH_SIZE", "200"))
+MESSAGE_WRITER_FLUSH_INTERVAL_MS = float(os.getenv("MESSAGE_WRITER_FLUSH_INTERVAL_MS", "50"))
+MESSAGE_WRITER_SHUTDOWN_TIMEOUT = float(os.getenv("MESSAGE_WRITER_SHUTDOWN_TIMEOUT", "10"))
+
+# Write-behind mode: user messages are queued too instead of being committed
+# before the model is called. Enqueueing waits at most WRITE_BEHIND_ENQUEUE_TIMEOUT
+# seconds for room in the queue before the request is rejected.
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "false").lower() in ("1", "true", "yes")
+WRITE_BEHIND_ENQUEUE_TIMEOUT = float(os.getenv("WRITE_BEHIND_ENQUEUE_TIMEOUT", "2"))
+
+
+class WriterBusy(Exception):
+    pass
+
+
+class WriteRecord:
+    __slots__ = ("message", "title", "done")
+
+    def __init__(self, message: models.Message, title: Optional[str] = None):
+        self.message = message
+        self.title = title
+        # Resolved once the record has been written (or given up on).
+        self.done: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+# Persists messages off the request path. Records are collected into batches of
+# up to batch_size or whatever arrived within flush_interval, and each batch is
+# written in one transaction with a multi-row INSERT. Started and drained by the
+# app lifespan; the queue is bounded, and enqueue() applies backpressure.
+class MessageWriter:
+    def __init__(
+        self,
+        max_queue: int = MESSAGE_WRITER_QUEUE_SIZE,
+        batch_size: int = MESSAGE_WRITER_BATCH_SIZE,
+        flush_interval: float = MESSAGE_WRITER_FLUSH_INTERVAL_MS / 1000
+    ):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._worker: Optional[asyncio.Task] = None
+        self._overflow_tasks: set = set()
+        self._pending: Dict[str, Set[WriteRecord]] = defaultdict(set)
+        self._failure_hooks: List[Callable[[models.Message], Any]] = []
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.rejected = 0
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    async def start(self):
+        if not self.running:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = MESSAGE_WRITER_SHUTDOWN_TIMEOUT):
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            print(f"MessageWriter: shutting down with {self._queue.qsize()} unwritten messages")
+        self._worker.cancel()
+        self._worker = None
+
+    def on_failure(self, hook: Callable[[models.Message], Any]):
+        self._failure_hooks.append(hook)
+
+    async def enqueue(self, message: models.Message, title: Optional[str] = None, timeout: float = WRITE_BEHIND_ENQUEUE_TIMEOUT):
+        record = WriteRecord(message, title)
+        if not self.running:
+            self._track(record)
+            await self._write([record])
+            return
+        try:
+            await asyncio.wait_for(self._queue.put(record), timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise WriterBusy(f"message queue full ({self._queue.qsize()} pending)")
+        self._track(record)
+
+    def submit(self, message: models.Message, title: Optional[str] = None):
+        # For callers that must not wait (the tail of a streaming response). If the
+        # queue is full, or no worker runs, the record is written by its own task.
+        record = WriteRecord(message, title)
+        self._track(record)
+        if self.running:
+            try:
+                self._queue.put_nowait(record)
+                return
+            except asyncio.QueueFull:
+                pass
+        task = asyncio.create_task(self._write([record]))
+        self._overflow_tasks.add(task)
+        task.add_done_callback(self._overflow_tasks.discard)
+
+    async def wait_pending(self, session_ids: Iterable[str]) -> bool:
+        # Read-your-writes: waits for the records of these sessions that are queued
+        # right now, not for the queue to drain, which under steady traffic it never
+        # does. Returns whether there was anything to wait for.
+        records = [r for session_id in session_ids for r in self._pending.get(session_id, ())]
+        if records:
+            await asyncio.wait([r.done for r in records])
+        return bool(records)
+
+    async def flush(self):
+        # Drains everything, including records submitted while waiting; for shutdown.
+        if self.running:
+            await self._queue.join()
+        if self._overflow_tasks:
+            await asyncio.gather(*self._overflow_tasks, return_exceptions=True)
+
+    def _track(self, record: WriteRecord):
+        self._pending[record.message.session_id].add(record)
+
+    def _untrack(self, batch: List[WriteRecord]):
+        for record in batch:
+            session_id = record.message.session_id
+            pending = self._pending.get(session_id)
+            if pending is not None:
+                pending.discard(record)
+                if not pending:
+                    del self._pending[session_id]
+            if not record.done.done():
+                record.done.set_result(None)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _write(self, batch: List[WriteRecord]):
+        try:
+            await self._save(batch)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            if len(batch) > 1:
+                # Retry one by one so a single bad row (e.g. its session was deleted
+                # meanwhile) does not take the rest of the batch down with it.
+                for record in batch:
+                    await self._write_one(record)
+            else:
+                self._fail(batch[0], e)
+        self._untrack(batch)
+
+    async def _write_one(self, record: WriteRecord):
+        try:
+            await self._save([record])
+            self.written += 1
+        except Exception as e:
+            self._fail(record, e)
+
+    async def _save(self, batch: List[WriteRecord]):
+        titles = {r.message.session_id: r.title for r in batch if r.title is not None}
+        async with SessionLocal() as db:
+            await ChatRepository(db).save_messages([r.message for r in batch], titles)
+
+    def _fail(self, record: WriteRecord, error: Exception):
+        self.failed += 1
+        print(f"MessageWriter: failed to write message {record.message.id}: {error}")
+        for hook in self._failure_hooks:
+            try:
+                hook(record.message)
+            except Exception as e:
+                print(f"MessageWriter: failure hook raised: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "write_behind": WRITE_BEHIND_ENABLED,
+            "queued": self._queue.qsize(),
+            "sessions_pending": len(self._pending),
+            "written": self.written,
+            "batches": self.batches,
+            "failed": self.failed,
+            "rejected": self.rejected
+        }
+
+
+message_writer = MessageWriter()
@@ -0,0 +1,163 @@
+from fastapi.encoders import jsonable_encoder
+from typing import Any, Dict, List, Optional
+import asyncio
+import hashlib
+import json
+import os
+import time
+from .. import schemas
+from . import openrouter
+from .shared_state import StateContended, bulk_state, offload, shared_state
+
+MODEL_CATALOG_TTL = float(os.getenv("MODEL_CATALOG_TTL", "600"))
+MODEL_CATALOG_RETRY_INTERVAL = float(os.getenv("MODEL_CATALOG_RETRY_INTERVAL", "30"))
+DEFAULT_CONTEXT_LENGTH = int(os.getenv("DEFAULT_CONTEXT_LENGTH", "8192"))
+
+CATALOG_KEY = "openrouter:catalog"
+CATALOG_REFRESH_KEY = "openrouter:catalog:refresh"
+# How long one worker may hold the refresh claim before another one takes over.
+CATALOG_REFRESH_CLAIM = 30.0
+
+
+class CatalogSnapshot:
+    # Everything /api/models and prompt building need, computed once per fetch:
+    # the raw model dicts, the encoded AIModelDTO response body and its ETag.
+    def __init__(self, models: List[Dict[str, Any]], context_lengths: Dict[str, int], fetched_at: float, is_fallback: bool = False):
+        self.models = models
+        self.context_lengths = {m["id"]: m["context_length"] for m in models}
+        self.context_lengths.update(context_lengths)
+        self.fetched_at = fetched_at
+        self.is_fallback = is_fallback
+
+        dtos = [
+            schemas.AIModelDTO(
+                id=m["id"],
+                name=m["name"],
+                provider=m["provider"],
+                isFree=m["is_free"],
+                contextWindow=m["context_length"]
+            ) for m in models
+        ]
+        self.body = json.dumps(jsonable_encoder(dtos), separators=(",", ":")).encode()
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+
+
+# Process-wide OpenRouter model catalog. Fresh snapshots are served for
+# MODEL_CATALOG_TTL; after that the stale snapshot keeps being served while one
+# background fetch revalidates it. Concurrent misses share a single fetch, and a
+# failed fetch keeps the last good snapshot (FALLBACK_FREE_MODELS is only used
+# before the first successful fetch). Fetched catalogs are published to
+# bulk_state: a worker whose snapshot expires first adopts a fresher one from
+# another worker, and only the worker holding the refresh claim asks OpenRouter,
+# so all workers serve the same ETag and /models is fetched once per TTL.
+class ModelCatalog:
+    def __init__(self, ttl: float = MODEL_CATALOG_TTL, retry_interval: float = MODEL_CATALOG_RETRY_INTERVAL):
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._expires_at = 0.0
+        self._inflight: Optional[asyncio.Task] = None
+        self.fetches = 0
+        self.fetch_failures = 0
+        self.stale_served = 0
+        self.adopted = 0
+
+    async def get(self) -> CatalogSnapshot:
+        if self._snapshot is None:
+            return await self.refresh()
+
+        if time.monotonic() >= self._expires_at:
+            self.stale_served += 1
+            self._start_refresh()
+        return self._snapshot
+
+    async def refresh(self) -> CatalogSnapshot:
+        # Shielded so a client that disconnects mid-request does not cancel the
+        # fetch the other waiters are sharing.
+        return await asyncio.shield(self._start_refresh())
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._fetch())
+        return self._inflight
+
+    async def _adopt_shared(self) -> bool:
+        shared = await offload(bulk_state, bulk_state.get, CATALOG_KEY)
+        if not shared:
+            return False
+        age = time.time() - shared["fetched_at"]
+        if age >= self.ttl or (self._snapshot is not None and shared["fetched_at"] <= self._snapshot.fetched_at):
+            return False
+        self._snapshot = CatalogSnapshot(shared["models"], shared["context_lengths"], shared["fetched_at"])
+        self._expires_at = time.monotonic() + self.ttl - age
+        self.adopted += 1
+        return True
+
+    @staticmethod
+    async def _shared_update(state, key: str, fn, ttl: Optional[float] = None) -> Any:
+        # Only other workers doing the same refresh race for these keys, so losing
+        # counts as "someone else has it": no claim, no publish, and a claim that
+        # could not be released simply expires.
+        try:
+            return await offload(state, state.update, key, fn, ttl)
+        except StateContended:
+            return False
+
+    async def _fetch(self) -> CatalogSnapshot:
+        if await self._adopt_shared():
+            return self._snapshot
+        claimed = await self._shared_update(
+            shared_state, CATALOG_REFRESH_KEY,
+            lambda current: (current, False) if current else (os.getpid(), True),
+            CATALOG_REFRESH_CLAIM
+        )
+        if not claimed and self._snapshot is not None:
+            # Another worker is fetching; keep serving stale and look again shortly.
+            self._expires_at = time.monotonic() + 1
+            return self._snapshot
+
+        self.fetches += 1
+        try:
+            models, context_lengths = await openrouter.fetch_models()
+            self._snapshot = CatalogSnapshot(models, context_lengths, time.time())
+            self._expires_at = time.monotonic() + self.ttl
+            shared = {"models": models, "context_lengths": context_lengths, "fetched_at": self._snapshot.fetched_at}
+            await self._shared_update(bulk_state, CATALOG_KEY, lambda current: (shared, None), self.ttl)
+        except Exception as e:
+            self.fetch_failures += 1
+            print(f"Error fetching models from OpenRouter: {e}")
+            if self._snapshot is None:
+                self._snapshot = CatalogSnapshot(openrouter.FALLBACK_FREE_MODELS, {}, time.time(), is_fallback=True)
+            # Keep serving what we have and try again shortly instead of on every request.
+            self._expires_at = time.monotonic() + self.retry_interval
+        finally:
+            if claimed:
+                await self._shared_update(shared_state, CATALOG_REFRESH_KEY, lambda current: (None, None))
+        return self._snapshot
+
+    async def get_models(self) -> List[Dict[str, Any]]:
+        return (await self.get()).models
+
+    async def get_context_length(self, model: str) -> int:
+        return (await self.get()).context_lengths.get(model, DEFAULT_CONTEXT_LENGTH)
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self._snapshot
+        return {
+            "models": len(snapshot.models) if snapshot else 0,
+            "etag": snapshot.etag if snapshot else None,
+            "age_seconds": round(time.time() - snapshot.fetched_at, 1) if snapshot else None,
+            "stale": snapshot is not None and time.monotonic() >= self._expires_at,
+            "is_fallback": snapshot.is_fallback if snapshot else None,
+            "fetches": self.fetches,
+            "fetch_failures": self.fetch_failures,
+            "stale_served": self.stale_served,
+            "adopted": self.adopted
+        }
+
+
+model_catalog = ModelCatalog()
+
+
+def get_model_catalog_stats() -> Dict[str, Any]:
+    return model_catalog.stats()
@@ -0,0 +1,250 @@
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+from fastapi import HTTPException
+import asyncio
+import os
+import time
+from . import openrouter
+from .model_catalog import model_catalog
+from .openrouter import StreamDelta
+from .circuit_breaker import circuit_breakers
+
+# off: only the selected model. failover: when it fails before the first token,
+# retry on an equivalent model. hedge: failover, plus a second request to the next
+# candidate when the first token is later than MODEL_HEDGE_AFTER_MS.
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "off").lower()
+MODEL_FAILOVER_MAX_ATTEMPTS = int(os.getenv("MODEL_FAILOVER_MAX_ATTEMPTS", "3"))
+MODEL_HEDGE_AFTER_MS = float(os.getenv("MODEL_HEDGE_AFTER_MS", "4000"))
+MODEL_STATS_ALPHA = float(os.getenv("MODEL_STATS_ALPHA", "0.2"))
+
+ROUTING_MODES = ("off", "failover", "hedge")
+
+
+class ModelHealth:
+    # Exponentially weighted error rate and time to first token of one model.
+    __slots__ = ("requests", "failures", "error_rate", "ttft", "last_error", "last_error_at")
+
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.error_rate = 0.0
+        self.ttft: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.last_error_at: Optional[float] = None
+
+
+class ModelStats:
+    def __init__(self, alpha: float = MODEL_STATS_ALPHA):
+        self.alpha = alpha
+        self._models: Dict[str, ModelHealth] = {}
+        self.failovers = 0
+        self.hedges = 0
+        self.hedges_won = 0
+
+    def _get(self, model: str) -> ModelHealth:
+        health = self._models.get(model)
+        if health is None:
+            health = self._models[model] = ModelHealth()
+        return health
+
+    def record_success(self, model: str, ttft: float):
+        health = self._get(model)
+        health.requests += 1
+        health.error_rate *= 1 - self.alpha
+        health.ttft = ttft if health.ttft is None else health.ttft + self.alpha * (ttft - health.ttft)
+
+    def record_failure(self, model: str, error: str):
+        health = self._get(model)
+        health.requests += 1
+        health.failures += 1
+        health.error_rate += self.alpha * (1 - health.error_rate)
+        health.last_error = error[:200]
+        health.last_error_at = time.time()
+
+    def rank_key(self, model: str) -> Tuple[float, float]:
+        # Lower is better: error rate first (in 10% steps so noise does not reorder
+        # healthy models), then typical time to first token. Unknown models sit
+        # between proven fast ones and failing ones.
+        health = self._models.get(model)
+        if health is None:
+            return (0.0, MODEL_HEDGE_AFTER_MS / 1000)
+        return (round(health.error_rate, 1), health.ttft if health.ttft is not None else MODEL_HEDGE_AFTER_MS / 1000)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "failovers": self.failovers,
+            "hedges": self.hedges,
+            "hedges_won": self.hedges_won,
+            "models": {
+                model: {
+                    "requests": h.requests,
+                    "failures": h.failures,
+                    "error_rate": round(h.error_rate, 3),
+                    "ttft_seconds": round(h.ttft, 3) if h.ttft is not None else None,
+                    "last_error": h.last_error,
+                    "last_error_at": h.last_error_at
+                } for model, h in self._models.items()
+            }
+        }
+
+
+model_stats = ModelStats()
+
+
+def get_model_stats() -> Dict[str, Any]:
+    return model_stats.stats()
+
+
+def _provider(model_id: str) -> str:
+    return model_id.split("/")[0] if "/" in model_id else model_id
+
+
+async def candidates(model: str, limit: int = MODEL_FAILOVER_MAX_ATTEMPTS) -> List[str]:
+    # The selected model first, then equivalent models from the cached catalog: a
+    # context window at least as large (the prompt was trimmed to the selected
+    # model's window), same provider preferred, ordered by health and latency.
+    snapshot = await model_catalog.get()
+    context_length = snapshot.context_lengths.get(model, 0)
+    provider = _provider(model)
+    alternatives = [
+        m["id"] for m in snapshot.models
+        if m["id"] != model and m["context_length"] >= context_length and not circuit_breakers.is_open(m["id"])
+    ]
+    alternatives.sort(key=lambda m: (
+        model_stats.rank_key(m),
+        _provider(m) != provider,
+        -snapshot.context_lengths.get(m, 0)
+    ))
+    return [model] + alternatives[:max(0, limit - 1)]
+
+
+def resolve_mode(requested: Optional[str]) -> str:
+    mode = (requested or MODEL_ROUTING).lower()
+    return mode if mode in ROUTING_MODES else "off"
+
+
+async def chat_completion(model: str, messages: List[Dict[str, Any]], user_id: Optional[str] = None, mode: Optional[str] = None):
+    # Non-streaming counterpart: failover only (there is no first token to hedge on).
+    # Returns the response and the model that produced it.
+    mode = resolve_mode(mode)
+    models = await candidates(model) if mode != "off" else [model]
+    last_error: Optional[HTTPException] = None
+    for index, candidate in enumerate(models):
+        started = time.monotonic()
+        try:
+            response = await openrouter.chat_completion(
+                model=candidate,
+                messages=messages,
+                user_id=user_id,
+                max_retries=1 if len(models) > 1 else 3
+            )
+        except HTTPException as e:
+            model_stats.record_failure(candidate, str(e.detail))
+            last_error = e
+            if index + 1 < len(models):
+                model_stats.failovers += 1
+                print(f"Model {candidate} failed ({e.status_code}), failing over to {models[index + 1]}")
+            continue
+        model_stats.record_success(candidate, time.monotonic() - started)
+        return response, candidate
+    raise last_error
+
+
+class _Attempt:
+    __slots__ = ("model", "stream", "first", "started", "hedge")
+
+    def __init__(self, model: str, stream, hedge: bool = False):
+        self.model = model
+        self.stream = stream
+        self.started = time.monotonic()
+        self.hedge = hedge
+        # The pending first __anext__; it is awaited (not cancelled) across the
+        # hedge timeout so the request keeps going while a second one starts.
+        self.first: asyncio.Task = asyncio.ensure_future(stream.__anext__())
+
+    async def close(self):
+        if not self.first.done():
+            self.first.cancel()
+        try:
+            await self.first
+        except (asyncio.CancelledError, Exception):
+            pass
+        await self.stream.aclose()
+
+
+# Streams one answer, routing around failing or slow models. Failover only ever
+# happens before the first token reaches the client; once a model has produced
+# a token the rest of the answer comes from it. `model` is the model that ended
+# up serving the answer.
+class RoutedStream:
+    def __init__(self, model: str, messages: List[Dict[str, Any]], user_id: Optional[str] = None, mode: Optional[str] = None):
+        self.model = model
+        self.messages = messages
+        self.user_id = user_id
+        self.mode = resolve_mode(mode)
+
+    def _start(self, model: str, retries: int, hedge: bool = False) -> _Attempt:
+        stream = openrouter.chat_completion_stream(
+            model=model,
+            messages=self.messages,
+            user_id=self.user_id,
+            max_retries=retries
+        )
+        return _Attempt(model, stream, hedge)
+
+    async def stream(self) -> AsyncGenerator[StreamDelta, None]:
+        models = await candidates(self.model) if self.mode != "off" else [self.model]
+        retries = 1 if len(models) > 1 else 3
+        remaining = list(models)
+        running = [self._start(remaining.pop(0), retries)]
+        hedged = self.mode != "hedge" or not remaining
+        hedge_at = time.monotonic() + MODEL_HEDGE_AFTER_MS / 1000
+        winner: Optional[_Attempt] = None
+        first: Optional[StreamDelta] = None
+        try:
+            while winner is None:
+                timeout = None if hedged else max(0.0, hedge_at - time.monotonic())
+                finished, _ = await asyncio.wait([a.first for a in running], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not finished:
+                    hedged = True
+                    model_stats.hedges += 1
+                    running.append(self._start(remaining.pop(0), retries, hedge=True))
+                    continue
+
+                for attempt in [a for a in running if a.first in finished]:
+                    try:
+                        delta = attempt.first.result()
+                    except StopAsyncIteration:
+                        delta = StreamDelta(done=True, error="Empty response from model")
+                    if delta.error is None:
+                        winner, first = attempt, delta
+                        break
+                    model_stats.record_failure(attempt.model, delta.error)
+                    running.remove(attempt)
+                    await attempt.close()
+                    if not running:
+                        if not remaining:
+                            yield delta
+                            return
+                        model_stats.failovers += 1
+                        print(f"Model {attempt.model} failed ({delta.status}), failing over to {remaining[0]}")
+                        running.append(self._start(remaining.pop(0), retries))
+                        hedge_at = time.monotonic() + MODEL_HEDGE_AFTER_MS / 1000
+                        hedged = self.mode != "hedge" or not remaining
+
+            for attempt in running:
+                if attempt is not winner:
+                    await attempt.close()
+            running = [winner]
+            if winner.hedge:
+                model_stats.hedges_won += 1
+            model_stats.record_success(winner.model, time.monotonic() - winner.started)
+            self.model = winner.model
+
+            yield first
+            if first.done:
+                return
+            async for delta in winner.stream:
+                yield delta
+        finally:
+            for attempt in running:
+                await attempt.close()
@@ -2,13 +2,45 @@ import httpx
 import os
 import asyncio
 import json
-from typing import List, Dict, Any, AsyncGenerator
+from typing import List, Dict, Any, AsyncGenerator, AsyncIterable, Optional, Tuple
 from fastapi import HTTPException
+from .rate_limiter import request_scheduler, RateLimitExceeded, parse_reset
+from .circuit_breaker import circuit_breakers, CircuitOpenError, Guard
+from .response_cache import response_cache, cache_key, replay_chunks
+from .llm_metrics import llm_metrics
+from .shared_state import offload
+import time
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-OPENROUTER_URL = "https://openrouter.ai/api/v1"
+# Overridable to point at a stand-in such as benchmarks/mock_openrouter.py.
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1").rstrip("/")
+
+OPENROUTER_MAX_CONNECTIONS = int(os.getenv("OPENROUTER_MAX_CONNECTIONS", "100"))
+OPENROUTER_MAX_KEEPALIVE = int(os.getenv("OPENROUTER_MAX_KEEPALIVE", "20"))
+OPENROUTER_KEEPALIVE_EXPIRY = float(os.getenv("OPENROUTER_KEEPALIVE_EXPIRY", "30"))
+OPENROUTER_HTTP2 = os.getenv("OPENROUTER_HTTP2", "true").lower() in ("1", "true", "yes")
+OPENROUTER_CONNECT_TIMEOUT = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "10"))
+OPENROUTER_WRITE_TIMEOUT = float(os.getenv("OPENROUTER_WRITE_TIMEOUT", "30"))
+OPENROUTER_POOL_TIMEOUT = float(os.getenv("OPENROUTER_POOL_TIMEOUT", "10"))
+OPENROUTER_READ_TIMEOUT = float(os.getenv("OPENROUTER_READ_TIMEOUT", "60"))
+OPENROUTER_STREAM_READ_TIMEOUT = float(os.getenv("OPENROUTER_STREAM_READ_TIMEOUT", "120"))
+OPENROUTER_MODELS_READ_TIMEOUT = float(os.getenv("OPENROUTER_MODELS_READ_TIMEOUT", "15"))
 
-rate_limit_info = {
+_client: Optional[httpx.AsyncClient] = None
+
+# Last x-ratelimit-* values seen by any worker, kept with the shared bucket.
+_RATE_LIMIT_DEFAULTS = {
     "requests_remaining": None,
     "requests_limit": None,
     "requests_reset": None
@@ -45,73 +77,202 @@ FALLBACK_FREE_MODELS = [
     }
 ]
 
-def get_rate_limit_info() -> Dict[str, Any]:
-    return rate_limit_info.copy()
+def _build_client() -> httpx.AsyncClient:
+    http2 = OPENROUTER_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            print("OpenRouter: HTTP/2 requested but 'h2' is not installed, falling back to HTTP/1.1")
+            http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=OPENROUTER_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENROUTER_MAX_KEEPALIVE,
+            keepalive_expiry=OPENROUTER_KEEPALIVE_EXPIRY
+        ),
+        timeout=_timeout(OPENROUTER_READ_TIMEOUT)
+    )
+
+def _timeout(read: float) -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=OPENROUTER_CONNECT_TIMEOUT,
+        read=read,
+        write=OPENROUTER_WRITE_TIMEOUT,
+        pool=OPENROUTER_POOL_TIMEOUT
+    )
+
+def get_client() -> httpx.AsyncClient:
+    # Created by the app lifespan; lazily built here for scripts that never start it.
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client()
+    return _client
+
+async def startup():
+    get_client()
+
+async def shutdown():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def get_rate_limit_info() -> Dict[str, Any]:
+    upstream = await offload(request_scheduler.bucket.state, request_scheduler.upstream)
+    return {**_RATE_LIMIT_DEFAULTS, **upstream}
 
 def _update_rate_limit_from_headers(headers: httpx.Headers):
-    global rate_limit_info
-    
+    changes = {}
     if "x-ratelimit-remaining" in headers:
-        rate_limit_info["requests_remaining"] = int(headers.get("x-ratelimit-remaining", 0))
+        changes["requests_remaining"] = int(headers.get("x-ratelimit-remaining", 0))
     if "x-ratelimit-limit" in headers:
-        rate_limit_info["requests_limit"] = int(headers.get("x-ratelimit-limit", 0))
+        changes["requests_limit"] = int(headers.get("x-ratelimit-limit", 0))
     if "x-ratelimit-reset" in headers:
-        rate_limit_info["requests_reset"] = headers.get("x-ratelimit-reset")
+        changes["requests_reset"] = headers.get("x-ratelimit-reset")
+    if not changes:
+        return
+
+    request_scheduler.observe(
+        changes,
+        changes.get("requests_remaining"),
+        parse_reset(headers.get("x-ratelimit-reset"))
+    )
+
+def _retry_after(headers: httpx.Headers, fallback: Optional[float] = None) -> Optional[float]:
+    # How long OpenRouter wants us to back off after a 429. Only account-wide limits
+    # carry these headers; a 429 without them comes from the model's upstream
+    # provider and says nothing about other models.
+    retry_after = headers.get("retry-after")
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+    reset_in = parse_reset(headers.get("x-ratelimit-reset"))
+    return reset_in if reset_in else fallback
+
+def _rate_limited(retry_after: str) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Rate limit exceeded. Please wait a moment and try again. Free models have strict usage limits.",
+        headers={"Retry-After": retry_after}
+    )
+
+def _circuit_open(e: CircuitOpenError, model: Optional[str] = None) -> HTTPException:
+    what = f"Model '{model}'" if model and e.key.startswith("model:") else "OpenRouter"
+    return HTTPException(
+        status_code=503,
+        detail=f"{what} is temporarily unavailable after repeated failures. Please try again in {e.retry_after_header}s or select a different model.",
+        headers={"Retry-After": e.retry_after_header}
+    )
+
+def _record_status(guard: Guard, status_code: int):
+    # 5xx: OpenRouter itself is struggling. 404/408/429: this model is unavailable
+    # or overloaded upstream. Other 4xx are problems with our request, not health.
+    if status_code >= 500:
+        guard.failure()
+    elif status_code in (404, 408, 429):
+        guard.failure(endpoint=False)
+    else:
+        guard.success()
+
+def _cache_answer(key: bytes, data: Dict[str, Any]):
+    try:
+        content = data["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return
+    if isinstance(content, str):
+        response_cache.put(key, content)
+
+async def acquire_slot(user_id: Optional[str] = None, model: Optional[str] = None, endpoint: str = "chat"):
+    # Waits for the shared scheduler to allow one more OpenRouter request, or
+    # fails fast with 429 + Retry-After when that would take too long.
+    if not OPENROUTER_API_KEY:
+        return
+    started = time.monotonic()
+    try:
+        await request_scheduler.acquire(user_id)
+    except RateLimitExceeded as e:
+        raise _rate_limited(e.retry_after_header)
+    if model:
+        llm_metrics.record_queue_wait(model, endpoint, time.monotonic() - started)
 
-async def get_models() -> List[Dict[str, Any]]:
+async def check_slot(user_id: Optional[str] = None):
+    # Fails fast with 429 + Retry-After when a request from user_id would be
+    # turned away right now; takes no slot.
+    if not OPENROUTER_API_KEY:
+        return
     try:
-        headers = {}
-        if OPENROUTER_API_KEY:
-            headers["Authorization"] = f"Bearer {OPENROUTER_API_KEY}"
+        await request_scheduler.check(user_id)
+    except RateLimitExceeded as e:
+        raise _rate_limited(e.retry_after_header)
+
+async def fetch_models() -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    # Downloads the catalog and returns the free models to offer plus the context
+    # length of every listed model. Raises on failure; callers decide what to serve
+    # instead (see services/model_catalog.py).
+    headers = {}
+    if OPENROUTER_API_KEY:
+        headers["Authorization"] = f"Bearer {OPENROUTER_API_KEY}"
+    
+    guard = circuit_breakers.guard("models")
+    try:
+        response = await get_client().get(
+            f"{OPENROUTER_URL}/models",
+            headers=headers,
+            timeout=_timeout(OPENROUTER_MODELS_READ_TIMEOUT)
+        )
+    except Exception:
+        guard.failure()
+        raise
+    _record_status(guard, response.status_code)
+    response.raise_for_status()
+    _update_rate_limit_from_headers(response.headers)
+    data = response.json()
+    
+    free_models = []
+    context_lengths = {}
+    for model in data.get("data", []):
+        if model.get("id") and model.get("context_length"):
+            context_lengths[model["id"]] = int(model["context_length"])
+
+        pricing = model.get("pricing", {})
+        prompt_price = pricing.get("prompt", "1")
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{OPENROUTER_URL}/models",
-                headers=headers,
-                timeout=15.0
-            )
-            response.raise_for_status()
-            _update_rate_limit_from_headers(response.headers)
-            data = response.json()
-            
-            free_models = []
-            for model in data.get("data", []):
-                pricing = model.get("pricing", {})
-                prompt_price = pricing.get("prompt", "1")
+        try:
+            if prompt_price == "0" or float(prompt_price) == 0:
+                model_id = model.get("id", "")
+                provider = model_id.split("/")[0].replace("-", " ").title() if "/" in model_id else "Unknown"
                 
-                try:
-                    if prompt_price == "0" or float(prompt_price) == 0:
-                        model_id = model.get("id", "")
-                        provider = model_id.split("/")[0].replace("-", " ").title() if "/" in model_id else "Unknown"
-                        
-                        free_models.append({
-                            "id": model_id,
-                            "name": model.get("name", model_id),
-                            "provider": provider,
-                            "context_length": model.get("context_length", 4096),
-                            "is_free": True
-                        })
-                except (ValueError, TypeError):
-                    continue
-            
-            free_models.sort(key=lambda x: x.get("context_length", 0), reverse=True)
-            
-            if free_models:
-                print(f"Fetched {len(free_models)} free models from OpenRouter API")
-                return free_models[:15]
-            
-            print("No free models found from API, using fallback list")
-            return FALLBACK_FREE_MODELS
-            
-    except Exception as e:
-        print(f"Error fetching models from OpenRouter: {e}")
-        return FALLBACK_FREE_MODELS
+                free_models.append({
+                    "id": model_id,
+                    "name": model.get("name", model_id),
+                    "provider": provider,
+                    "context_length": model.get("context_length", 4096),
+                    "is_free": True
+                })
+        except (ValueError, TypeError):
+            continue
+    
+    free_models.sort(key=lambda x: x.get("context_length", 0), reverse=True)
+    
+    if free_models:
+        print(f"Fetched {len(free_models)} free models from OpenRouter API")
+        return free_models[:15], context_lengths
+    
+    print("No free models found from API, using fallback list")
+    return FALLBACK_FREE_MODELS, context_lengths
 
 async def chat_completion(
     model: str, 
     messages: List[Dict[str, str]], 
     site_url: str = "http://localhost:3000", 
-    app_name: str = "Madlen AI"
+    app_name: str = "Madlen AI",
+    user_id: Optional[str] = None,
+    max_retries: int = 3
 ) -> Dict[str, Any]:
     
     if not OPENROUTER_API_KEY:
@@ -125,6 +286,11 @@ async def chat_completion(
             }]
         }
 
+    key = cache_key(model, messages) if response_cache.enabled else None
+    cached = response_cache.get(key) if key is not None else None
+    if cached is not None:
+        return {"choices": [{"message": {"role": "assistant", "content": cached}}]}
+
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "HTTP-Referer": site_url,
@@ -137,79 +303,184 @@ async def chat_completion(
         "messages": messages
     }
 
-    max_retries = 3
     base_delay = 2
+    client = get_client()
+    last_error: Optional[HTTPException] = None
     
-    async with httpx.AsyncClient() as client:
-        for attempt in range(max_retries):
-            try:
-                response = await client.post(
-                    f"{OPENROUTER_URL}/chat/completions",
-                    json=payload,
-                    headers=headers,
-                    timeout=60.0
-                )
-                response.raise_for_status()
-                _update_rate_limit_from_headers(response.headers)
-                return response.json()
-                
-            except httpx.HTTPStatusError as e:
-                error_text = e.response.text
-                status_code = e.response.status_code
-                _update_rate_limit_from_headers(e.response.headers)
-                
-                if status_code == 429:
-                    if attempt < max_retries - 1:
-                        delay = base_delay * (2 ** attempt)
-                        print(f"Rate limited (429). Retrying in {delay}s... (attempt {attempt + 1}/{max_retries})")
-                        await asyncio.sleep(delay)
-                        continue
-                    else:
-                        print(f"Rate limit exceeded after {max_retries} attempts")
-                        raise HTTPException(
-                            status_code=429, 
-                            detail="Rate limit exceeded. Please wait a moment and try again. Free models have strict usage limits."
-                        )
-                
-                elif status_code == 404:
-                    print(f"Model not found: {model}")
-                    raise HTTPException(
-                        status_code=404, 
-                        detail=f"Model '{model}' not found or unavailable. Please select a different model."
-                    )
-                
-                elif status_code == 400:
-                    print(f"Invalid model ID: {model}")
-                    raise HTTPException(
-                        status_code=400, 
-                        detail=f"Invalid model ID '{model}'. Please select a valid model from the list."
-                    )
-                
-                print(f"OpenRouter API Error: {error_text}")
-                raise HTTPException(status_code=status_code, detail=f"OpenRouter Error: {error_text}")
-                
-            except httpx.TimeoutException:
+    for attempt in range(max_retries):
+        # Retries draw on a shared budget and go through the breakers again, so a
+        # degraded model is not hit with every request times max_retries.
+        if attempt == 0:
+            circuit_breakers.retry_budget.deposit()
+        elif not circuit_breakers.retry_budget.try_spend():
+            print(f"Retry budget exhausted, giving up on {model}")
+            raise last_error
+        try:
+            guard = circuit_breakers.guard("chat", model)
+        except CircuitOpenError as e:
+            raise _circuit_open(e, model)
+        try:
+            await acquire_slot(user_id, model, "chat")
+        except HTTPException:
+            guard.release()
+            raise
+
+        try:
+            response = await client.post(
+                f"{OPENROUTER_URL}/chat/completions",
+                json=payload,
+                headers=headers,
+                timeout=_timeout(OPENROUTER_READ_TIMEOUT)
+            )
+            _record_status(guard, response.status_code)
+            response.raise_for_status()
+            _update_rate_limit_from_headers(response.headers)
+            data = response.json()
+            if key is not None:
+                _cache_answer(key, data)
+            return data
+            
+        except httpx.HTTPStatusError as e:
+            error_text = e.response.text
+            status_code = e.response.status_code
+            _update_rate_limit_from_headers(e.response.headers)
+            
+            if status_code == 429:
+                # Account-wide limit: pause the shared scheduler instead of sleeping
+                # here; the next acquire_slot waits for the reset, or rejects right
+                # away with Retry-After when the reset is too far off. A model-level
+                # limit only backs off this request.
+                retry_after = _retry_after(e.response.headers)
+                if retry_after is not None:
+                    await request_scheduler.pause(retry_after)
                 if attempt < max_retries - 1:
-                    delay = base_delay * (2 ** attempt)
-                    print(f"Request timeout. Retrying in {delay}s... (attempt {attempt + 1}/{max_retries})")
-                    await asyncio.sleep(delay)
+                    delay = retry_after if retry_after is not None else base_delay * (2 ** attempt)
+                    last_error = _rate_limited(str(max(1, round(delay))))
+                    llm_metrics.record_retry(model, "chat", "rate_limited")
+                    print(f"Rate limited (429). Retrying after {delay:.1f}s... (attempt {attempt + 1}/{max_retries})")
+                    if retry_after is None:
+                        await asyncio.sleep(delay)
                     continue
-                raise HTTPException(status_code=504, detail="Request timed out. Please try again.")
-                
-            except Exception as e:
-                print(f"Network Error: {str(e)}")
-                raise HTTPException(status_code=500, detail=f"Internal Service Error: {str(e)}")
+                else:
+                    print(f"Rate limit exceeded after {max_retries} attempts")
+                    raise _rate_limited(str(max(1, round(retry_after or base_delay))))
+            
+            elif status_code == 404:
+                print(f"Model not found: {model}")
+                raise HTTPException(
+                    status_code=404, 
+                    detail=f"Model '{model}' not found or unavailable. Please select a different model."
+                )
+            
+            elif status_code == 400:
+                print(f"Invalid model ID: {model}")
+                raise HTTPException(
+                    status_code=400, 
+                    detail=f"Invalid model ID '{model}'. Please select a valid model from the list."
+                )
+            
+            print(f"OpenRouter API Error: {error_text}")
+            raise HTTPException(status_code=status_code, detail=f"OpenRouter Error: {error_text}")
+            
+        except httpx.TimeoutException:
+            guard.failure()
+            last_error = HTTPException(status_code=504, detail="Request timed out. Please try again.")
+            if attempt < max_retries - 1:
+                delay = base_delay * (2 ** attempt)
+                llm_metrics.record_retry(model, "chat", "timeout")
+                print(f"Request timeout. Retrying in {delay}s... (attempt {attempt + 1}/{max_retries})")
+                await asyncio.sleep(delay)
+                continue
+            raise last_error
+            
+        except Exception as e:
+            guard.failure()
+            print(f"Network Error: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Internal Service Error: {str(e)}")
+
+
+class StreamDelta:
+    # One event of a streamed answer: the text it adds, whether it ends the stream,
+    # and the SSE frame sent to the browser. The frame is encoded on first use, once,
+    # so nothing downstream has to parse or re-serialize it.
+    __slots__ = ("content", "done", "error", "status", "_frame")
 
+    def __init__(self, content: str = "", done: bool = False, error: Optional[str] = None, status: Optional[int] = None):
+        self.content = content
+        self.done = done
+        self.error = error
+        # HTTP status behind an error event, when there was one (not sent to the browser).
+        self.status = status
+        self._frame: Optional[bytes] = None
+
+    @property
+    def frame(self) -> bytes:
+        if self._frame is None:
+            if self.error is not None:
+                payload = {"error": self.error, "done": self.done}
+            elif self.content:
+                payload = {"content": self.content, "done": self.done}
+            else:
+                payload = {"done": self.done}
+            self._frame = b"data: " + _dumps(payload) + b"\n\n"
+        return self._frame
+
+def parse_sse_line(line: bytes) -> Optional[StreamDelta]:
+    # Single parse of an upstream "data:" line; returns None for comments,
+    # keep-alives, role-only chunks and anything that is not valid JSON.
+    if not line.startswith(b"data:"):
+        return None
+    data = line[5:].strip()
+    if data == b"[DONE]":
+        return StreamDelta(done=True)
+    try:
+        chunk = _loads(data)
+        content = chunk["choices"][0]["delta"].get("content")
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return None
+    return StreamDelta(content) if content else None
+
+async def relay_sse(chunks: AsyncIterable[bytes]) -> AsyncGenerator[StreamDelta, None]:
+    # Splits the raw response body into lines without decoding it to text first.
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        if b"\n" not in chunk:
+            continue
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            delta = parse_sse_line(line)
+            if delta is not None:
+                yield delta
+                if delta.done:
+                    return
+    if buffer:
+        delta = parse_sse_line(buffer)
+        if delta is not None:
+            yield delta
 
 async def chat_completion_stream(
     model: str, 
     messages: List[Dict[str, str]], 
     site_url: str = "http://localhost:3000", 
-    app_name: str = "Madlen AI"
-) -> AsyncGenerator[str, None]:
+    app_name: str = "Madlen AI",
+    user_id: Optional[str] = None,
+    max_retries: int = 3
+) -> AsyncGenerator[StreamDelta, None]:
     
     if not OPENROUTER_API_KEY:
-        yield json.dumps({"content": "This is a mock response because OPENROUTER_API_KEY is missing.", "done": True})
+        yield StreamDelta("This is a mock response because OPENROUTER_API_KEY is missing.", done=True)
+        return
+
+    key = cache_key(model, messages) if response_cache.enabled else None
+    cached = response_cache.get(key) if key is not None else None
+    if cached is not None:
+        # Replayed in stream-sized pieces so the client sees the same kind of
+        # stream.
+        for piece in replay_chunks(cached):
+            yield StreamDelta(piece)
+        yield StreamDelta(done=True)
         return
 
     headers = {
@@ -225,39 +496,88 @@ async def chat_completion_stream(
         "stream": True
     }
 
+    guard: Optional[Guard] = None
     try:
-        async with httpx.AsyncClient() as client:
-            async with client.stream(
+        for attempt in range(max_retries):
+            if attempt == 0:
+                circuit_breakers.retry_budget.deposit()
+            elif not circuit_breakers.retry_budget.try_spend():
+                yield StreamDelta(done=True, error="Rate limit exceeded. Please try again in a moment.", status=429)
+                return
+            try:
+                guard = circuit_breakers.guard("chat", model)
+            except CircuitOpenError as e:
+                yield StreamDelta(done=True, error=str(_circuit_open(e, model).detail), status=503)
+                return
+
+            waited = time.monotonic()
+            try:
+                await request_scheduler.acquire(user_id)
+            except RateLimitExceeded as e:
+                guard.release()
+                yield StreamDelta(done=True, error=f"Rate limit exceeded. Please try again in {e.retry_after_header}s.", status=429)
+                return
+            llm_metrics.record_queue_wait(model, "chat_stream", time.monotonic() - waited)
+
+            sent_at = time.monotonic()
+
+            async with get_client().stream(
                 "POST",
                 f"{OPENROUTER_URL}/chat/completions",
                 json=payload,
                 headers=headers,
-                timeout=120.0
+                timeout=_timeout(OPENROUTER_STREAM_READ_TIMEOUT)
             ) as response:
                 _update_rate_limit_from_headers(response.headers)
+                if response.status_code != 200:
+                    _record_status(guard, response.status_code)
+
+                if response.status_code == 429 and attempt < max_retries - 1:
+                    # Nothing has been streamed yet, so retrying is invisible to the client.
+                    llm_metrics.record_retry(model, "chat_stream", "rate_limited")
+                    retry_after = _retry_after(response.headers)
+                    if retry_after is not None:
+                        await request_scheduler.pause(retry_after)
+                    else:
+                        await asyncio.sleep(2 ** attempt)
+                    continue
                 
                 if response.status_code != 200:
                     error_text = await response.aread()
-                    yield json.dumps({"error": error_text.decode(), "done": True})
+                    yield StreamDelta(done=True, error=error_text.decode(), status=response.status_code)
                     return
                 
-                async for line in response.aiter_lines():
-                    if line.startswith("data: "):
-                        data = line[6:]
-                        if data == "[DONE]":
-                            yield json.dumps({"done": True})
-                            break
-                        try:
-                            chunk = json.loads(data)
-                            if "choices" in chunk and len(chunk["choices"]) > 0:
-                                delta = chunk["choices"][0].get("delta", {})
-                                content = delta.get("content", "")
-                                if content:
-                                    yield json.dumps({"content": content, "done": False})
-                        except json.JSONDecodeError:
-                            continue
-                            
+                # Health is judged on time to the first token: a model that accepts the
+                # request and then stalls counts as slow, not as fine.
+                chunks: List[str] = []
+                last_at: Optional[float] = None
+                async for delta in relay_sse(response.aiter_bytes()):
+                    guard.success()
+                    if delta.content:
+                        now = time.monotonic()
+                        if last_at is None:
+                            llm_metrics.record_upstream_ttft(model, "chat_stream", now - sent_at)
+                        else:
+                            llm_metrics.record_gap(model, "chat_stream", now - last_at)
+                        last_at = now
+                    if key is not None:
+                        if delta.content:
+                            chunks.append(delta.content)
+                        if delta.done and delta.error is None:
+                            response_cache.put(key, "".join(chunks))
+                    yield delta
+                guard.success()
+                return
+                        
     except httpx.TimeoutException:
-        yield json.dumps({"error": "Request timed out", "done": True})
+        if guard is not None:
+            guard.failure()
+        yield StreamDelta(done=True, error="Request timed out", status=504)
     except Exception as e:
-        yield json.dumps({"error": str(e), "done": True})
+        if guard is not None:
+            guard.failure()
+        yield StreamDelta(done=True, error=str(e))
+    finally:
+        # Closed before any outcome (client gone, hedge lost): no verdict either way.
+        if guard is not None:
+            guard.release()
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import os
+
+PROMPT_COMPLETION_RESERVE = int(os.getenv("PROMPT_COMPLETION_RESERVE", "1024"))
+PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "0"))
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "50000"))
+
+# Rough per-message cost of role/formatting tokens and of one attached image.
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKEN_ESTIMATE = 1000
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    # ~4 bytes per token for English; counting UTF-8 bytes rather than characters
+    # errs on the high side for other scripts, which is the safe direction here.
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+class TokenCounter:
+    # Token counts keyed by message id. Messages never change once stored, so a
+    # count is computed once and reused on every later turn of the conversation.
+    def __init__(self, max_entries: int = TOKEN_COUNT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._counts: "OrderedDict[str, int]" = OrderedDict()
+
+    def count(self, message) -> int:
+        key = getattr(message, "id", None)
+        if key is not None:
+            cached = self._counts.get(key)
+            if cached is not None:
+                self._counts.move_to_end(key)
+                return cached
+
+        tokens = MESSAGE_OVERHEAD_TOKENS + estimate_tokens(message.content or "")
+        if getattr(message, "image_url", None) and message.role == "user":
+            tokens += IMAGE_TOKEN_ESTIMATE
+
+        if key is not None and self.max_entries > 0:
+            self._counts[key] = tokens
+            if len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return tokens
+
+    def forget(self, message_ids):
+        for key in message_ids:
+            self._counts.pop(key, None)
+
+
+token_counter = TokenCounter()
+
+
+def to_openrouter_message(message) -> Dict[str, Any]:
+    if message.image_url and message.role == "user":
+        return {
+            "role": message.role,
+            "content": [
+                {"type": "text", "text": message.content},
+                {"type": "image_url", "image_url": {"url": message.image_url}}
+            ]
+        }
+    return {"role": message.role, "content": message.content}
+
+
+def prompt_budget(context_length: int) -> int:
+    reserve = min(PROMPT_COMPLETION_RESERVE, context_length // 4)
+    budget = context_length - reserve
+    if PROMPT_MAX_TOKENS > 0:
+        budget = min(budget, PROMPT_MAX_TOKENS)
+    return budget
+
+
+def select_messages(messages: List, budget: int, counter: Optional[TokenCounter] = None) -> List:
+    # Walk back from the newest message and keep as many as fit. The newest one is
+    # always sent, even if it alone exceeds the budget, so the user gets the
+    # provider's error instead of an empty prompt.
+    counter = counter or token_counter
+    selected = []
+    used = 0
+    for message in reversed(messages):
+        tokens = counter.count(message)
+        if selected and used + tokens > budget:
+            break
+        selected.append(message)
+        used += tokens
+    selected.reverse()
+    return selected
+
+
+def build_prompt(messages: List, context_length: int, counter: Optional[TokenCounter] = None) -> List[Dict[str, Any]]:
+    selected = select_messages(messages, prompt_budget(context_length), counter)
+    return [to_openrouter_message(m) for m in selected]
@@ -0,0 +1,327 @@
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+import asyncio
+import math
+import os
+import time
+from .shared_state import StateContended, offload, shared_state, submit
+
+OPENROUTER_RATE_LIMIT_RPM = float(os.getenv("OPENROUTER_RATE_LIMIT_RPM", "20"))
+OPENROUTER_RATE_LIMIT_BURST = float(os.getenv("OPENROUTER_RATE_LIMIT_BURST", "5"))
+OPENROUTER_QUEUE_MAX_WAIT = float(os.getenv("OPENROUTER_QUEUE_MAX_WAIT", "15"))
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"rate limited, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+def parse_reset(value: Optional[str], now: Optional[float] = None) -> Optional[float]:
+    # x-ratelimit-reset comes as epoch milliseconds from OpenRouter; epoch seconds
+    # and plain "seconds from now" are accepted too. Returns seconds from now.
+    if value is None:
+        return None
+    try:
+        reset = float(value)
+    except (TypeError, ValueError):
+        return None
+    now = time.time() if now is None else now
+    if reset > 1e12:
+        return max(0.0, reset / 1000 - now)
+    if reset > 1e9:
+        return max(0.0, reset - now)
+    return max(0.0, reset)
+
+
+class TokenBucket:
+    # The bucket itself: tokens, when they were last refilled, until when
+    # OpenRouter asked us to stop and the last x-ratelimit-* values it sent. It
+    # lives in shared_state, so with the mmap or redis backend every worker draws
+    # from the same bucket; each operation is one atomic update of it.
+    def __init__(self, rate: float, capacity: float, state=None, key: str = "openrouter:bucket"):
+        self.rate = rate
+        self.capacity = capacity
+        self.state = state if state is not None else shared_state
+        self.key = key
+
+    def _refill(self, bucket: Optional[Dict[str, Any]], now: float) -> Dict[str, Any]:
+        if bucket is None:
+            return {"tokens": self.capacity, "updated": now, "paused_until": 0.0}
+        bucket = dict(bucket)
+        tokens, updated, paused_until = bucket["tokens"], bucket["updated"], bucket["paused_until"]
+        bucket["updated"] = now
+        if now < paused_until:
+            return bucket
+        if updated < paused_until:
+            # The window OpenRouter reported has reset; allow one request right away.
+            updated = paused_until
+            tokens = max(tokens, 1.0)
+        bucket["tokens"] = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+        return bucket
+
+    def _apply(self, change: Callable[[Dict[str, Any], float], Any], contended: Any = None) -> Any:
+        def update(current):
+            now = self.state.now()
+            bucket = self._refill(current, now)
+            return bucket, change(bucket, now)
+        try:
+            return self.state.update(self.key, update)
+        except StateContended:
+            # Other workers keep winning the race for the bucket: answer as if it
+            # were empty (`contended`) instead of letting a request through that
+            # the shared limit does not know about.
+            return contended
+
+    @staticmethod
+    def _tokens_at_resume(bucket: Dict[str, Any], now: float) -> float:
+        # Tokens available once any pause is over (see _refill).
+        return max(bucket["tokens"], 1.0) if now < bucket["paused_until"] else bucket["tokens"]
+
+    @staticmethod
+    def _extend_pause(bucket: Dict[str, Any], now: float, seconds: float) -> bool:
+        bucket["tokens"] = 0.0
+        if now + seconds > bucket["paused_until"]:
+            bucket["paused_until"] = now + seconds
+            return True
+        return False
+
+    def try_take(self) -> bool:
+        def take(bucket, now):
+            if now >= bucket["paused_until"] and bucket["tokens"] >= 1:
+                bucket["tokens"] -= 1
+                return True
+            return False
+        return self._apply(take, False)
+
+    def give_back(self):
+        def give(bucket, now):
+            bucket["tokens"] = min(self.capacity, bucket["tokens"] + 1)
+        self._apply(give)
+
+    def wait_for(self, needed: float) -> float:
+        # Seconds until `needed` tokens are available, counting any pause.
+        def wait(bucket, now):
+            paused_for = max(0.0, bucket["paused_until"] - now)
+            return paused_for + max(0.0, needed - self._tokens_at_resume(bucket, now)) / self.rate
+        return self._apply(wait, needed / self.rate)
+
+    def observe(self, info: Dict[str, Any], remaining: Optional[float] = None, reset_in: Optional[float] = None) -> bool:
+        # Everything a response's x-ratelimit-* headers change, in one update: the
+        # values are kept for /api/rate-limit, the tokens are clamped to what
+        # OpenRouter says is left and an exhausted window pauses the bucket until
+        # the reset. True when this extended the pause.
+        def observe(bucket, now):
+            bucket["upstream"] = {**bucket.get("upstream", {}), **info}
+            if remaining is None:
+                return False
+            bucket["tokens"] = min(bucket["tokens"], remaining)
+            return remaining <= 0 and bool(reset_in) and self._extend_pause(bucket, now, reset_in)
+        return self._apply(observe, False)
+
+    def pause(self, seconds: float) -> bool:
+        # True when this extended the pause.
+        return self._apply(lambda bucket, now: self._extend_pause(bucket, now, seconds), False)
+
+    def upstream(self) -> Dict[str, Any]:
+        # Last x-ratelimit-* values stored by observe(); a plain read.
+        bucket = self.state.get(self.key)
+        return (bucket or {}).get("upstream", {})
+
+    def snapshot(self) -> Tuple[float, float]:
+        return self._apply(lambda bucket, now: (bucket["tokens"], max(0.0, bucket["paused_until"] - now)), (0.0, 0.0))
+
+
+# Token bucket in front of every OpenRouter call, shared by all workers (see
+# TokenBucket). It refills at OPENROUTER_RATE_LIMIT_RPM and holds at most
+# OPENROUTER_RATE_LIMIT_BURST tokens. The x-ratelimit-* headers of each response
+# clamp the bucket to what OpenRouter says is left, and a 429 or an exhausted
+# window pauses it until the reset. Callers that have to wait queue per user in
+# this process and are served round-robin by one task, so one user's burst cannot
+# starve everyone else. A caller whose estimated wait exceeds
+# OPENROUTER_QUEUE_MAX_WAIT is rejected up front with a Retry-After hint instead
+# of queueing for a slot it would not get in time. Bucket calls go through
+# offload()/submit(), so with Redis they never block the event loop: an upstream
+# request costs one update to take its token and one, not awaited, to apply the
+# headers of its response.
+class RequestScheduler:
+    def __init__(
+        self,
+        rate_per_minute: float = OPENROUTER_RATE_LIMIT_RPM,
+        burst: float = OPENROUTER_RATE_LIMIT_BURST,
+        max_wait: float = OPENROUTER_QUEUE_MAX_WAIT,
+        state=None
+    ):
+        self.bucket = TokenBucket(max(rate_per_minute, 0.001) / 60, max(burst, 1.0), state)
+        self.max_wait = max_wait
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._server: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self.granted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.pauses = 0
+        self.total_wait = 0.0
+        self.served_from_queue = 0
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    @property
+    def capacity(self) -> float:
+        return self.bucket.capacity
+
+    def _waiting(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    async def _estimate_wait(self, user_id: str) -> float:
+        # Round-robin position of a new request from user_id: its own queue plus, from
+        # every other user, at most as many requests as would be served before it.
+        # Other workers draw from the same bucket, so with a shared backend this is
+        # a lower bound.
+        own = len(self._queues.get(user_id, ()))
+        ahead = own + sum(min(len(q), own + 1) for u, q in self._queues.items() if u != user_id)
+        return await offload(self.bucket.state, self.bucket.wait_for, ahead + 1)
+
+    async def acquire(self, user_id: Optional[str] = None):
+        user_id = user_id or "anonymous"
+        now = time.monotonic()
+        if not self._queues and await offload(self.bucket.state, self.bucket.try_take):
+            self.granted += 1
+            return
+
+        estimate = await self._estimate_wait(user_id)
+        if estimate > self.max_wait:
+            self.rejected += 1
+            raise RateLimitExceeded(estimate)
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(future)
+        self.queued += 1
+        self._schedule()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            self._discard(user_id, future)
+            self.timed_out += 1
+            raise RateLimitExceeded(await self._estimate_wait(user_id))
+        except asyncio.CancelledError:
+            self._discard(user_id, future)
+            raise
+        self.total_wait += time.monotonic() - now
+        self.served_from_queue += 1
+
+    def _discard(self, user_id: str, future: asyncio.Future):
+        if future.done() and not future.cancelled():
+            # Granted just as the caller gave up: hand the token to the next in line.
+            self.granted -= 1
+            submit(self.bucket.state, self.bucket.give_back, then=lambda _: self._schedule())
+        else:
+            future.cancel()
+            queue = self._queues.get(user_id)
+            if queue is not None and future in queue:
+                queue.remove(future)
+                if not queue:
+                    del self._queues[user_id]
+        self._schedule()
+
+    async def check(self, user_id: Optional[str] = None):
+        # Raises RateLimitExceeded when acquire() would turn a request from user_id
+        # away right now, without taking a token.
+        estimate = await self._estimate_wait(user_id or "anonymous")
+        if estimate > self.max_wait:
+            self.rejected += 1
+            raise RateLimitExceeded(estimate)
+
+    def _schedule(self):
+        # Wakes the task serving the queues, or starts it.
+        if not self._queues:
+            return
+        if self._server is None or self._server.done():
+            self._wake = asyncio.Event()
+            self._server = asyncio.get_running_loop().create_task(self._serve())
+        self._wake.set()
+
+    async def _serve(self):
+        while self._queues:
+            self._wake.clear()
+            if not await offload(self.bucket.state, self.bucket.try_take):
+                # With a shared bucket another worker may take the token first; the
+                # wait then simply ends again.
+                delay = max(await offload(self.bucket.state, self.bucket.wait_for, 1), 0.001)
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            future = self._next_waiter()
+            if future is None:
+                # Everyone gave up while the bucket was asked.
+                await offload(self.bucket.state, self.bucket.give_back)
+                break
+            self.granted += 1
+            future.set_result(None)
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        while self._queues:
+            user_id, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            if queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            if not future.done():
+                return future
+        return None
+
+    def observe(self, info: Dict[str, Any], remaining: Optional[int] = None, reset_in: Optional[float] = None):
+        # Called with the x-ratelimit-* values of every OpenRouter response. Nothing
+        # waits for it: the response carries on while the bucket is updated.
+        submit(
+            self.bucket.state, self.bucket.observe, info,
+            float(remaining) if remaining is not None else None, reset_in,
+            then=self._paused
+        )
+
+    async def pause(self, seconds: float):
+        # Upstream said no more requests for `seconds` (429 / exhausted window).
+        # Awaited, so the caller's retry already sees the pause.
+        self._paused(await offload(self.bucket.state, self.bucket.pause, seconds))
+
+    def _paused(self, extended: bool):
+        if extended:
+            self.pauses += 1
+            self._schedule()
+
+    def upstream(self) -> Dict[str, Any]:
+        return self.bucket.upstream()
+
+    def stats(self) -> Dict[str, Any]:
+        tokens, paused_for = self.bucket.snapshot()
+        return {
+            "rate_per_minute": round(self.rate * 60, 2),
+            "burst": self.capacity,
+            "tokens": round(tokens, 2),
+            "paused_for": round(paused_for, 2),
+            "waiting": self._waiting(),
+            "users_waiting": len(self._queues),
+            "granted": self.granted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "pauses": self.pauses,
+            "average_wait": round(self.total_wait / self.served_from_queue, 3) if self.served_from_queue else None
+        }
+
+
+request_scheduler = RequestScheduler()
+
+
+def get_scheduler_stats() -> Dict[str, Any]:
+    return request_scheduler.stats()
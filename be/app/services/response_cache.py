@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional
+import hashlib
+import json
+import os
+import time
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_MAX_RESPONSE_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_RESPONSE_BYTES", "65536"))
+RESPONSE_CACHE_REPLAY_CHUNK_CHARS = int(os.getenv("RESPONSE_CACHE_REPLAY_CHUNK_CHARS", "48"))
+
+
+def _normalize_content(content: Any) -> Any:
+    # Whitespace at the edges and line-ending style never change what the model is
+    # asked; everything else (case, inner spacing, image references) does.
+    if isinstance(content, str):
+        return content.replace("\r\n", "\n").strip()
+    if isinstance(content, list):
+        return [
+            {**part, "text": _normalize_content(part["text"])} if isinstance(part, dict) and "text" in part else part
+            for part in content
+        ]
+    return content
+
+
+def cache_key(model: str, messages: List[Dict[str, Any]]) -> bytes:
+    normalized = [
+        {"role": m.get("role"), "content": _normalize_content(m.get("content"))}
+        for m in messages
+    ]
+    raw = json.dumps([model, normalized], sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).digest()
+
+
+def replay_chunks(text: str, size: int = RESPONSE_CACHE_REPLAY_CHUNK_CHARS) -> Iterator[str]:
+    # Splits a cached answer back into stream-sized pieces, preferring to cut
+    # after whitespace so words are not split across frames.
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            cut = text.rfind(" ", start, end)
+            if cut > start:
+                end = cut + 1
+        yield text[start:end]
+        start = end
+
+
+# Exact-match cache of model answers, keyed by model + normalized message list
+# (see cache_key). Opt-in with RESPONSE_CACHE_ENABLED: it only pays off for
+# prompts that repeat verbatim, such as canned first questions, and it returns
+# the same answer every time for as long as the entry lives.
+class ResponseCache:
+    def __init__(
+        self,
+        enabled: bool = RESPONSE_CACHE_ENABLED,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        ttl: float = RESPONSE_CACHE_TTL,
+        max_response_bytes: int = RESPONSE_CACHE_MAX_RESPONSE_BYTES
+    ):
+        self.enabled = enabled and max_entries > 0
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_response_bytes = max_response_bytes
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: bytes) -> Optional[str]:
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, text = entry
+        if time.monotonic() >= expires_at:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return text
+
+    def put(self, key: bytes, text: str):
+        if not self.enabled or not text or len(text.encode()) > self.max_response_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, text)
+        self._bytes += len(text.encode())
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: bytes):
+        _, text = self._entries.pop(key)
+        self._bytes -= len(text.encode())
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None
+        }
+
+
+response_cache = ResponseCache()
+
+
+def get_response_cache_stats() -> Dict[str, Any]:
+    return response_cache.stats()
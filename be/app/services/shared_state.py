@@ -0,0 +1,338 @@
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+import asyncio
+import fcntl
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+# local: this process only (one worker). mmap: a shared memory file, for several
+# workers on one host. redis: any Redis-compatible server, for several hosts.
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "local").lower()
+SHARED_STATE_PATH = os.getenv(
+    "SHARED_STATE_PATH",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "madlen-shared-state")
+)
+SHARED_STATE_SIZE = int(os.getenv("SHARED_STATE_SIZE", str(1024 * 1024)))
+# mmap only: large, rarely written values (the model catalog) live in a second
+# file, SHARED_STATE_PATH + ".bulk", of this size.
+SHARED_STATE_BULK_SIZE = int(os.getenv("SHARED_STATE_BULK_SIZE", str(8 * 1024 * 1024)))
+SHARED_STATE_REDIS_URL = os.getenv("SHARED_STATE_REDIS_URL", "redis://localhost:6379/0")
+SHARED_STATE_PREFIX = os.getenv("SHARED_STATE_PREFIX", "madlen:")
+# Redis calls block their thread for a round trip (see offload); keep them short
+# and fall back to this process's own state when the server does not answer in time.
+SHARED_STATE_REDIS_TIMEOUT = float(os.getenv("SHARED_STATE_REDIS_TIMEOUT", "0.05"))
+# After a failure Redis is not tried again for this many seconds, so an outage
+# costs one timeout per window instead of one per call.
+SHARED_STATE_REDIS_BACKOFF = float(os.getenv("SHARED_STATE_REDIS_BACKOFF", "5"))
+# Optimistic update attempts on a contended key before giving up (StateContended).
+SHARED_STATE_REDIS_MAX_RETRIES = int(os.getenv("SHARED_STATE_REDIS_MAX_RETRIES", "5"))
+
+# An update function gets the current value (None when absent or expired) and
+# returns the value to store (None deletes it) and what update() should return.
+# It may run more than once (Redis retries on conflicts), so it must not have
+# side effects, and values are JSON-compatible so every backend stores the same.
+Updater = Callable[[Any], Tuple[Any, Any]]
+
+
+class StateContended(Exception):
+    # RedisState.update lost the race for its key SHARED_STATE_REDIS_MAX_RETRIES
+    # times in a row and wrote nothing. Callers pick a safe answer themselves:
+    # applying the update to this process's own state instead would hand out
+    # tokens the other workers never see.
+    pass
+
+
+class LocalState:
+    # Plain dict; the default and the fallback of the other backends.
+    name = "local"
+    blocking = False
+
+    def __init__(self):
+        self._values: Dict[str, Tuple[Any, Optional[float]]] = {}
+        self._lock = threading.Lock()
+
+    def now(self) -> float:
+        return time.monotonic()
+
+    def _live(self, key: str, now: float) -> Any:
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and now >= expires_at:
+            del self._values[key]
+            return None
+        return value
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            return self._live(key, self.now())
+
+    def update(self, key: str, fn: Updater, ttl: Optional[float] = None) -> Any:
+        with self._lock:
+            now = self.now()
+            value, result = fn(self._live(key, now))
+            if value is None:
+                self._values.pop(key, None)
+            else:
+                self._values[key] = (value, now + ttl if ttl else None)
+            return result
+
+
+class MmapState:
+    # One JSON document in a memory-mapped file, guarded by flock. Every worker
+    # on the host maps the same file, so each read-modify-write is atomic across
+    # processes. Every operation parses and rewrites the whole document, so it
+    # should only hold small values (see bulk_state); it is capped at `size` and
+    # expired entries are dropped on every write.
+    name = "mmap"
+    blocking = False
+    _HEADER = struct.Struct("<I")
+
+    def __init__(self, path: str = SHARED_STATE_PATH, size: int = SHARED_STATE_SIZE):
+        self.path = path
+        self.size = size
+        self._pid: Optional[int] = None
+        self._fd = -1
+        self._map: Optional[mmap.mmap] = None
+        # flock is per open file description; threads of this process share one.
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # Opened per process, on first use: flock belongs to the open file
+        # description, so a descriptor inherited across fork (gunicorn --preload)
+        # would be shared by all workers and they would no longer exclude each other.
+        # Called with self._lock held.
+        if self._pid == os.getpid():
+            return
+        if self._map is not None:
+            # Inherited from the parent; this process gets its own.
+            self._map.close()
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < self.size:
+                os.ftruncate(self._fd, self.size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, self.size)
+        self._pid = os.getpid()
+
+    def now(self) -> float:
+        return time.time()
+
+    def _read(self) -> Dict[str, Any]:
+        (length,) = self._HEADER.unpack_from(self._map, 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self._map[self._HEADER.size:self._HEADER.size + length])
+        except ValueError:
+            return {}
+
+    def _write(self, doc: Dict[str, Any]):
+        data = json.dumps(doc, separators=(",", ":")).encode()
+        if self._HEADER.size + len(data) > self.size:
+            raise RuntimeError(f"shared state is full ({len(data)} bytes), raise SHARED_STATE_SIZE")
+        self._map[self._HEADER.size:self._HEADER.size + len(data)] = data
+        self._HEADER.pack_into(self._map, 0, len(data))
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                entry = self._read().get(key)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        if entry is None or (entry[1] is not None and self.now() >= entry[1]):
+            return None
+        return entry[0]
+
+    def update(self, key: str, fn: Updater, ttl: Optional[float] = None) -> Any:
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                now = self.now()
+                doc = {k: e for k, e in self._read().items() if e[1] is None or e[1] > now}
+                entry = doc.get(key)
+                value, result = fn(entry[0] if entry is not None else None)
+                if value is None:
+                    doc.pop(key, None)
+                else:
+                    doc[key] = [value, now + ttl if ttl else None]
+                self._write(doc)
+                return result
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class RedisState:
+    # Values are JSON strings under SHARED_STATE_PREFIX. Updates are optimistic
+    # WATCH/MULTI transactions, retried up to SHARED_STATE_REDIS_MAX_RETRIES times
+    # when another worker changed the key in between; a get is one round trip and
+    # an update at least three (WATCH, GET, MULTI/EXEC). Calls are synchronous, so
+    # callers on the event loop go through offload()/submit(), which run them in
+    # a worker thread. When Redis is unreachable the process carries on with its
+    # own LocalState and leaves Redis alone for SHARED_STATE_REDIS_BACKOFF seconds,
+    # so pacing degrades to per-worker instead of failing or stalling requests.
+    name = "redis"
+    blocking = True
+
+    def __init__(self, url: str = SHARED_STATE_REDIS_URL, prefix: str = SHARED_STATE_PREFIX):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("SHARED_STATE_BACKEND=redis requires the redis package (pip install redis)")
+        self._redis = redis
+        self._client = redis.Redis.from_url(
+            url,
+            socket_timeout=SHARED_STATE_REDIS_TIMEOUT,
+            socket_connect_timeout=SHARED_STATE_REDIS_TIMEOUT
+        )
+        self.prefix = prefix
+        self._fallback = LocalState()
+        self._failing_since: Optional[float] = None
+        self._retry_at = 0.0
+        # Updates of one key from this process's threads take turns, so WATCH
+        # retries are only spent on other workers.
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self.errors = 0
+        self.conflicts = 0
+
+    def now(self) -> float:
+        return time.time()
+
+    def _available(self) -> bool:
+        return self._failing_since is None or time.monotonic() >= self._retry_at
+
+    def _failed(self, error: Exception):
+        self.errors += 1
+        self._retry_at = time.monotonic() + SHARED_STATE_REDIS_BACKOFF
+        if self._failing_since is None:
+            self._failing_since = time.monotonic()
+            print(f"Shared state: Redis unavailable ({error}), using per-process state")
+
+    def _recovered(self):
+        if self._failing_since is not None:
+            self._failing_since = None
+            print("Shared state: Redis is back")
+
+    def get(self, key: str) -> Any:
+        if not self._available():
+            return self._fallback.get(key)
+        try:
+            raw = self._client.get(self.prefix + key)
+        except self._redis.RedisError as e:
+            self._failed(e)
+            return self._fallback.get(key)
+        self._recovered()
+        return json.loads(raw) if raw is not None else None
+
+    def update(self, key: str, fn: Updater, ttl: Optional[float] = None) -> Any:
+        if not self._available():
+            return self._fallback.update(key, fn, ttl)
+        name = self.prefix + key
+        try:
+            with self._key_locks.setdefault(key, threading.Lock()), self._client.pipeline() as pipe:
+                for _ in range(SHARED_STATE_REDIS_MAX_RETRIES):
+                    try:
+                        pipe.watch(name)
+                        raw = pipe.get(name)
+                        value, result = fn(json.loads(raw) if raw is not None else None)
+                        pipe.multi()
+                        if value is None:
+                            pipe.delete(name)
+                        elif ttl:
+                            pipe.set(name, json.dumps(value, separators=(",", ":")), px=max(1, int(ttl * 1000)))
+                        else:
+                            pipe.set(name, json.dumps(value, separators=(",", ":")))
+                        pipe.execute()
+                        break
+                    except self._redis.WatchError:
+                        continue
+                else:
+                    self.conflicts += 1
+                    raise StateContended(f"{key} changed on every one of {SHARED_STATE_REDIS_MAX_RETRIES} attempts")
+        except self._redis.RedisError as e:
+            self._failed(e)
+            return self._fallback.update(key, fn, ttl)
+        self._recovered()
+        return result
+
+
+_submitted: Set[asyncio.Task] = set()
+
+
+async def offload(state, fn: Callable[..., Any], *args) -> Any:
+    # Runs a state call (fn is e.g. state.update or a method built on it) without
+    # holding up the event loop: Redis round trips go to a worker thread, local
+    # and mmap calls take microseconds and run inline.
+    if not state.blocking:
+        return fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+
+def submit(state, fn: Callable[..., Any], *args, then: Optional[Callable[[Any], None]] = None):
+    # offload() for calls nobody waits on; `then` gets the result on the event
+    # loop. Local and mmap calls still happen right away, so their effect is seen
+    # by whatever runs next.
+    if not state.blocking:
+        result = fn(*args)
+        if then is not None:
+            then(result)
+        return
+
+    async def run():
+        try:
+            result = await asyncio.to_thread(fn, *args)
+        except Exception as e:
+            print(f"Shared state: background update failed: {e}")
+            return
+        if then is not None:
+            then(result)
+
+    task = asyncio.get_running_loop().create_task(run())
+    _submitted.add(task)
+    task.add_done_callback(_submitted.discard)
+
+
+def _build_state(name: str):
+    if name == "mmap":
+        return MmapState()
+    if name == "redis":
+        return RedisState()
+    return LocalState()
+
+
+def _build_bulk_state(state):
+    # Each Redis key is stored on its own, but an mmap document is rewritten as a
+    # whole, so big values get their own file instead of slowing down every
+    # bucket operation.
+    if isinstance(state, MmapState):
+        return MmapState(state.path + ".bulk", SHARED_STATE_BULK_SIZE)
+    return state
+
+
+shared_state = _build_state(SHARED_STATE_BACKEND)
+bulk_state = _build_bulk_state(shared_state)
+
+
+def get_shared_state_stats() -> Dict[str, Any]:
+    stats: Dict[str, Any] = {"backend": shared_state.name}
+    if isinstance(shared_state, MmapState):
+        stats["path"] = shared_state.path
+        stats["size"] = shared_state.size
+        stats["bulk_path"] = bulk_state.path
+        stats["bulk_size"] = bulk_state.size
+    if isinstance(shared_state, RedisState):
+        stats["errors"] = shared_state.errors
+        stats["conflicts"] = shared_state.conflicts
+        stats["degraded"] = shared_state._failing_since is not None
+    return stats
@@ -0,0 +1,103 @@
+from typing import AsyncGenerator, AsyncIterable, List, Optional
+import anyio
+import asyncio
+import os
+from .openrouter import StreamDelta
+
+SSE_COALESCE_WINDOW_MS = float(os.getenv("SSE_COALESCE_WINDOW_MS", "20"))
+SSE_COALESCE_MAX_BYTES = int(os.getenv("SSE_COALESCE_MAX_BYTES", "1024"))
+
+
+# Sits between chat_completion_stream and the response and merges upstream deltas
+# into fewer SSE frames. The first token goes out immediately so time to first
+# token is unchanged; after that text is held until window_ms has passed since
+# the oldest held delta or max_bytes have piled up, whichever comes first. A
+# done/error event flushes whatever is held and is sent right after it.
+# window_ms <= 0 turns coalescing off and every delta is its own frame.
+class StreamCoalescer:
+    def __init__(self, window_ms: Optional[float] = None, max_bytes: Optional[int] = None):
+        self.window = (SSE_COALESCE_WINDOW_MS if window_ms is None else window_ms) / 1000
+        self.max_bytes = SSE_COALESCE_MAX_BYTES if max_bytes is None else max_bytes
+        self.deltas = 0
+        self.frames = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    async def stream(self, deltas: AsyncIterable[StreamDelta]) -> AsyncGenerator[StreamDelta, None]:
+        if not self.enabled:
+            async for delta in deltas:
+                self.deltas += 1
+                self.frames += 1
+                yield delta
+            return
+
+        loop = asyncio.get_running_loop()
+        iterator = deltas.__aiter__()
+        held: List[str] = []
+        held_bytes = 0
+        deadline: Optional[float] = None
+        sent_first = False
+        # The pending __anext__ runs as a task so the window can expire while the
+        # upstream is silent without cancelling (and so ending) the upstream read.
+        next_delta: Optional[asyncio.Task] = None
+        try:
+            while True:
+                if next_delta is None:
+                    next_delta = asyncio.ensure_future(iterator.__anext__())
+                timeout = None if deadline is None else max(0.0, deadline - loop.time())
+                finished, _ = await asyncio.wait((next_delta,), timeout=timeout)
+                if not finished:
+                    yield self._frame(held)
+                    held, held_bytes, deadline = [], 0, None
+                    continue
+
+                task, next_delta = next_delta, None
+                try:
+                    delta = task.result()
+                except StopAsyncIteration:
+                    break
+                self.deltas += 1
+
+                if delta.done or delta.error is not None:
+                    if held:
+                        yield self._frame(held)
+                    self.frames += 1
+                    yield delta
+                    return
+
+                if not sent_first:
+                    sent_first = True
+                    self.frames += 1
+                    yield delta
+                    continue
+
+                held.append(delta.content)
+                held_bytes += len(delta.content.encode())
+                if held_bytes >= self.max_bytes > 0:
+                    yield self._frame(held)
+                    held, held_bytes, deadline = [], 0, None
+                elif deadline is None:
+                    deadline = loop.time() + self.window
+
+            if held:
+                yield self._frame(held)
+        finally:
+            # Shielded: when the response is cancelled because the client went away,
+            # every unshielded await here would be cancelled again at once, leaving
+            # the pending read unfinished and the upstream request open.
+            with anyio.CancelScope(shield=True):
+                if next_delta is not None:
+                    next_delta.cancel()
+                    try:
+                        await next_delta
+                    except (asyncio.CancelledError, Exception):
+                        pass
+                aclose = getattr(iterator, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+
+    def _frame(self, held: List[str]) -> StreamDelta:
+        self.frames += 1
+        return StreamDelta("".join(held))
@@ -0,0 +1,69 @@
+from opentelemetry import metrics
+from typing import Any, Dict
+
+meter = metrics.get_meter("madlen.llm")
+_aborted_counter = meter.create_counter(
+    "llm.stream.aborted",
+    description="Streamed answers cancelled because the client disconnected"
+)
+_tokens_saved_counter = meter.create_counter(
+    "llm.stream.tokens_saved",
+    unit="{token}",
+    description="Estimated completion tokens not generated thanks to cancelled streams"
+)
+
+
+# Counts streamed answers and how many were cut short by the client. Tokens saved
+# by a cancellation cannot be known exactly; they are estimated as the average
+# length of completed answers minus what the aborted one had already produced.
+class StreamStats:
+    def __init__(self):
+        self.completed = 0
+        self.aborted = 0
+        self.completed_tokens = 0
+        self.aborted_tokens = 0
+        self.tokens_saved = 0
+        self.deltas = 0
+        self.frames = 0
+
+    def average_completion_tokens(self) -> float:
+        return self.completed_tokens / self.completed if self.completed else 0.0
+
+    def record_completed(self, tokens: int):
+        self.completed += 1
+        self.completed_tokens += tokens
+
+    def record_aborted(self, tokens: int, model: str):
+        saved = max(0, round(self.average_completion_tokens()) - tokens)
+        self.aborted += 1
+        self.aborted_tokens += tokens
+        self.tokens_saved += saved
+        _aborted_counter.add(1, {"model": model})
+        if saved:
+            _tokens_saved_counter.add(saved, {"model": model})
+
+    def record_frames(self, deltas: int, frames: int):
+        # Upstream deltas in vs. SSE frames out, to see what coalescing saves.
+        self.deltas += deltas
+        self.frames += frames
+
+    def stats(self) -> Dict[str, Any]:
+        finished = self.completed + self.aborted
+        return {
+            "completed": self.completed,
+            "aborted": self.aborted,
+            "abort_ratio": round(self.aborted / finished, 4) if finished else None,
+            "average_completion_tokens": round(self.average_completion_tokens(), 1),
+            "tokens_before_abort": self.aborted_tokens,
+            "tokens_saved_estimate": self.tokens_saved,
+            "upstream_deltas": self.deltas,
+            "frames_sent": self.frames,
+            "deltas_per_frame": round(self.deltas / self.frames, 2) if self.frames else None
+        }
+
+
+stream_stats = StreamStats()
+
+
+def get_stream_stats() -> Dict[str, Any]:
+    return stream_stats.stats()
@@ -0,0 +1,37 @@
+"""The backend app for load tests: Clerk auth is replaced by an X-Bench-User header.
+
+Never expose this server; anyone can act as any user. Started by
+benchmarks/load_test.py with OPENROUTER_URL pointing at the mock server.
+
+    cd be
+    python -m benchmarks.bench_server --port 8200
+"""
+import argparse
+
+from fastapi import Request
+
+from app.core.auth import get_current_user
+from app.main import app
+
+BENCH_USER_HEADER = "x-bench-user"
+
+
+async def bench_user(request: Request) -> dict:
+    return {"sub": request.headers.get(BENCH_USER_HEADER, "bench-user"), "email": None}
+
+
+app.dependency_overrides[get_current_user] = bench_user
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8200)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
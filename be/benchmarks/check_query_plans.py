@@ -0,0 +1,133 @@
+"""Query-plan regression check for the hot repository queries.
+
+Migrates a database to head, seeds it, captures the SQL that ChatRepository
+actually emits for the session list and message history (including keyset
+pages) and asserts that the planner answers each of them from the composite
+indexes added in migration 0002 rather than a table scan.
+
+    cd be
+    python -m benchmarks.check_query_plans
+
+Uses DATABASE_URL when set (PostgreSQL or SQLite), otherwise a throwaway
+SQLite file. Exits non-zero when a query stops using its index.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+
+if not os.getenv("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.gettempdir()}/madlen-plans-{uuid.uuid4().hex[:8]}.db"
+
+from sqlalchemy import event
+
+from app import models
+from app.core.database import SessionLocal, engine
+from app.main import _upgrade_schema
+from app.repositories.chat_repository import ChatRepository
+
+SESSIONS_INDEX = "ix_chat_sessions_user_id_updated_at"
+MESSAGES_INDEX = "ix_messages_session_id_timestamp"
+
+
+async def seed(users: int = 20, sessions_per_user: int = 20, messages_per_session: int = 30):
+    started = datetime.utcnow() - timedelta(days=1)
+    async with SessionLocal() as db:
+        for u in range(users):
+            user_id = f"plan-user-{u}"
+            db.add(models.User(id=user_id))
+            for s in range(sessions_per_user):
+                session_id = str(uuid.uuid4())
+                db.add(models.ChatSession(
+                    id=session_id, user_id=user_id, title=f"s{s}",
+                    updated_at=started + timedelta(minutes=s)
+                ))
+                for m in range(messages_per_session):
+                    db.add(models.Message(
+                        session_id=session_id, role="user", content=f"message {m}",
+                        timestamp=started + timedelta(minutes=s, seconds=m)
+                    ))
+        await db.commit()
+
+
+async def capture_repository_queries():
+    captured = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            captured.append((statement, parameters))
+
+    sync_engine = engine.sync_engine
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        async with SessionLocal() as db:
+            repo = ChatRepository(db)
+            rows = await repo.get_user_sessions("plan-user-3")
+            session = rows[0][0]
+            page = await repo.get_user_sessions("plan-user-3", limit=5)
+            await repo.get_user_sessions("plan-user-3", limit=5, before=(page[-1][0].updated_at, page[-1][0].id))
+            messages = await repo.get_messages(session.id)
+            await repo.get_messages(session.id, limit=10)
+            await repo.get_messages(session.id, limit=10, before=(messages[-1].timestamp, messages[-1].id))
+    finally:
+        event.remove(sync_engine, "before_cursor_execute", before_cursor_execute)
+
+    return captured
+
+
+async def explain(statement, parameters) -> str:
+    dialect = engine.dialect.name
+    async with engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        driver = raw.driver_connection
+        if dialect == "sqlite":
+            cursor = await driver.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+            return "\n".join(row[-1] for row in await cursor.fetchall())
+        if dialect == "postgresql":
+            # Seeded tables are small enough for a seq scan to win on cost; disable it
+            # so the check asserts that the index is usable for the query shape.
+            await driver.execute("SET enable_seqscan = off")
+            rows = await driver.fetch(f"EXPLAIN {statement}", *parameters)
+            return "\n".join(row[0] for row in rows)
+    raise SystemExit(f"Query plan check does not support the {dialect} dialect")
+
+
+def expected_index(statement: str):
+    lowered = statement.lower()
+    if "from chat_sessions" in lowered and "chat_sessions.user_id" in lowered:
+        return [SESSIONS_INDEX, MESSAGES_INDEX]
+    if "from messages" in lowered and "messages.session_id" in lowered:
+        return [MESSAGES_INDEX]
+    return None
+
+
+async def main() -> int:
+    async with engine.begin() as conn:
+        await conn.run_sync(_upgrade_schema)
+    await seed()
+
+    failures = 0
+    checked = 0
+    for statement, parameters in await capture_repository_queries():
+        indexes = expected_index(statement)
+        if not indexes:
+            continue
+        checked += 1
+        plan = await explain(statement, parameters)
+        missing = [ix for ix in indexes if ix not in plan]
+        first_line = " ".join(statement.split())[:90]
+        if missing:
+            failures += 1
+            print(f"FAIL  {first_line}...\n      missing {', '.join(missing)}\n{plan}\n")
+        else:
+            print(f"ok    {first_line}...")
+
+    await engine.dispose()
+    print(f"{checked - failures}/{checked} queries use their indexes")
+    return 1 if failures or not checked else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
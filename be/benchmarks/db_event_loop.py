@@ -0,0 +1,139 @@
+"""Event-loop stall benchmark: token latency on concurrent streams while DB queries run.
+
+Simulates N open SSE streams, each emitting a token every TOKEN_INTERVAL_MS, while
+Q workers keep loading a long chat history. In ``sync`` mode the queries go through
+a blocking SQLAlchemy engine called straight from the event loop (the old data
+path); in ``async`` mode they go through ChatRepository on the AsyncEngine.
+The reported latency is how late each token was compared to its schedule.
+
+    cd be
+    python -m benchmarks.db_event_loop --streams 200 --workers 8 --seconds 10
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file (needs aiosqlite).
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+if not os.getenv("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.gettempdir()}/madlen-bench-{uuid.uuid4().hex[:8]}.db"
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+
+from app import models
+from app.core.database import Base, DATABASE_URL, SessionLocal, engine
+from app.repositories.chat_repository import ChatRepository
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def seed(history: int) -> str:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    user_id = f"bench-{uuid.uuid4().hex[:8]}"
+    session_id = str(uuid.uuid4())
+    started = datetime.utcnow() - timedelta(hours=1)
+    async with SessionLocal() as db:
+        db.add(models.User(id=user_id))
+        db.add(models.ChatSession(id=session_id, user_id=user_id, title="bench"))
+        for i in range(history):
+            db.add(models.Message(
+                session_id=session_id,
+                role="user" if i % 2 == 0 else "assistant",
+                content=("lorem ipsum dolor sit amet " * 40),
+                timestamp=started + timedelta(seconds=i)
+            ))
+        await db.commit()
+    return session_id
+
+
+async def token_stream(interval: float, deadline: float, lateness: list):
+    next_tick = time.perf_counter() + interval
+    while next_tick < deadline:
+        await asyncio.sleep(max(0.0, next_tick - time.perf_counter()))
+        lateness.append((time.perf_counter() - next_tick) * 1000)
+        next_tick += interval
+
+
+async def async_worker(session_id: str, deadline: float, counter: list):
+    while time.perf_counter() < deadline:
+        async with SessionLocal() as db:
+            await ChatRepository(db).get_messages(session_id)
+        counter[0] += 1
+
+
+async def blocking_worker(sync_engine, session_id: str, deadline: float, counter: list):
+    while time.perf_counter() < deadline:
+        with Session(sync_engine) as db:
+            db.execute(
+                select(models.Message)
+                .filter(models.Message.session_id == session_id)
+                .order_by(models.Message.timestamp.asc())
+            ).scalars().all()
+        counter[0] += 1
+        await asyncio.sleep(0)
+
+
+async def run(mode: str, session_id: str, args) -> dict:
+    interval = args.token_interval_ms / 1000
+    deadline = time.perf_counter() + args.seconds
+    lateness: list = []
+    queries = [0]
+
+    sync_engine = create_engine(DATABASE_URL) if mode == "sync" else None
+    if mode == "sync":
+        workers = [blocking_worker(sync_engine, session_id, deadline, queries) for _ in range(args.workers)]
+    else:
+        workers = [async_worker(session_id, deadline, queries) for _ in range(args.workers)]
+
+    streams = [token_stream(interval, deadline, lateness) for _ in range(args.streams)]
+    await asyncio.gather(*streams, *workers)
+    if sync_engine is not None:
+        sync_engine.dispose()
+
+    return {
+        "mode": mode,
+        "tokens": len(lateness),
+        "queries/s": queries[0] / args.seconds,
+        "p50_ms": statistics.median(lateness) if lateness else 0.0,
+        "p99_ms": percentile(lateness, 99),
+        "max_ms": max(lateness) if lateness else 0.0,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--history", type=int, default=500, help="messages in the seeded session")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--token-interval-ms", type=float, default=20.0)
+    parser.add_argument("--mode", choices=["sync", "async", "both"], default="both")
+    args = parser.parse_args()
+
+    session_id = await seed(args.history)
+    modes = ["sync", "async"] if args.mode == "both" else [args.mode]
+
+    print(f"{'mode':<6} {'tokens':>8} {'queries/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for mode in modes:
+        r = await run(mode, session_id, args)
+        print(f"{r['mode']:<6} {r['tokens']:>8} {r['queries/s']:>10.1f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['max_ms']:>8.2f}")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,474 @@
+"""End-to-end load test of the backend against a local mock OpenRouter.
+
+Starts benchmarks.mock_openrouter and benchmarks.bench_server as subprocesses
+(no network, no API key, no Clerk), seeds the database and runs scripted
+scenarios over real HTTP:
+
+* ``streams``: many concurrent SSE chats; time to first token, full answer time
+  and the backend's extra memory per open stream
+* ``sessions``: session list refreshes by many users with seeded sessions
+* ``history``: chat turns and history page loads on long conversations
+* ``export``: json / gzipped ndjson exports of long sessions and the zip of all
+* ``abort``: concurrent SSE chats whose clients hang up after --abort-after
+  frames; fails (counts errors) unless every upstream stream at the mock is
+  closed within --abort-grace seconds
+
+For every scenario it reports req/s, p50/p99 latency and errors; --output saves
+the numbers as JSON to compare a change against a baseline.
+
+    cd be
+    python -m benchmarks.load_test --streams 200 --ttft-ms 300 --tokens-per-second 60
+    python -m benchmarks.load_test --scenario sessions --seconds 20 --output before.json
+
+Uses DATABASE_URL when set (use Postgres for meaningful numbers), otherwise a
+throwaway SQLite file (needs aiosqlite). The mock's latency and failure knobs
+(see benchmarks/mock_openrouter.py) are accepted here too; --app-env passes
+extra settings to the backend, e.g. --app-env WRITE_BEHIND_ENABLED=true.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+if not os.getenv("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.gettempdir()}/madlen-load-{uuid.uuid4().hex[:8]}.db"
+
+import httpx
+from sqlalchemy import insert
+
+from app import models
+from app.core.database import SessionLocal, engine
+from benchmarks import mock_openrouter
+from benchmarks.bench_server import BENCH_USER_HEADER
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("streams", "sessions", "history", "export", "abort")
+MODEL = mock_openrouter.MODELS[0]["id"]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    # Linux only; memory figures are left out elsewhere.
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class Result:
+    def __init__(self, scenario: str):
+        self.scenario = scenario
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.seconds = 0.0
+        self.extra: Dict[str, float] = {}
+
+    def summary(self) -> dict:
+        return {
+            "scenario": self.scenario,
+            "requests": len(self.latencies) + self.errors,
+            "errors": self.errors,
+            "req/s": round(len(self.latencies) / self.seconds, 2) if self.seconds else 0.0,
+            "p50_ms": round(percentile(self.latencies, 50) * 1000, 2),
+            "p99_ms": round(percentile(self.latencies, 99) * 1000, 2),
+            **{k: round(v, 2) for k, v in self.extra.items()},
+        }
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.mock_port = free_port()
+        self.app_port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.app_port}"
+        self.processes: List[subprocess.Popen] = []
+        self.app_pid: Optional[int] = None
+
+    def _spawn(self, module: str, argv: List[str], env: dict) -> subprocess.Popen:
+        process = subprocess.Popen(
+            [sys.executable, "-m", module, *argv],
+            cwd=BACKEND_DIR,
+            env={**os.environ, **env},
+        )
+        self.processes.append(process)
+        return process
+
+    async def start(self):
+        a = self.args
+        self._spawn("benchmarks.mock_openrouter", [
+            "--port", str(self.mock_port),
+            "--ttft-ms", str(a.ttft_ms),
+            "--tokens-per-second", str(a.tokens_per_second),
+            "--tokens", str(a.tokens),
+            "--jitter", str(a.jitter),
+            "--rate-limit-rpm", str(a.rate_limit_rpm),
+            "--error-rate", str(a.error_rate),
+            "--model-429-rate", str(a.model_429_rate),
+        ], {})
+        app_env = {
+            "OPENROUTER_URL": f"http://127.0.0.1:{self.mock_port}/api/v1",
+            "OPENROUTER_API_KEY": "mock",
+            # The mock enforces its own limit when asked to; the client-side pacing
+            # would otherwise cap every scenario at the production default.
+            "OPENROUTER_RATE_LIMIT_RPM": "1000000",
+            "OPENROUTER_RATE_LIMIT_BURST": "100000",
+            "OPENROUTER_HTTP2": "false",
+        }
+        for item in a.app_env:
+            key, _, value = item.partition("=")
+            app_env[key] = value
+        self.app_pid = self._spawn("benchmarks.bench_server", ["--port", str(self.app_port)], app_env).pid
+
+        async with httpx.AsyncClient() as client:
+            for url in (f"http://127.0.0.1:{self.mock_port}/stats", f"{self.base_url}/"):
+                deadline = time.monotonic() + 30
+                while True:
+                    try:
+                        if (await client.get(url)).status_code == 200:
+                            break
+                    except httpx.TransportError:
+                        pass
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"{url} did not come up")
+                    await asyncio.sleep(0.2)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def client(self, concurrency: int) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=httpx.Timeout(120.0),
+            limits=httpx.Limits(max_connections=concurrency + 8, max_keepalive_connections=concurrency + 8),
+        )
+
+
+async def seed(users: int, sessions_per_user: int, messages_per_session: int, prefix: str) -> Dict[str, List[str]]:
+    # Written straight to the database; going through the API would make seeding
+    # the slowest part of every run.
+    started = datetime.utcnow() - timedelta(days=1)
+    sessions: Dict[str, List[str]] = {}
+    session_rows, message_rows = [], []
+    for u in range(users):
+        user_id = f"{prefix}-{u}"
+        sessions[user_id] = []
+        for s in range(sessions_per_user):
+            session_id = str(uuid.uuid4())
+            sessions[user_id].append(session_id)
+            at = started + timedelta(minutes=s)
+            session_rows.append({"id": session_id, "user_id": user_id, "title": f"Session {s}", "created_at": at, "updated_at": at})
+            for m in range(messages_per_session):
+                message_rows.append({
+                    "id": str(uuid.uuid4()),
+                    "session_id": session_id,
+                    "role": "user" if m % 2 == 0 else "assistant",
+                    "content": ("lorem ipsum dolor sit amet " * 12).strip(),
+                    "timestamp": at + timedelta(seconds=m),
+                    "model": MODEL if m % 2 else None,
+                })
+
+    async with SessionLocal() as db:
+        await db.execute(insert(models.User), [{"id": user_id} for user_id in sessions])
+        if session_rows:
+            await db.execute(insert(models.ChatSession), session_rows)
+        for i in range(0, len(message_rows), 5000):
+            await db.execute(insert(models.Message), message_rows[i:i + 5000])
+        await db.commit()
+    return sessions
+
+
+async def stream_chat(client: httpx.AsyncClient, user_id: str, session_id: str, result: Result, ttfts: List[float]):
+    started = time.perf_counter()
+    first = None
+    try:
+        async with client.stream(
+            "POST", f"/api/sessions/{session_id}/chat/stream",
+            json={"message": "Tell me something about load testing.", "model": MODEL},
+            headers={BENCH_USER_HEADER: user_id},
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                result.errors += 1
+                return
+            failed = False
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                if first is None and '"content"' in line:
+                    first = time.perf_counter()
+                if '"error"' in line:
+                    failed = True
+        if failed:
+            result.errors += 1
+            return
+    except httpx.HTTPError:
+        result.errors += 1
+        return
+    result.latencies.append(time.perf_counter() - started)
+    if first is not None:
+        ttfts.append(first - started)
+
+
+async def run_streams(harness: Harness, args) -> Result:
+    result = Result("streams")
+    ttfts: List[float] = []
+    users = [f"stream-{uuid.uuid4().hex[:6]}-{i}" for i in range(args.streams)]
+    async with harness.client(args.streams) as client:
+        sessions = []
+        for user_id in users:
+            response = await client.post("/api/sessions", headers={BENCH_USER_HEADER: user_id})
+            sessions.append(response.json()["id"])
+
+        baseline = rss_bytes(harness.app_pid)
+        peak = [baseline or 0]
+        done = asyncio.Event()
+
+        async def sample_memory():
+            while not done.is_set():
+                rss = rss_bytes(harness.app_pid)
+                if rss:
+                    peak[0] = max(peak[0], rss)
+                await asyncio.sleep(0.05)
+
+        sampler = asyncio.create_task(sample_memory())
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            await asyncio.gather(*(stream_chat(client, u, s, result, ttfts) for u, s in zip(users, sessions)))
+        result.seconds = time.perf_counter() - started
+        done.set()
+        await sampler
+
+    result.extra["ttft_p50_ms"] = percentile(ttfts, 50) * 1000
+    result.extra["ttft_p99_ms"] = percentile(ttfts, 99) * 1000
+    if baseline:
+        result.extra["rss_mb"] = peak[0] / 2 ** 20
+        result.extra["kb_per_stream"] = max(0, peak[0] - baseline) / 1024 / args.streams
+    return result
+
+
+async def timed_requests(harness: Harness, name: str, concurrency: int, seconds: float, make_request) -> Result:
+    # `concurrency` workers issue make_request(client, worker) back to back for `seconds`.
+    result = Result(name)
+    deadline = time.perf_counter() + seconds
+    async with harness.client(concurrency) as client:
+        async def worker(index: int):
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    response = await make_request(client, index)
+                    ok = response.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    result.latencies.append(time.perf_counter() - started)
+                else:
+                    result.errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        result.seconds = time.perf_counter() - started
+    return result
+
+
+async def run_sessions(harness: Harness, args) -> Result:
+    sessions = await seed(args.users, args.sessions_per_user, 2, f"list-{uuid.uuid4().hex[:6]}")
+    users = list(sessions)
+
+    async def refresh(client, index):
+        return await client.get("/api/sessions?limit=20", headers={BENCH_USER_HEADER: users[index % len(users)]})
+
+    return await timed_requests(harness, "sessions", args.concurrency, args.seconds, refresh)
+
+
+async def run_history(harness: Harness, args) -> List[Result]:
+    sessions = await seed(args.concurrency, 1, args.history, f"hist-{uuid.uuid4().hex[:6]}")
+    pairs = [(user_id, ids[0]) for user_id, ids in sessions.items()]
+
+    async def page(client, index):
+        user_id, session_id = pairs[index % len(pairs)]
+        return await client.get(f"/api/sessions/{session_id}/messages?limit=50", headers={BENCH_USER_HEADER: user_id})
+
+    pages = await timed_requests(harness, "history_page", args.concurrency, args.seconds, page)
+
+    turns = Result("history_chat")
+    ttfts: List[float] = []
+    async with harness.client(len(pairs)) as client:
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            await asyncio.gather(*(stream_chat(client, u, s, turns, ttfts) for u, s in pairs))
+        turns.seconds = time.perf_counter() - started
+    turns.extra["ttft_p50_ms"] = percentile(ttfts, 50) * 1000
+    turns.extra["ttft_p99_ms"] = percentile(ttfts, 99) * 1000
+    return [pages, turns]
+
+
+async def run_export(harness: Harness, args) -> List[Result]:
+    concurrency = max(1, args.concurrency // 4)
+    sessions = await seed(concurrency, 3, args.history, f"export-{uuid.uuid4().hex[:6]}")
+    pairs = [(user_id, ids[0]) for user_id, ids in sessions.items()]
+    results = []
+    for name, path in (
+        ("export_json", "/api/sessions/{id}/export?format=json"),
+        ("export_ndjson_gz", "/api/sessions/{id}/export?format=ndjson&gzip=true"),
+        ("export_zip", "/api/sessions/export?format=json"),
+    ):
+        received = [0]
+
+        async def export(client, index, path=path):
+            user_id, session_id = pairs[index % len(pairs)]
+            response = await client.get(path.format(id=session_id), headers={BENCH_USER_HEADER: user_id})
+            received[0] += len(response.content)
+            return response
+
+        result = await timed_requests(harness, name, concurrency, args.seconds, export)
+        result.extra["mb/s"] = received[0] / 2 ** 20 / result.seconds if result.seconds else 0.0
+        results.append(result)
+    return results
+
+
+async def abort_chat(client: httpx.AsyncClient, user_id: str, session_id: str, frames: int, result: Result):
+    # Reads `frames` content frames, then drops the connection mid-answer.
+    started = time.perf_counter()
+    seen = 0
+    try:
+        async with client.stream(
+            "POST", f"/api/sessions/{session_id}/chat/stream",
+            json={"message": "Tell me something about load testing.", "model": MODEL},
+            headers={BENCH_USER_HEADER: user_id},
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                result.errors += 1
+                return
+            async for line in response.aiter_lines():
+                if line.startswith("data:") and '"content"' in line:
+                    seen += 1
+                    if seen >= frames:
+                        break
+    except httpx.HTTPError:
+        result.errors += 1
+        return
+    if seen < frames:
+        # The answer ended before the abort point; raise --tokens.
+        result.errors += 1
+        return
+    result.latencies.append(time.perf_counter() - started)
+
+
+async def run_abort(harness: Harness, args) -> Result:
+    result = Result("abort")
+    users = [f"abort-{uuid.uuid4().hex[:6]}-{i}" for i in range(args.streams)]
+    async with harness.client(args.streams) as client:
+        sessions = []
+        for user_id in users:
+            response = await client.post("/api/sessions", headers={BENCH_USER_HEADER: user_id})
+            sessions.append(response.json()["id"])
+
+        started = time.perf_counter()
+        await asyncio.gather(*(abort_chat(client, u, s, args.abort_after, result) for u, s in zip(users, sessions)))
+        result.seconds = time.perf_counter() - started
+
+    # Every abandoned answer must cancel its upstream request: wait for the mock
+    # to report no open streams.
+    aborted_at = time.perf_counter()
+    deadline = aborted_at + args.abort_grace
+    async with httpx.AsyncClient() as client:
+        while True:
+            stats = (await client.get(f"http://127.0.0.1:{harness.mock_port}/stats")).json()
+            if stats["streams_open"] == 0 or time.perf_counter() > deadline:
+                break
+            await asyncio.sleep(0.05)
+    result.extra["upstream_close_ms"] = (time.perf_counter() - aborted_at) * 1000
+    result.extra["upstream_left_open"] = stats["streams_open"]
+    if stats["streams_open"]:
+        print(f"abort: {stats['streams_open']} upstream streams still open after {args.abort_grace}s", flush=True)
+        result.errors += stats["streams_open"]
+    return result
+
+
+def print_table(summaries: List[dict]):
+    extras = sorted({k for s in summaries for k in s} - {"scenario", "requests", "errors", "req/s", "p50_ms", "p99_ms"})
+    columns = ["scenario", "requests", "errors", "req/s", "p50_ms", "p99_ms", *extras]
+    print("  ".join(f"{c:>16}" if i else f"{c:<18}" for i, c in enumerate(columns)))
+    for s in summaries:
+        print("  ".join(f"{str(s.get(c, '')):>16}" if i else f"{s[c]:<18}" for i, c in enumerate(columns)))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=[*SCENARIOS, "all"], default="all")
+    parser.add_argument("--streams", type=int, default=100, help="concurrent SSE streams")
+    parser.add_argument("--rounds", type=int, default=1, help="chat turns per stream")
+    parser.add_argument("--concurrency", type=int, default=20, help="workers for request/response scenarios")
+    parser.add_argument("--seconds", type=float, default=10.0, help="duration of request/response scenarios")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--sessions-per-user", type=int, default=40)
+    parser.add_argument("--history", type=int, default=400, help="messages per long session")
+    parser.add_argument("--abort-after", type=int, default=4, help="frames read before an abort scenario client hangs up")
+    parser.add_argument("--abort-grace", type=float, default=2.0, help="seconds allowed for upstream streams to close after aborts")
+    parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE")
+    parser.add_argument("--output", help="write the results as JSON here")
+    mock_openrouter.add_arguments(parser)
+    args = parser.parse_args()
+
+    harness = Harness(args)
+    await harness.start()
+    summaries = []
+    try:
+        scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+        for scenario in scenarios:
+            print(f"running {scenario}...", flush=True)
+            if scenario == "streams":
+                results = [await run_streams(harness, args)]
+            elif scenario == "sessions":
+                results = [await run_sessions(harness, args)]
+            elif scenario == "history":
+                results = await run_history(harness, args)
+            elif scenario == "abort":
+                results = [await run_abort(harness, args)]
+            else:
+                results = await run_export(harness, args)
+            summaries.extend(r.summary() for r in results)
+    finally:
+        harness.stop()
+        await engine.dispose()
+
+    print_table(summaries)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": summaries}, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
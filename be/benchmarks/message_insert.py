@@ -0,0 +1,121 @@
+"""Message insert throughput: per-message commits vs. the write-behind queue.
+
+C concurrent writers each insert messages into their own session. In ``direct``
+mode every message goes through ChatRepository.add_message (one add + commit +
+refresh per message, the path used when WRITE_BEHIND_ENABLED is off); in
+``batched`` mode they are handed to a MessageWriter, which flushes them as
+multi-row INSERTs of up to --batch-size rows or every --flush-interval-ms.
+Throughput for ``batched`` includes draining the queue, so every message counted
+is committed.
+
+    cd be
+    python -m benchmarks.message_insert --writers 50 --messages 40
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file (needs aiosqlite).
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+
+if not os.getenv("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.gettempdir()}/madlen-bench-{uuid.uuid4().hex[:8]}.db"
+
+from sqlalchemy import func, select
+
+from app import models
+from app.core.database import Base, SessionLocal, engine
+from app.repositories.chat_repository import ChatRepository
+from app.services.chat_service import _new_message
+from app.services.message_writer import MessageWriter
+
+CONTENT = "lorem ipsum dolor sit amet " * 20
+
+
+async def seed(writers: int) -> list:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    user_id = f"bench-{uuid.uuid4().hex[:8]}"
+    session_ids = [str(uuid.uuid4()) for _ in range(writers)]
+    async with SessionLocal() as db:
+        db.add(models.User(id=user_id))
+        for session_id in session_ids:
+            db.add(models.ChatSession(id=session_id, user_id=user_id, title="bench"))
+        await db.commit()
+    return session_ids
+
+
+async def direct_writer(session_id: str, count: int):
+    async with SessionLocal() as db:
+        repository = ChatRepository(db)
+        session = await db.get(models.ChatSession, session_id)
+        for i in range(count):
+            await repository.add_message(session_id, "user" if i % 2 == 0 else "assistant", CONTENT, session=session)
+
+
+async def batched_writer(writer: MessageWriter, session_id: str, count: int):
+    for i in range(count):
+        await writer.enqueue(_new_message(session_id, "user" if i % 2 == 0 else "assistant", CONTENT))
+
+
+async def count_messages(session_ids: list) -> int:
+    async with SessionLocal() as db:
+        result = await db.execute(
+            select(func.count()).select_from(models.Message).where(models.Message.session_id.in_(session_ids))
+        )
+        return result.scalar_one()
+
+
+async def run(mode: str, args) -> dict:
+    session_ids = await seed(args.writers)
+    started = time.perf_counter()
+    if mode == "direct":
+        await asyncio.gather(*(direct_writer(s, args.messages) for s in session_ids))
+        batches = args.writers * args.messages
+    else:
+        writer = MessageWriter(
+            max_queue=args.queue_size,
+            batch_size=args.batch_size,
+            flush_interval=args.flush_interval_ms / 1000
+        )
+        await writer.start()
+        await asyncio.gather(*(batched_writer(writer, s, args.messages) for s in session_ids))
+        await writer.stop()
+        batches = writer.batches
+    elapsed = time.perf_counter() - started
+
+    written = await count_messages(session_ids)
+    return {
+        "mode": mode,
+        "messages": written,
+        "transactions": batches,
+        "seconds": elapsed,
+        "inserts/s": written / elapsed if elapsed else 0.0,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=50, help="concurrent sessions being written")
+    parser.add_argument("--messages", type=int, default=40, help="messages per writer")
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--flush-interval-ms", type=float, default=50.0)
+    parser.add_argument("--queue-size", type=int, default=10000)
+    parser.add_argument("--mode", choices=["direct", "batched", "both"], default="both")
+    args = parser.parse_args()
+
+    modes = ["direct", "batched"] if args.mode == "both" else [args.mode]
+
+    print(f"{'mode':<8} {'messages':>9} {'txns':>7} {'seconds':>8} {'inserts/s':>10}")
+    for mode in modes:
+        r = await run(mode, args)
+        print(f"{r['mode']:<8} {r['messages']:>9} {r['transactions']:>7} {r['seconds']:>8.2f} {r['inserts/s']:>10.1f}")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
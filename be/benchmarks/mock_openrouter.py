@@ -0,0 +1,208 @@
+"""Local stand-in for the parts of the OpenRouter API the backend uses.
+
+Serves ``GET /models`` and ``POST /chat/completions`` (streamed and buffered)
+with configurable latency and failures, so the backend can be load tested with
+no network and no API key:
+
+* ``--ttft-ms``: delay before the first token (``--jitter`` adds +-N% noise)
+* ``--tokens-per-second`` / ``--tokens``: pace and length of every answer
+* ``--rate-limit-rpm``: account-wide limit; requests over it get a 429 with
+  Retry-After and every response carries x-ratelimit-* headers
+* ``--error-rate`` / ``--model-429-rate``: share of requests answered with a
+  502, or with a header-less 429 as returned by an overloaded provider
+
+Point the backend at it with OPENROUTER_URL and any OPENROUTER_API_KEY:
+
+    cd be
+    python -m benchmarks.mock_openrouter --port 8100 --ttft-ms 300 --tokens-per-second 60
+    OPENROUTER_URL=http://127.0.0.1:8100/api/v1 OPENROUTER_API_KEY=mock uvicorn app.main:app
+
+benchmarks/load_test.py starts it on its own.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import deque
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from app.core.streaming import DisconnectAwareStreamingResponse
+
+MODELS = [
+    {"id": "mock/fast:free", "name": "Mock Fast", "context_length": 131072},
+    {"id": "mock/medium:free", "name": "Mock Medium", "context_length": 65536},
+    {"id": "mock/small:free", "name": "Mock Small", "context_length": 8192},
+]
+
+WORDS = "the quick brown fox jumps over a lazy dog while streaming tokens to many users".split()
+
+
+class MockSettings:
+    def __init__(self, ttft_ms=300.0, tokens_per_second=50.0, tokens=120, jitter=0.1,
+                 rate_limit_rpm=0.0, error_rate=0.0, model_429_rate=0.0, seed=None):
+        self.ttft_ms = ttft_ms
+        self.tokens_per_second = tokens_per_second
+        self.tokens = tokens
+        self.jitter = jitter
+        self.rate_limit_rpm = rate_limit_rpm
+        self.error_rate = error_rate
+        self.model_429_rate = model_429_rate
+        self.random = random.Random(seed)
+
+
+class MockOpenRouter:
+    def __init__(self, settings: MockSettings):
+        self.settings = settings
+        self._window = deque()
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.streams_open = 0
+        self.streams_aborted = 0
+        self.app = Starlette(routes=[
+            Route("/api/v1/models", self.models, methods=["GET"]),
+            Route("/api/v1/chat/completions", self.chat_completions, methods=["POST"]),
+            Route("/stats", self.stats, methods=["GET"]),
+        ])
+
+    def _jittered(self, seconds: float) -> float:
+        spread = self.settings.jitter
+        return max(0.0, seconds * (1 + self.settings.random.uniform(-spread, spread)))
+
+    def _rate_limit(self):
+        # Sliding one-minute window; returns (headers, seconds until a slot frees up
+        # or None when the request is allowed).
+        rpm = self.settings.rate_limit_rpm
+        if not rpm:
+            return {}, None
+        now = time.time()
+        while self._window and self._window[0] <= now - 60:
+            self._window.popleft()
+        reset_at = (self._window[0] + 60) if self._window else now + 60
+        if len(self._window) >= rpm:
+            headers = {
+                "x-ratelimit-limit": str(int(rpm)),
+                "x-ratelimit-remaining": "0",
+                "x-ratelimit-reset": str(int(reset_at * 1000)),
+                "retry-after": str(max(1, round(reset_at - now))),
+            }
+            return headers, reset_at - now
+        self._window.append(now)
+        return {
+            "x-ratelimit-limit": str(int(rpm)),
+            "x-ratelimit-remaining": str(int(rpm - len(self._window))),
+            "x-ratelimit-reset": str(int(reset_at * 1000)),
+        }, None
+
+    async def models(self, request: Request):
+        data = [{**m, "pricing": {"prompt": "0", "completion": "0"}} for m in MODELS]
+        return JSONResponse({"data": data})
+
+    async def chat_completions(self, request: Request):
+        self.requests += 1
+        body = await request.json()
+        headers, wait = self._rate_limit()
+        if wait is not None:
+            self.rate_limited += 1
+            return JSONResponse({"error": {"code": 429, "message": "Rate limit exceeded"}}, status_code=429, headers=headers)
+
+        roll = self.settings.random.random()
+        if roll < self.settings.error_rate:
+            self.errors += 1
+            return JSONResponse({"error": {"code": 502, "message": "Upstream provider error"}}, status_code=502, headers=headers)
+        if roll < self.settings.error_rate + self.settings.model_429_rate:
+            self.rate_limited += 1
+            return JSONResponse({"error": {"code": 429, "message": "Provider overloaded"}}, status_code=429)
+
+        model = body.get("model", MODELS[0]["id"])
+        words = [self.settings.random.choice(WORDS) for _ in range(self.settings.tokens)]
+        if not body.get("stream"):
+            await asyncio.sleep(self._jittered(self.settings.ttft_ms / 1000 + len(words) / self.settings.tokens_per_second))
+            return JSONResponse({
+                "id": "gen-mock",
+                "model": model,
+                "choices": [{"message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+            }, headers=headers)
+        # Closes the generator as soon as the backend hangs up, like a real upstream
+        # that stops generating, so /stats shows whether aborts reach OpenRouter.
+        return DisconnectAwareStreamingResponse(self._stream(model, words), media_type="text/event-stream", headers=headers)
+
+    async def _stream(self, model: str, words):
+        self.streams_open += 1
+        finished = False
+        try:
+            yield b": OPENROUTER PROCESSING\n\n"
+            await asyncio.sleep(self._jittered(self.settings.ttft_ms / 1000))
+            interval = 1 / self.settings.tokens_per_second if self.settings.tokens_per_second > 0 else 0
+            next_at = time.monotonic()
+            for i, word in enumerate(words):
+                chunk = {
+                    "id": "gen-mock",
+                    "model": model,
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}],
+                }
+                yield b"data: " + json.dumps(chunk).encode() + b"\n\n"
+                next_at += self._jittered(interval)
+                await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+            yield b"data: [DONE]\n\n"
+            finished = True
+        finally:
+            self.streams_open -= 1
+            if not finished:
+                self.streams_aborted += 1
+
+    async def stats(self, request: Request):
+        return JSONResponse({
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "errors": self.errors,
+            "streams_open": self.streams_open,
+            "streams_aborted": self.streams_aborted,
+        })
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--ttft-ms", type=float, default=300.0)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--tokens", type=int, default=120, help="tokens per answer")
+    parser.add_argument("--jitter", type=float, default=0.1, help="relative +- noise on every delay")
+    parser.add_argument("--rate-limit-rpm", type=float, default=0.0, help="0 disables the account limit")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--model-429-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def settings_from(args) -> MockSettings:
+    return MockSettings(
+        ttft_ms=args.ttft_ms,
+        tokens_per_second=args.tokens_per_second,
+        tokens=args.tokens,
+        jitter=args.jitter,
+        rate_limit_rpm=args.rate_limit_rpm,
+        error_rate=args.error_rate,
+        model_429_rate=args.model_429_rate,
+        seed=args.seed,
+    )
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    mock = MockOpenRouter(settings_from(args))
+    uvicorn.run(mock.app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""SSE relay micro-benchmark: tokens/sec per core for the streaming hot path.
+
+Feeds a synthetic OpenRouter event stream (chunk payloads shaped like the real
+ones, split across network-sized reads) through two relays and measures how many
+tokens one core can push through each:
+
+* ``legacy``: the previous path - decode to text lines, json.loads the chunk,
+  json.dumps a small dict, json.loads it again in the service and wrap it in an
+  f-string frame (three JSON passes per token).
+* ``relay``: openrouter.relay_sse - one parse per line straight from bytes and a
+  pre-encoded bytes frame per delta (orjson when installed).
+
+No network or database is involved; run it on an otherwise idle machine.
+
+    cd be
+    python -m benchmarks.sse_relay --tokens 200000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from app.services import openrouter
+
+CHUNK_TEMPLATE = {
+    "id": "gen-1760700000-AbCdEfGhIjKlMnOpQrSt",
+    "provider": "Chutes",
+    "model": "meta-llama/llama-3.3-70b-instruct:free",
+    "object": "chat.completion.chunk",
+    "created": 1760700000,
+    "choices": [{
+        "index": 0,
+        "delta": {"role": "assistant", "content": ""},
+        "finish_reason": None,
+        "native_finish_reason": None,
+        "logprobs": None
+    }]
+}
+
+
+def build_stream(tokens: int, read_size: int) -> list:
+    events = []
+    for i in range(tokens):
+        CHUNK_TEMPLATE["choices"][0]["delta"]["content"] = f" word{i % 97}"
+        events.append(b"data: " + json.dumps(CHUNK_TEMPLATE).encode() + b"\n\n")
+        if i % 50 == 0:
+            events.append(b": OPENROUTER PROCESSING\n\n")
+    events.append(b"data: [DONE]\n\n")
+    body = b"".join(events)
+    return [body[i:i + read_size] for i in range(0, len(body), read_size)]
+
+
+async def replay(reads: list):
+    for read in reads:
+        yield read
+
+
+async def legacy_relay(reads: list) -> int:
+    # Mirrors the old chat_completion_stream + ChatService.generate pair.
+    async def upstream():
+        buffer = ""
+        async for read in replay(reads):
+            buffer += read.decode()
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                if line.startswith("data: "):
+                    data = line[6:]
+                    if data == "[DONE]":
+                        yield json.dumps({"done": True})
+                        return
+                    try:
+                        chunk = json.loads(data)
+                        if "choices" in chunk and len(chunk["choices"]) > 0:
+                            content = chunk["choices"][0].get("delta", {}).get("content", "")
+                            if content:
+                                yield json.dumps({"content": content, "done": False})
+                    except json.JSONDecodeError:
+                        continue
+
+    tokens, chunks = 0, []
+    async for chunk in upstream():
+        data = json.loads(chunk)
+        if "content" in data:
+            chunks.append(data["content"])
+            tokens += 1
+        frame = f"data: {chunk}\n\n".encode()
+    return tokens
+
+
+async def new_relay(reads: list) -> int:
+    tokens, chunks = 0, []
+    async for delta in openrouter.relay_sse(replay(reads)):
+        if delta.content:
+            chunks.append(delta.content)
+            tokens += 1
+        frame = delta.frame
+    return tokens
+
+
+async def measure(relay, reads: list, rounds: int) -> dict:
+    best = None
+    tokens = 0
+    for _ in range(rounds):
+        started = time.process_time()
+        tokens = await relay(reads)
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {"tokens": tokens, "cpu_seconds": best, "tokens/s": tokens / best if best else 0.0}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=200000)
+    parser.add_argument("--read-size", type=int, default=4096, help="bytes per simulated socket read")
+    parser.add_argument("--rounds", type=int, default=3, help="best of N runs is reported")
+    args = parser.parse_args()
+
+    reads = build_stream(args.tokens, args.read_size)
+    parser_name = "orjson" if openrouter._loads is not json.loads else "json"
+
+    print(f"{'relay':<8} {'tokens':>8} {'cpu s':>8} {'tokens/s/core':>14}")
+    results = {}
+    for name, relay in (("legacy", legacy_relay), ("relay", new_relay)):
+        r = results[name] = await measure(relay, reads, args.rounds)
+        print(f"{name:<8} {r['tokens']:>8} {r['cpu_seconds']:>8.3f} {r['tokens/s']:>14.0f}")
+    print(f"speedup: {results['relay']['tokens/s'] / results['legacy']['tokens/s']:.2f}x (parser: {parser_name})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,41 @@
+"""indexes for the session list and message history queries
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+
+(user_id, updated_at DESC, id DESC) serves GET /api/sessions and
+(session_id, timestamp, id) serves message history loads, the last-message
+preview subquery and keyset pagination on both.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def _index_names(table):
+    return {ix["name"] for ix in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade():
+    if "ix_chat_sessions_user_id_updated_at" not in _index_names("chat_sessions"):
+        op.create_index(
+            "ix_chat_sessions_user_id_updated_at",
+            "chat_sessions",
+            ["user_id", sa.text("updated_at DESC"), sa.text("id DESC")],
+        )
+    if "ix_messages_session_id_timestamp" not in _index_names("messages"):
+        op.create_index(
+            "ix_messages_session_id_timestamp",
+            "messages",
+            ["session_id", "timestamp", "id"],
+        )
+
+
+def downgrade():
+    op.drop_index("ix_messages_session_id_timestamp", table_name="messages")
+    op.drop_index("ix_chat_sessions_user_id_updated_at", table_name="chat_sessions")
@@ -0,0 +1,30 @@
+"""messages.truncated flag for answers cut short by a client disconnect
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+
+Existing rows are complete answers, so the column is added with a false
+server default.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {c["name"] for c in sa.inspect(op.get_bind()).get_columns("messages")}
+    if "truncated" not in columns:
+        op.add_column(
+            "messages",
+            sa.Column("truncated", sa.Boolean(), nullable=False, server_default=sa.false()),
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("messages") as batch_op:
+        batch_op.drop_column("truncated")